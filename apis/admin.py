@@ -0,0 +1,206 @@
+import os
+from database.authdb import AuthDB
+from database.circuitbreaker import DatabaseUnavailable
+from database.faultinjection import FaultInjector
+from flask import Response
+from flask_restful import Resource, reqparse
+from logging import getLogger
+from profiling import Profiler
+from settings import Settings
+
+config = Settings.getConfig()
+log = getLogger('gunicorn.error')
+
+
+def checkAdmin(sessionKey):
+    """
+    Check that a session key belongs to an admin of the default org.
+    Returns None if it does, or an error response.
+    """
+    sessionValid, sessionUser, sessionOrg = \
+        AuthDB.validateSessionKey(sessionKey)
+
+    if not sessionValid:
+        return {'message': 'Invalid session key'}, 401
+
+    if not AuthDB.isOrgAdmin(config['defaultorg']['name'], sessionUser,
+                             sessionOrg):
+        return {'message':
+                'You do not have permission to view this resource'}, 403
+    return None
+
+
+class Profiles(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+
+    def get(self):
+        """
+        List the endpoints with request profiles
+        """
+        args = self.getParser.parse_args()
+
+        try:
+            error = checkAdmin(args['key'])
+            if error is not None:
+                return error
+
+            endpoints = Profiler.endpoints()
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in Profiles.get: %s', e)
+            return {'message': 'Unexpected error listing profiles'}, 500
+
+        return {'message': 'Found profiles for %d endpoints' %
+                (len(endpoints),),
+                'endpoints': endpoints}, 200
+
+
+class Profile(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    getParser.add_argument('sort', type=str, required=False,
+                           choices=('cumulative', 'tottime', 'calls'),
+                           help='Sort by cumulative, tottime or calls',
+                           default='cumulative', location='args')
+    getParser.add_argument('limit', type=int, required=False,
+                           help='Number of functions to return',
+                           default=50, location='args')
+    getParser.add_argument('format', type=str, required=False,
+                           choices=('json', 'pstats'),
+                           help='Return json or a pstats file',
+                           default='json', location='args')
+
+    def get(self, endpoint):
+        """
+        Aggregate the request profiles of an endpoint
+        """
+        args = self.getParser.parse_args()
+
+        try:
+            error = checkAdmin(args['key'])
+            if error is not None:
+                return error
+
+            stats = Profiler.aggregate(endpoint)
+            if stats is None:
+                return {'message': 'No profiles for %s' % (endpoint,)}, 404
+
+            if args['format'] == 'pstats':
+                return Response(
+                    Profiler.dump(stats), status=200,
+                    mimetype='application/octet-stream',
+                    headers={'Content-Disposition':
+                             'attachment; filename="%s.prof"' %
+                             (os.path.basename(
+                                 Profiler.endpointDirectory(endpoint)),)})
+
+            functions = Profiler.summarize(stats, args['sort'],
+                                           max(args['limit'], 1))
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in Profile.get: %s', e)
+            return {'message': 'Unexpected error reading profiles'}, 500
+
+        return {'message': 'Aggregated %d profiles of %s' %
+                (len(stats.files), endpoint),
+                'totaltime': stats.total_tt,
+                'functions': functions}, 200
+
+
+class Faults(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+
+    putParser = reqparse.RequestParser()
+    putParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    putParser.add_argument('rules', type=dict, required=False,
+                           action='append', location='json',
+                           help='List of fault injection rules')
+
+    deleteParser = reqparse.RequestParser()
+    deleteParser.add_argument('key', type=str, required=True,
+                              help='Valid session key',
+                              location=['headers', 'args'])
+
+    def get(self):
+        """
+        List the fault injection rules in effect
+        """
+        args = self.getParser.parse_args()
+
+        try:
+            with FaultInjector.suspend():
+                error = checkAdmin(args['key'])
+            if error is not None:
+                return error
+
+            rules = FaultInjector.describeRules()
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in Faults.get: %s', e)
+            return {'message': 'Unexpected error listing faults'}, 500
+
+        return {'message': 'Found %d fault injection rules' % (len(rules),),
+                'source': FaultInjector.source,
+                'rules': rules}, 200
+
+    def put(self):
+        """
+        Replace the fault injection rules of every worker on this host
+        """
+        args = self.putParser.parse_args()
+        # An empty list is parsed as a missing argument
+        rules = args['rules'] or []
+
+        try:
+            with FaultInjector.suspend():
+                error = checkAdmin(args['key'])
+            if error is not None:
+                return error
+
+            try:
+                FaultInjector.saveRules(rules)
+            except ValueError as e:
+                return {'message': 'Invalid rule: %s' % (e,)}, 400
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in Faults.put: %s', e)
+            return {'message': 'Unexpected error setting faults'}, 500
+
+        return {'message': 'Set %d fault injection rules' %
+                (len(rules),)}, 200
+
+    def delete(self):
+        """
+        Return every worker on this host to the configured rules
+        """
+        args = self.deleteParser.parse_args()
+
+        try:
+            with FaultInjector.suspend():
+                error = checkAdmin(args['key'])
+            if error is not None:
+                return error
+
+            FaultInjector.resetRules()
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in Faults.delete: %s', e)
+            return {'message': 'Unexpected error resetting faults'}, 500
+
+        return {'message': 'Restored the configured fault injection ' +
+                'rules'}, 200
@@ -0,0 +1,185 @@
+import io
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app, request
+from flask_restful import Resource, reqparse
+from logging import getLogger
+from settings import Settings
+from urllib.parse import unquote_to_bytes
+
+config = Settings.getConfig()
+log = getLogger('gunicorn.error')
+
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+# Keys of the batch request's WSGI environ that sub-requests share
+SHARED_ENVIRON = ('SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT',
+                  'SERVER_PROTOCOL', 'wsgi.errors', 'wsgi.multiprocess',
+                  'wsgi.multithread', 'wsgi.run_once', 'wsgi.url_scheme',
+                  'wsgi.version')
+
+
+def checkRequests(subRequests):
+    """
+    Validate a list of sub-requests. Returns an error message, or None if
+    the list is valid.
+    """
+    if len(subRequests) == 0:
+        return 'No requests given'
+    if len(subRequests) > config['batch']['maxrequests']:
+        return ('At most %d requests may be batched' %
+                (config['batch']['maxrequests'],))
+
+    ids = set()
+    for sub in subRequests:
+        if not isinstance(sub, dict):
+            return 'Each request must be an object'
+        if not isinstance(sub.get('id'), str) or sub['id'] in ids:
+            return 'Each request needs a unique string id'
+        ids.add(sub['id'])
+        if not isinstance(sub.get('path'), str) or \
+                not sub['path'].startswith('/'):
+            return 'Request "%s" needs an absolute path' % (sub['id'],)
+        if sub['path'].split('?')[0].rstrip('/') == '/batch':
+            return 'Request "%s" may not be a batch' % (sub['id'],)
+        if not isinstance(sub.get('dependson', []), list):
+            return 'dependson of request "%s" must be a list' % (sub['id'],)
+
+    for sub in subRequests:
+        for dep in sub.get('dependson', []):
+            if dep not in ids:
+                return ('Request "%s" depends on unknown request "%s"' %
+                        (sub['id'], dep))
+
+    # Reject cycles: repeatedly remove requests whose dependencies are gone
+    remaining = {sub['id']: set(sub.get('dependson', []))
+                 for sub in subRequests}
+    while remaining:
+        ready = [i for i, deps in remaining.items()
+                 if not deps & remaining.keys()]
+        if len(ready) == 0:
+            return 'Request dependencies contain a cycle'
+        for i in ready:
+            del remaining[i]
+    return None
+
+
+def checkRequest(sub):
+    """
+    Validate the method and headers of a sub-request. Returns an error
+    message, or None if they are valid.
+    """
+    method = sub.get('method', 'GET')
+    if not isinstance(method, str) or method.upper() not in METHODS:
+        return 'method must be one of %s' % (', '.join(METHODS),)
+    headers = sub.get('headers', {})
+    if not isinstance(headers, dict) or not all(
+            isinstance(value, str) for value in headers.values()):
+        return 'headers must be an object of strings'
+    return None
+
+
+def subEnviron(parent, sub):
+    """
+    WSGI environ of a sub-request, sharing the server details and client
+    address of the batch request
+    """
+    path, _, query = sub['path'].partition('?')
+    body = b''
+    if sub.get('body') is not None:
+        body = json.dumps(sub['body']).encode('utf-8')
+
+    environ = {key: parent[key] for key in SHARED_ENVIRON if key in parent}
+    environ.update({
+        'REQUEST_METHOD': sub.get('method', 'GET').upper(),
+        # PATH_INFO holds the unquoted path bytes as latin-1
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'REMOTE_ADDR': parent.get('REMOTE_ADDR'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body)})
+    if body:
+        environ['CONTENT_TYPE'] = 'application/json'
+    for name, value in sub.get('headers', {}).items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value
+    return environ
+
+
+def runRequest(app, sub, environ):
+    """
+    Dispatch a single sub-request through the Flask app in-process
+    """
+    try:
+        with app.request_context(environ):
+            response = app.full_dispatch_request()
+            body = response.get_json(silent=True)
+            if body is None:
+                body = response.get_data(as_text=True)
+    except Exception as e:
+        log.error('Exception in batch request "%s": %s', sub['id'], e)
+        return {'id': sub['id'], 'status': 500,
+                'body': {'message': 'Unexpected error'}}
+    return {'id': sub['id'], 'status': response.status_code, 'body': body}
+
+
+class Batch(Resource):
+    postParser = reqparse.RequestParser()
+    postParser.add_argument('requests', type=dict, required=True,
+                            action='append', location='json',
+                            help='List of requests to run')
+
+    def post(self):
+        """
+        Run several API requests in one call. Requests without unmet
+        dependencies run concurrently. A request whose dependency failed
+        (status 400 or above) is not run and gets a 424.
+        """
+        args = self.postParser.parse_args()
+
+        subRequests = args['requests']
+        error = checkRequests(subRequests)
+        if error is not None:
+            return {'message': error}, 400
+
+        app = current_app._get_current_object()
+        pending = {}
+        results = {}
+        running = {}
+        for sub in subRequests:
+            error = checkRequest(sub)
+            if error is not None:
+                results[sub['id']] = {
+                    'id': sub['id'], 'status': 400,
+                    'body': {'message': 'Request "%s": %s' %
+                             (sub['id'], error)}}
+            else:
+                pending[sub['id']] = (sub, subEnviron(request.environ, sub))
+
+        with ThreadPoolExecutor(
+                max_workers=config['batch']['maxworkers']) as executor:
+            while pending or running:
+                for subId, (sub, environ) in list(pending.items()):
+                    deps = sub.get('dependson', [])
+                    if any(dep not in results for dep in deps):
+                        continue
+                    del pending[subId]
+                    failed = [dep for dep in deps
+                              if results[dep]['status'] >= 400]
+                    if failed:
+                        results[subId] = {
+                            'id': subId, 'status': 424,
+                            'body': {'message': 'Dependency "%s" failed' %
+                                     (failed[0],)}}
+                    else:
+                        running[executor.submit(runRequest, app, sub,
+                                                environ)] = subId
+
+                if not running:
+                    continue
+                done, notDone = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+
+        return {'responses': [results[sub['id']] for sub in subRequests]}, 200
@@ -0,0 +1,15 @@
+from flask import Response
+from flask_restful import Resource
+from logging import getLogger
+from metrics import Metrics as ProcessMetrics
+
+log = getLogger('gunicorn.error')
+
+
+class Metrics(Resource):
+    def get(self):
+        """
+        Export metrics in the Prometheus text format
+        """
+        return Response(ProcessMetrics.render(), status=200,
+                        mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,185 @@
+import base64
+import json
+from database.authdb import AuthDB
+from database.circuitbreaker import DatabaseUnavailable
+from database.eventlog import EventLog
+from database.tenantquotas import QuotaExceeded
+from flask_restful import Resource, reqparse
+from logging import getLogger
+from settings import Settings
+
+config = Settings.getConfig()
+log = getLogger('gunicorn.error')
+
+
+def encodeCursor(bucket, after):
+    """
+    Encode an orgusers index position as an opaque cursor string
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([bucket, after]).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    """
+    Decode a cursor from encodeCursor(). Raises ValueError if the cursor is
+    malformed.
+    """
+    try:
+        bucket, after = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if (not isinstance(bucket, int) or bucket < 0 or
+            not (after is None or isinstance(after, str))):
+        raise ValueError('Invalid cursor')
+    return bucket, after
+
+
+class OrgStats(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+
+    def get(self, org):
+        """
+        Get the number of users and stored sessions of an organization from
+        its maintained counters
+        """
+        args = self.getParser.parse_args()
+
+        sessionValid, sessionUser, sessionOrg = \
+            AuthDB.validateSessionKey(args['key'])
+
+        if not sessionValid:
+            return {'message': 'Invalid session key'}, 401
+
+        try:
+            if not AuthDB.isOrgAdmin(org, sessionUser, sessionOrg):
+                return {'message':
+                        'You do not have permission to view this resource'}, \
+                    403
+
+            counters = AuthDB.getOrgCounters(org)
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in OrgStats.get: %s', e)
+            return {'message': 'Unexpected error getting stats'}, 500
+
+        return dict({'message': 'Stats of %s' % (org,), 'org': org},
+                    **counters), 200
+
+
+class OrgUsers(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    getParser.add_argument('prefix', type=str, required=False,
+                           help='Only list usernames starting with prefix',
+                           default=None, location='args')
+    getParser.add_argument('limit', type=int, required=False,
+                           help='Maximum number of users to return',
+                           default=config['orgs']['defaultpagesize'],
+                           location='args')
+    getParser.add_argument('cursor', type=str, required=False,
+                           help='Cursor returned by the previous page',
+                           default=None, location='args')
+
+    def get(self, org):
+        """
+        List the users of an organization, one page at a time
+        """
+        args = self.getParser.parse_args()
+
+        sessionValid, sessionUser, sessionOrg = \
+            AuthDB.validateSessionKey(args['key'])
+
+        if not sessionValid:
+            return {'message': 'Invalid session key'}, 401
+
+        limit = min(max(args['limit'], 1), config['orgs']['maxpagesize'])
+
+        bucket, after = 0, None
+        if args['cursor'] is not None:
+            try:
+                bucket, after = decodeCursor(args['cursor'])
+            except ValueError:
+                return {'message': 'Invalid cursor'}, 400
+
+        try:
+            if not AuthDB.isOrgAdmin(org, sessionUser, sessionOrg):
+                return {'message':
+                        'You do not have permission to view this resource'}, \
+                    403
+
+            usernames, nextBucket, nextAfter = AuthDB.getOrgUsersPage(
+                org, limit, bucket=bucket, after=after,
+                prefix=args['prefix'],
+                maxBuckets=config['orgs']['maxbucketsperpage'])
+        except (DatabaseUnavailable, QuotaExceeded):
+            raise
+        except Exception as e:
+            log.error('Exception in OrgUsers.get: %s', e)
+            return {'message': 'Unexpected error listing users'}, 500
+
+        return {'message': 'Found %d users in %s' % (len(usernames), org),
+                'users': usernames,
+                'cursor': (encodeCursor(nextBucket, nextAfter)
+                           if nextBucket is not None else None)}, 200
+
+
+class OrgEvents(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    getParser.add_argument('start', type=float, required=False,
+                           help='Earliest event time (seconds since epoch)',
+                           default=None, location='args')
+    getParser.add_argument('end', type=float, required=False,
+                           help='Latest event time (seconds since epoch)',
+                           default=None, location='args')
+    getParser.add_argument('limit', type=int, required=False,
+                           help='Maximum number of events to return',
+                           default=config['eventlog']['querylimit'],
+                           location='args')
+
+    def get(self, org):
+        """
+        List the auth events of an organization's users within a time range
+        """
+        args = self.getParser.parse_args()
+
+        sessionValid, sessionUser, sessionOrg = \
+            AuthDB.validateSessionKey(args['key'])
+
+        if not sessionValid:
+            return {'message': 'Invalid session key'}, 401
+
+        try:
+            start, end = EventLog.queryWindow(
+                args['start'], args['end'],
+                maxRange=config['eventlog']['maxorgqueryrange'])
+        except ValueError as ve:
+            return {'message': str(ve)}, 400
+        limit = min(max(args['limit'], 1), config['eventlog']['querylimit'])
+
+        try:
+            if not AuthDB.isOrgAdmin(org, sessionUser, sessionOrg):
+                return {'message':
+                        'You do not have permission to view this resource'}, \
+                    403
+
+            events = AuthDB.getOrgAuthEvents(org, start, end, limit)
+        except (DatabaseUnavailable, QuotaExceeded):
+            raise
+        except Exception as e:
+            log.error('Exception in OrgEvents.get: %s', e)
+            return {'message': 'Unexpected error listing events'}, 500
+
+        return {'message': 'Found %d events in %s' % (len(events), org),
+                'events': [EventLog.formatEvent(event) for event in events]}, \
+            200
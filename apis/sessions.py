@@ -1,4 +1,8 @@
 from database.authdb import AuthDB
+from database.circuitbreaker import DatabaseUnavailable
+from database.eventlog import EventLog
+from database.tenantquotas import QuotaExceeded
+from flask import request
 from flask_restful import Resource, reqparse
 from logging import getLogger
 from settings import Settings
@@ -8,15 +12,21 @@ log = getLogger('gunicorn.error')
 
 
 class Sessions(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+
+    postParser = reqparse.RequestParser()
+    postParser.add_argument('password', type=str, required=True,
+                            help='PBKDF2 hash of the user\'s password using ' +
+                            '"user@org" as the salt and count=10000')
+
     def get(self, username, org):
         """
         List user's sessions
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument('key', type=str, required=True,
-                            help='Valid session key',
-                            location=['headers', 'args'])
-        args = parser.parse_args()
+        args = self.getParser.parse_args()
 
         sessionValid, sessionUser, sessionOrg = \
             AuthDB.validateSessionKey(args['key'])
@@ -40,53 +50,64 @@ class Sessions(Resource):
             else:
                 return {'message': 'Key expired or invalid'}, 401
 
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
-            log.critical('Error in Sessions.get: %s' % (e,))
+            log.critical('Error in Sessions.get: %s', e)
 
     def post(self, username, org):
         """
         Create a session for the user.
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument('password', type=str, required=True,
-                            help='PBKDF2 hash of the user\'s password using ' +
-                            '"user@org" as the salt and count=10000')
-        args = parser.parse_args()
+        args = self.postParser.parse_args()
 
         try:
-            if AuthDB.userExists(org, username):
+            if AuthDB.userMayExist(org, username):
                 if AuthDB.validatePassword(org, username, args['password']):
                     sessionId = AuthDB.createUserSession(org, username)
                     sessionKey = AuthDB.createUserSessionKey(org, username,
                                                              sessionId)
                     if sessionId and sessionKey:
+                        EventLog.record('login', org, username,
+                                        sessionId=sessionId,
+                                        source=request.remote_addr)
                         return {'message': 'Session created',
                                 'id': str(sessionId),
                                 'key': sessionKey}
                     else:
                         return {'message': 'Failed to open session'}, 500
                 else:
+                    EventLog.record('loginfailed', org, username,
+                                    source=request.remote_addr,
+                                    detail='invalid password')
                     return {'message':
                             'Password authentication failed for "%s@%s".'
                             % (username, org)}, 400
             else:
+                EventLog.record('loginfailed', org, username,
+                                source=request.remote_addr,
+                                detail='invalid user', knownUser=False)
                 return {'message':
                         'Cannot open session for invalid user "%s@%s".'
                         % (username, org)}, 404
+        except (DatabaseUnavailable, QuotaExceeded):
+            raise
         except Exception as e:
-            log.critical("Error in Sessions.post: %s" % (e,))
+            log.critical("Error in Sessions.post: %s", e)
 
 
 class Session(Resource):
+    # GET and DELETE take the same arguments
+    keyParser = reqparse.RequestParser()
+    keyParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+
     def get(self, username, org, sessionId=None):
         """
         List information about a user's session
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument('key', type=str, required=True,
-                            help='Valid session key',
-                            location=['headers', 'args'])
-        args = parser.parse_args()
+        args = self.keyParser.parse_args()
 
         sessionValid, sessionUser, sessionOrg = \
             AuthDB.validateSessionKey(args['key'])
@@ -122,11 +143,7 @@ class Session(Resource):
         """
         Delete (invalidate) a user's session
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument('key', type=str, required=True,
-                            help='Valid session key',
-                            location=['headers', 'args'])
-        args = parser.parse_args()
+        args = self.keyParser.parse_args()
 
         sessionValid, sessionUser, sessionOrg = \
             AuthDB.validateSessionKey(args['key'])
@@ -144,7 +161,40 @@ class Session(Resource):
             else:
                 AuthDB.deleteUserSession(org, username, sessionId)
 
+            EventLog.record('sessiondelete', org, username,
+                            sessionId=sessionId, source=request.remote_addr,
+                            detail='current' if sessionId is None else None)
+
             return {'message': 'Session deleted'}, 200
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
-            log.error('Exception in Session.delete: %s' % (str(e),))
+            log.error('Exception in Session.delete: %s', e)
             return {'message': 'Unexpected error deleting the session'}, 500
+
+
+class SessionsValidate(Resource):
+    postParser = reqparse.RequestParser()
+    postParser.add_argument('keys', type=str, required=True,
+                            action='append', location='json',
+                            help='List of session keys to validate')
+
+    def post(self):
+        """
+        Validate many session keys in one request
+        """
+        args = self.postParser.parse_args()
+
+        if len(args['keys']) > config['sessions']['maxvalidatebatch']:
+            return {'message': 'At most %d keys may be validated at once' %
+                    (config['sessions']['maxvalidatebatch'],)}, 400
+
+        try:
+            results = AuthDB.validateSessionKeys(args['keys'])
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in SessionsValidate.post: %s', e)
+            return {'message': 'Unexpected error validating sessions'}, 500
+
+        return {'results': [list(result) for result in results]}, 200
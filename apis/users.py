@@ -1,30 +1,59 @@
+import base64
+import json
 import passwordutils
-from cassandra import ConsistencyLevel
+from flask import Response, request
 from flask_restful import Resource, reqparse
 from logging import getLogger
 from settings import Settings
 from database.authdb import AuthDB
+from database.circuitbreaker import DatabaseUnavailable
+from database.eventlog import EventLog
+from database.tenantquotas import QuotaExceeded
 
 config = Settings.getConfig()
 log = getLogger('gunicorn.error')
 
 
+def encodeChildCursor(org, username):
+    """
+    Encode a userchildren index position as an opaque cursor string
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps([org, username]).encode('utf-8')).decode('ascii')
+
+
+def decodeChildCursor(cursor):
+    """
+    Decode a cursor from encodeChildCursor(). Raises ValueError if the cursor
+    is malformed.
+    """
+    try:
+        org, username = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not (isinstance(org, str) and isinstance(username, str)):
+        raise ValueError('Invalid cursor')
+    return org, username
+
+
 class Users(Resource):
-    def post(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument('username', type=str, required=True,
+    postParser = reqparse.RequestParser()
+    postParser.add_argument('username', type=str, required=True,
                             help='Username')
-        parser.add_argument('org', type=str, required=True,
+    postParser.add_argument('org', type=str, required=True,
                             help='Org for user membership')
-        parser.add_argument('email', type=str, required=True,
+    postParser.add_argument('email', type=str, required=True,
                             help='Email address for user')
-        parser.add_argument('parentuser', type=str, required=False,
+    postParser.add_argument('parentuser', type=str, required=False,
                             help='Parent user in form of user@org',
                             default=None)
-        parser.add_argument('key', type=str, required=False,
+    postParser.add_argument('key', type=str, required=False,
                             help='Valid session key of parentuser',
                             default=None, location=['headers', 'form', 'args'])
-        args = parser.parse_args()
+
+    def post(self):
+        args = self.postParser.parse_args()
 
         parentusername, parentuserorg = '', ''
         try:
@@ -39,47 +68,46 @@ class Users(Resource):
             sessionValid, sessionUser, sessionOrg = (False, '', '')
 
         try:
-            if not AuthDB.userExists(args['org'], args['username']):
-                regOpen = AuthDB.getOrgSetting(args['org'],
-                                               'registrationOpen').current_rows
-                if len(regOpen) == 0 or regOpen[0].value == 0:
-                    return {'Message':
-                            'Cannot create user "%s@%s". Organization is ' %
-                            (args['username'], args['org']) +
-                            'closed for registrations or does not exist.'}, 400
-                elif (args['parentuser'] is not None and
-                      (len(parentusername) == 0 or len(parentuserorg) == 0 or
-                       not AuthDB.userExists(parentuserorg, parentusername))):
-                    return {'Message':
-                            'Cannot create user "%s@%s". ' %
-                            (args['username'], args['org']) +
-                            'Parent user "%s" does not exist.' %
-                            (args['parentuser'],)}, 400
-                elif (args['parentuser'] is not None and
-                        args['key'] is None):
-                    return {'Message':
-                            'Cannot create user "%s@%s". ' %
-                            (args['username'], args['org']) +
-                            'Must provide valid session key for "%s" ' %
-                            (args['parentuser'],)}, 401
-                elif (args['parentuser'] is not None and
-                      not (sessionValid and sessionUser == parentusername and
-                           sessionOrg == parentuserorg)):
-                    return {'Message':
-                            'Cannot create user "%s@%s". ' %
-                            (args['username'], args['org']) +
-                            'Session key not valid for parent user "%s".' %
-                            (args['parentuser'],)}, 403
-                else:
-                    AuthDB.createUser(args['org'], args['username'],
-                                      args['email'], args['parentuser'],
-                                      ConsistencyLevel.QUORUM)
-            else:
+            regOpen = AuthDB.getOrgSetting(args['org'],
+                                           'registrationOpen').current_rows
+            if len(regOpen) == 0 or regOpen[0].value == 0:
+                return {'Message':
+                        'Cannot create user "%s@%s". Organization is ' %
+                        (args['username'], args['org']) +
+                        'closed for registrations or does not exist.'}, 400
+            elif (args['parentuser'] is not None and
+                  (len(parentusername) == 0 or len(parentuserorg) == 0)):
+                return {'Message':
+                        'Cannot create user "%s@%s". ' %
+                        (args['username'], args['org']) +
+                        'Parent user "%s" does not exist.' %
+                        (args['parentuser'],)}, 400
+            elif (args['parentuser'] is not None and
+                    args['key'] is None):
+                return {'Message':
+                        'Cannot create user "%s@%s". ' %
+                        (args['username'], args['org']) +
+                        'Must provide valid session key for "%s" ' %
+                        (args['parentuser'],)}, 401
+            elif (args['parentuser'] is not None and
+                  not (sessionValid and sessionUser == parentusername and
+                       sessionOrg == parentuserorg)):
+                # A valid session of the parent also shows that it exists
+                return {'Message':
+                        'Cannot create user "%s@%s". ' %
+                        (args['username'], args['org']) +
+                        'Session key not valid for parent user "%s".' %
+                        (args['parentuser'],)}, 403
+            elif not AuthDB.createUser(args['org'], args['username'],
+                                       args['email'], args['parentuser']):
+                # The conditional insert found an existing user
                 return {'Message':
                         'Cannot create user "%s@%s", as it already exists.' %
                         (args['username'], args['org'])}, 400
+        except (DatabaseUnavailable, QuotaExceeded):
+            raise
         except Exception as e:
-            log.error('Exception in Users.Post: %s' % (e,))
+            log.error('Exception in Users.Post: %s', e)
             return {'ServerError': 500, 'Message':
                     'There was an error fulfiling your request'}, 500
         return {'Message':
@@ -89,18 +117,34 @@ class Users(Resource):
 class User(Resource):
     def get(self, username, org):
         """
-        Retrieve basic user record information.
+        Retrieve basic user record information. Responses carry a strong ETag
+        derived from the record's write time, and If-None-Match requests for
+        an unchanged record get a 304. Records without a write time, such as
+        partially written rows, are returned without an ETag.
         """
         try:
-            results = AuthDB.getUser(org, username).current_rows
+            results = AuthDB.getCachedUser(org, username)
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
-            log.error('Exception on User/get: %s' % str(e))
+            log.error('Exception on User/get: %s', e)
             return {'ServerError': 500, 'Message':
                     'There was an error fulfiling your request'}, 500
         if len(results) == 0:
             return {'Message':
                     'No user matched "%s"@"%s"' % (username, org)}, 404
         elif len(results) == 1:
+            writeTimes = [t for t in (results[0].createdatetime,
+                                      results[0].parentusertime)
+                          if t is not None]
+            headers = {'Cache-Control': 'public, max-age=%d' %
+                       (config['usercache']['maxage'],)}
+            if len(writeTimes) > 0:
+                etag = '%x' % (max(writeTimes),)
+                headers['ETag'] = '"%s"' % (etag,)
+                if request.if_none_match.contains_weak(etag):
+                    return Response(status=304, headers=headers)
+
             # dict(zip(n._fields, list(n)))
             user = {
                     'username': results[0].username,
@@ -110,7 +154,7 @@ class User(Resource):
                     }
             if results[0].parentuser is not None:
                 user['parentuser'] = results[0].parentuser
-            return user
+            return user, 200, headers
         else:
             return {'RequestError': 400, 'Message':
                     'Request returned too many results'}, 400
@@ -119,9 +163,11 @@ class User(Resource):
 class RequestPasswordReset(Resource):
     def post(self, username, org):
         try:
-            if AuthDB.userExists(org, username):
+            if AuthDB.userMayExist(org, username):
                 resetid = AuthDB.createPasswordReset(org, username)
                 if resetid:
+                    EventLog.record('passwordresetrequest', org, username,
+                                    source=request.remote_addr)
                     # TODO: Email ResetID
                     return {'Message':
                             'Password reset for "%s"@"%s"'
@@ -134,24 +180,27 @@ class RequestPasswordReset(Resource):
                 return {'Message':
                         'Cannot reset password for invalid user "%s"@"%s"'
                         % (username, org)}, 400
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
-            log.error('Exception in PasswordReset.Post: %s' % (e,))
+            log.error('Exception in PasswordReset.Post: %s', e)
             return {'ServerError': 500, 'Message':
                     'There was an error fulfiling your request'}, 500
 
 
 class CompletePasswordReset(Resource):
-    def post(self, username, org):
-        parser = reqparse.RequestParser()
-        parser.add_argument('resetid', type=str, required=True,
+    postParser = reqparse.RequestParser()
+    postParser.add_argument('resetid', type=str, required=True,
                             help='ResetID of the reset request')
-        parser.add_argument('password', type=str, required=True,
+    postParser.add_argument('password', type=str, required=True,
                             help='New password equivelent created from the ' +
                             'output of the pbkdf2 function salted with ' +
                             '"username@org" and a count of 100000')
-        args = parser.parse_args()
 
-        if AuthDB.userExists(org, username):
+    def post(self, username, org):
+        args = self.postParser.parse_args()
+
+        if AuthDB.userMayExist(org, username):
             if AuthDB.validatePasswordReset(org, username, args['resetid']):
                 try:
                     salt = passwordutils.generateSalt()
@@ -159,20 +208,142 @@ class CompletePasswordReset(Resource):
                         args['password'], salt, algo='argon2',
                         params={'t': 5})
                     AuthDB.setPassword(org, username, passwordHash, salt)
+                except DatabaseUnavailable:
+                    raise
                 except Exception as e:
-                    log.error('Exeption in CompletePasswordReset Post: %s'
-                              % (e,))
+                    log.error('Exeption in CompletePasswordReset Post: %s', e)
                     return {'message':
                             'Error changing password for "%s"@"%s"'
                             % (username, org)}, 500
                 finally:
                     AuthDB.deletePasswordReset(org, username)
+                EventLog.record('passwordreset', org, username,
+                                source=request.remote_addr)
                 return {'message': 'Password updated for "%s"@"%s".'
                         % (username, org)}, 200
             else:
+                EventLog.record('passwordresetfailed', org, username,
+                                source=request.remote_addr,
+                                detail='invalid or expired resetid')
                 return {'message': 'Cannot change password for "%s"@"%s". '
                         % (username, org) + 'Invalid or expired resetid'}, 400
         else:
             return {'message':
                     'Cannot change password for invalid user "%s"@"%s"'
                     % (username, org)}, 400
+
+
+class UserEvents(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    getParser.add_argument('start', type=float, required=False,
+                           help='Earliest event time (seconds since epoch)',
+                           default=None, location='args')
+    getParser.add_argument('end', type=float, required=False,
+                           help='Latest event time (seconds since epoch)',
+                           default=None, location='args')
+    getParser.add_argument('limit', type=int, required=False,
+                           help='Maximum number of events to return',
+                           default=config['eventlog']['querylimit'],
+                           location='args')
+
+    def get(self, username, org):
+        """
+        List a user's auth events within a time range. Requires being logged
+        in as the user or as an admin of the user's organization.
+        """
+        args = self.getParser.parse_args()
+
+        sessionValid, sessionUser, sessionOrg = \
+            AuthDB.validateSessionKey(args['key'])
+
+        if not sessionValid:
+            return {'message': 'Invalid session key'}, 401
+
+        try:
+            start, end = EventLog.queryWindow(args['start'], args['end'])
+        except ValueError as ve:
+            return {'message': str(ve)}, 400
+        limit = min(max(args['limit'], 1), config['eventlog']['querylimit'])
+
+        try:
+            if (not (sessionUser == username and sessionOrg == org) and
+                    not AuthDB.isOrgAdmin(org, sessionUser, sessionOrg)):
+                return {'message':
+                        'You do not have permission to view this resource'}, \
+                    403
+
+            events = AuthDB.getUserAuthEvents(org, username, start, end, limit)
+        except DatabaseUnavailable:
+            raise
+        except Exception as e:
+            log.error('Exception in UserEvents.get: %s', e)
+            return {'message': 'Unexpected error listing events'}, 500
+
+        return {'message': 'Found %d events for %s@%s' %
+                (len(events), username, org),
+                'events': [EventLog.formatEvent(event) for event in events]}, \
+            200
+
+
+class UserChildren(Resource):
+    getParser = reqparse.RequestParser()
+    getParser.add_argument('key', type=str, required=True,
+                           help='Valid session key',
+                           location=['headers', 'args'])
+    getParser.add_argument('limit', type=int, required=False,
+                           help='Maximum number of users to return',
+                           default=config['users']['childrenpagesize'],
+                           location='args')
+    getParser.add_argument('cursor', type=str, required=False,
+                           help='Cursor returned by the previous page',
+                           default=None, location='args')
+
+    def get(self, username, org):
+        """
+        List the child users of a user, one page at a time. Requires being
+        logged in as the user, one of its ancestors or an admin of the
+        user's organization.
+        """
+        args = self.getParser.parse_args()
+
+        sessionValid, sessionUser, sessionOrg = \
+            AuthDB.validateSessionKey(args['key'])
+
+        if not sessionValid:
+            return {'message': 'Invalid session key'}, 401
+
+        limit = min(max(args['limit'], 1),
+                    config['users']['maxchildrenpagesize'])
+
+        after = None
+        if args['cursor'] is not None:
+            try:
+                after = decodeChildCursor(args['cursor'])
+            except ValueError:
+                return {'message': 'Invalid cursor'}, 400
+
+        try:
+            if (not (sessionUser == username and sessionOrg == org) and
+                    not AuthDB.isUserAncestor(org, username, sessionUser,
+                                              sessionOrg) and
+                    not AuthDB.isOrgAdmin(org, sessionUser, sessionOrg)):
+                return {'message':
+                        'You do not have permission to view this resource'}, \
+                    403
+
+            children, nextAfter = AuthDB.getUserChildrenPage(
+                org, username, limit, after=after)
+        except (DatabaseUnavailable, QuotaExceeded):
+            raise
+        except Exception as e:
+            log.error('Exception in UserChildren.get: %s', e)
+            return {'message': 'Unexpected error listing users'}, 500
+
+        return {'message': 'Found %d child users of %s@%s' %
+                (len(children), username, org),
+                'users': children,
+                'cursor': (encodeChildCursor(*nextAfter)
+                           if nextAfter is not None else None)}, 200
@@ -1,36 +1,94 @@
+import apis.admin
+import apis.batch
+import apis.metrics
+import apis.orgs
 import apis.sessions
 import apis.users
+import representations
 from database.authdb import AuthDB
-from flask import Flask
+from database.circuitbreaker import CircuitBreaker, DatabaseUnavailable
+from flask import Flask, jsonify, request
 from flask_restful import Api
 from logging import getLogger
+from logutils import QueueLogging
+from profiling import Profiler
 from settings import Settings
+from trafficcapture import TrafficCapture
 
 log = getLogger('gunicorn.error')
 
 config = Settings.getConfig()
 
-log.info("Initializing database.")
+if config['schema']['migrateonboot']:
+    import migrate
+    migrate.bootstrap()
 
-AuthDB.setupDB()
-AuthDB.createDefaultOrg(config['defaultorg']['name'],
-                        config['defaultorg']['defaultadminuser'],
-                        config['defaultorg']['defaultadminemail'])
-
-log.info("Database initialization complete.")
 log.info("Initializing Flask Application.")
 
+QueueLogging.install()
+
 app = Flask(__name__)
 api = Api(app)
+api.representations['application/json'] = representations.outputJson
+Profiler.install(app)
+TrafficCapture.install(app)
+
+
+@app.before_request
+def startLogging():
+    """
+    Start the log listener in workers forked after the app was loaded
+    """
+    QueueLogging.install()
+
+
+@app.before_request
+def checkDatabase():
+    """
+    Fail fast while the database circuit breaker is open
+    """
+    if request.endpoint != 'metrics' and CircuitBreaker.isOpen():
+        response = jsonify({'message': DatabaseUnavailable.description})
+        response.headers['Retry-After'] = \
+            str(config['circuitbreaker']['opentime'])
+        return response, 503
+
+
+@app.before_request
+def checkSchema():
+    """
+    Refuse traffic until the database schema has been migrated to the
+    version this code expects (see migrate.py).
+    """
+    if request.endpoint != 'metrics' and not AuthDB.schemaReady():
+        return jsonify({'message': 'Service unavailable: database schema ' +
+                        'is out of date'}), 503
+
 
 log.info("Adding API resources.")
 
 api.add_resource(apis.users.Users, '/users')
 api.add_resource(apis.users.User, '/users/<string:username>@<string:org>')
+api.add_resource(apis.users.UserChildren,
+                 '/users/<string:username>@<string:org>/children')
+api.add_resource(apis.users.UserEvents,
+                 '/users/<string:username>@<string:org>/events')
 api.add_resource(apis.users.RequestPasswordReset,
                  '/users/<string:username>@<string:org>/requestpasswordreset')
 api.add_resource(apis.users.CompletePasswordReset,
                  '/users/<string:username>@<string:org>/completepasswordreset')
+if config['profiling']['enabled']:
+    api.add_resource(apis.admin.Profiles, '/admin/profiles')
+    api.add_resource(apis.admin.Profile,
+                     '/admin/profiles/<string:endpoint>')
+if config['faultinjection']['enabled']:
+    api.add_resource(apis.admin.Faults, '/admin/faults')
+api.add_resource(apis.batch.Batch, '/batch')
+api.add_resource(apis.metrics.Metrics, '/metrics')
+api.add_resource(apis.orgs.OrgEvents, '/orgs/<string:org>/events')
+api.add_resource(apis.orgs.OrgStats, '/orgs/<string:org>/stats')
+api.add_resource(apis.orgs.OrgUsers, '/orgs/<string:org>/users')
+api.add_resource(apis.sessions.SessionsValidate, '/sessions/validate')
 api.add_resource(apis.sessions.Sessions,
                  '/sessions/<string:username>@<string:org>')
 api.add_resource(apis.sessions.Session,
@@ -1,15 +1,32 @@
 import passwordutils
 import uuid
-from cassandra import ConsistencyLevel
+import zlib
+from cacheutils import TTLCache
+from cassandra.query import BatchStatement, BatchType
 from database.cassandra import CassandraCluster
+from database.circuitbreaker import UNAVAILABLE_ERRORS, DatabaseUnavailable
 from database.db import DB
+from database.orgcounters import COUNTERS, OrgCounters
+from database.orgtree import OrgTree
+from database.sessioncache import CachedSession, SessionCache
+from database.tenantquotas import TenantQuotas
+from database.userfilter import UserFilter
 from datetime import datetime, timedelta
 from logging import getLogger
+from metrics import Metrics
 from random import SystemRandom
 from settings import Settings
 
 log = getLogger('gunicorn.error')
 
+config = Settings.getConfig()
+
+Metrics.describe('session_evictions_total', 'counter',
+                 'Sessions evicted for exceeding the per-user session cap')
+
+# New session keys tried before giving up on creating a session key
+SESSION_KEY_ATTEMPTS = 3
+
 
 class AuthDB(DB):
     """
@@ -19,6 +36,14 @@ class AuthDB(DB):
 
     config = Settings.getConfig()
     keyspace = config['cassandra']['auth_keyspace']
+    orgSettingsCache = TTLCache(config['orgsettings']['cachesize'],
+                                config['orgsettings']['cachettl'])
+    orgAdminsCache = TTLCache(config['orgsettings']['cachesize'],
+                              config['orgsettings']['adminsttl'])
+    userCache = TTLCache(config['usercache']['size'],
+                         config['usercache']['ttl'])
+    ancestryCache = TTLCache(config['usercache']['ancestrysize'],
+                             config['usercache']['ancestryttl'])
 
     @DB.sessionQuery(keyspace)
     def createDefaultOrg(orgName, adminUser, adminEmail, session=None):
@@ -44,11 +69,9 @@ class AuthDB(DB):
         if len(defaultOrg) == 0:
             # DefaultOrg isn't set in database
 
-            log.info('No DefaultOrg defined, defining as "%s"' %
-                     (orgName,))
+            log.info('No DefaultOrg defined, defining as "%s"', orgName)
 
-            AuthDB.setGlobalSetting('defaultorg', orgName,
-                                    consistency=ConsistencyLevel.QUORUM)
+            AuthDB.setGlobalSetting('defaultorg', orgName)
 
             defaultOrg = AuthDB.getGlobalSetting('defaultorg').current_rows
 
@@ -57,8 +80,8 @@ class AuthDB(DB):
 
         if len(org) == 0:
             # Listed DefaultOrg doesn't exist
-            log.info('DefaultOrg "%s" does not extist! ' %
-                     (defaultOrg[0].value,) + 'It will be created')
+            log.info('DefaultOrg "%s" does not extist! ' +
+                     'It will be created', defaultOrg[0].value)
 
             AuthDB.createOrg(defaultOrg[0].value, None)
 
@@ -69,25 +92,18 @@ class AuthDB(DB):
 
         if len(orgAdmins) == 0:
             # Org does not have admins listed
-            log.info('DefaultOrg "%s" does not have an admin defined! ' %
-                     (org[0].org,) + 'A default account will be added and ' +
-                     'created if necessary.')
+            log.info('DefaultOrg "%s" does not have an admin defined! ' +
+                     'A default account will be added and ' +
+                     'created if necessary.', org[0].org)
 
             AuthDB.setOrgSetting(org[0].org, 'admins',
                                  '%s@%s' % (adminUser, org[0].org))
 
-            if not AuthDB.userExists(org[0].org, adminUser):
-                # User doesn't exist
-                log.info('Creating default admin account for "%s"' %
-                         (org[0].org,))
-
-                AuthDB.createUser(org[0].org, adminUser, adminEmail, None,
-                                  consistency=ConsistencyLevel.QUORUM)
+            if AuthDB.createUser(org[0].org, adminUser, adminEmail, None):
+                log.info('Created default admin account for "%s"', org[0].org)
 
     @DB.sessionQuery(keyspace)
-    def createOrg(org, parentorg,
-                  consistency=ConsistencyLevel.LOCAL_QUORUM,
-                  session=None):
+    def createOrg(org, parentorg, session=None):
         """
         Create an organization in the authdb.orgs table.
 
@@ -95,21 +111,17 @@ class AuthDB(DB):
             Name of the organization
         :parentorg:
             Parent organization for this organization
-        :consistency:
-            Cassandra consistency level. Defaults to LOCAL_QUORUM.
         """
         createOrgQuery = CassandraCluster.getPreparedStatement(
             """
             INSERT INTO orgs (org, parentorg)
             VALUES (?, ?)
             """, keyspace=session.keyspace)
-        createOrgQuery.consistency_level = consistency
-        session.execute(createOrgQuery, (org,))
+        session.execute(createOrgQuery, (org, parentorg))
+        OrgTree.add(org, parentorg)
 
     @DB.sessionQuery(keyspace)
-    def createPasswordReset(org, username,
-                            consistency=ConsistencyLevel.LOCAL_QUORUM,
-                            session=None):
+    def createPasswordReset(org, username, session=None):
         """
         Create a password reset in authdb.userpasswordresets table.
 
@@ -124,7 +136,6 @@ class AuthDB(DB):
                                              resetid )
             VALUES ( ?, ?, dateof(now()), ? )
             """, keyspace=session.keyspace)
-        createPasswordResetQuery.consistency_level = consistency
 
         resetid = uuid.uuid4()
 
@@ -133,16 +144,24 @@ class AuthDB(DB):
                             (org, username, resetid))
             return resetid
         except Exception as e:
-            log.error("Caught exception in AuthDB.createPasswordReset: %s"
-                      % (e,))
+            log.error("Caught exception in AuthDB.createPasswordReset: %s", e)
             return False
 
+    @TenantQuotas.scheduled('createUser')
     @DB.sessionQuery(keyspace)
-    def createUser(org, username, email, parentuser,
-                   consistency=ConsistencyLevel.LOCAL_QUORUM,
-                   session=None):
+    def createUser(org, username, email, parentuser, session=None):
         """
-        Create a user in the authdb.users table.
+        Create a user in the authdb.users table, unless it already exists.
+        The user is inserted with a lightweight transaction, so of concurrent
+        creations of the same user exactly one succeeds. Returns True if the
+        user was created and False if it already existed.
+
+        The transaction runs on authdb.usersbyname whenever it is written,
+        so creations don't contend on the org's wide authdb.users partition,
+        and the other tables get plain inserts. Until the backfill is done
+        (users.indexbackfilled), users created before the dual writes began
+        may only be in authdb.users, so that table is checked first with a
+        plain read.
 
         :org:
             Name of organization
@@ -152,24 +171,79 @@ class AuthDB(DB):
             Email address for the user
         :parentuser:
             Parent user for this user (in the form of user@org) or None
-        :consistency:
-            Cassandra ConsistencyLevel (default LOCAL_QUORUM)
         """
-        createUserQuery = CassandraCluster.getPreparedStatement(
+        tables = list(config['users']['writetables'])
+        for table in (config['users']['readtable'], 'usersbyname'):
+            if table in tables:
+                tables.remove(table)
+                tables.insert(0, table)
+
+        if (tables[0] != 'users' and 'users' in tables and
+                not config['users']['indexbackfilled']):
+            getLegacyUserQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT username FROM users
+                WHERE org = ?
+                AND username = ?
+                """, keyspace=session.keyspace)
+            if len(session.execute(getLegacyUserQuery,
+                                   (org, username)).current_rows) > 0:
+                return False
+
+        createUserIfNotExistsQuery = CassandraCluster.getPreparedStatement(
             """
-            INSERT INTO users ( org, username, email, parentuser, createdate )
+            INSERT INTO %s ( org, username, email, parentuser, createdate )
             VALUES ( ?, ?, ?, ?, dateof(now()) )
+            IF NOT EXISTS
+            """ % (tables[0],), keyspace=session.keyspace)
+        if not session.execute(createUserIfNotExistsQuery,
+                               (org, username, email,
+                                parentuser)).was_applied:
+            return False
+
+        for table in tables[1:]:
+            createUserQuery = CassandraCluster.getPreparedStatement(
+                """
+                INSERT INTO %s ( org, username, email, parentuser,
+                    createdate )
+                VALUES ( ?, ?, ?, ?, dateof(now()) )
+                """ % (table,), keyspace=session.keyspace)
+            session.execute(createUserQuery,
+                            (org, username, email, parentuser))
+
+        AuthDB.indexUser(org, username)
+        AuthDB.userCache.invalidate((org, username))
+        if parentuser is not None:
+            parentusername, parentuserorg = parentuser.split('@', 1)
+            AuthDB.indexUserChild(parentuserorg, parentusername, org,
+                                  username)
+            ancestors = ((parentuser,) +
+                         AuthDB.getUserAncestors(parentuserorg,
+                                                 parentusername))
+        else:
+            ancestors = ()
+        AuthDB.setUserAncestry(org, username, ancestors)
+
+        # Log the creation so user filters on other workers pick it up
+        logUserCreationQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO usercreations ( org, bucket, username )
+            VALUES ( ?, ?, ? )
             """, keyspace=session.keyspace)
-        createUserQuery.consistency_level = consistency
-        return session.execute(createUserQuery,
-                               (org, username, email, parentuser))
+        session.execute(logUserCreationQuery,
+                        (org, UserFilter.creationBucket(), username))
+        UserFilter.add(org, username)
+        OrgCounters.add(org, 'users')
+        return True
 
     @DB.sessionQuery(keyspace)
-    def createUserSession(org, username,
-                          consistency=ConsistencyLevel.LOCAL_QUORUM,
-                          session=None):
+    def createUserSession(org, username, session=None):
         """
-        Create a session record in the usersessions table for the given user
+        Create a session record in the usersessions table for the given user.
+        If the user already has the maximum number of sessions for their org
+        (see getMaxSessionsPerUser()), the oldest sessions and their keys are
+        evicted in the same batch as the new session is created. The ages of
+        the user's sessions are only read when the user is at the maximum.
 
         :org:
             Name of organization for the user
@@ -184,20 +258,80 @@ class AuthDB(DB):
                     lastupdate )
                 VALUES ( ?, ?, ?, dateof(now()), dateof(now()) )
                 """, keyspace=session.keyspace)
-            createUserSessionQuery.consistency_level = consistency
-            session.execute(createUserSessionQuery,
-                            (org, username, sessionId))
+            deleteUserSessionQuery = CassandraCluster.getPreparedStatement(
+                """
+                DELETE FROM usersessions
+                WHERE org = ?
+                AND username = ?
+                AND sessionid = ?
+                """, keyspace=session.keyspace)
+            deleteUserSessionKeyQuery = CassandraCluster.getPreparedStatement(
+                """
+                DELETE FROM usersessionkeys
+                WHERE sessionkey = ?
+                """, keyspace=session.keyspace)
+            countUserSessionsQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT sessionid FROM usersessions
+                WHERE org = ?
+                AND username = ?
+                LIMIT ?
+                """, keyspace=session.keyspace)
+            getUserSessionAgesQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT sessionid, startdate, sessionkey FROM usersessions
+                WHERE org = ?
+                AND username = ?
+                """, keyspace=session.keyspace)
+
+            maxSessions = AuthDB.getMaxSessionsPerUser(org)
+            evicted = []
+            # Session ids are random, so finding the oldest sessions takes a
+            #   read of them all; most users are below the maximum and only
+            #   need their session ids counted up to it
+            sessionIds = list(session.execute(countUserSessionsQuery,
+                                              (org, username, maxSessions)))
+            if len(sessionIds) >= maxSessions:
+                existing = list(session.execute(getUserSessionAgesQuery,
+                                                (org, username)))
+                # Oldest first. Sessions without a start date are partial
+                #   rows and go first.
+                existing.sort(key=lambda s: (s.startdate is not None,
+                                             s.startdate))
+                evicted = existing[:len(existing) - maxSessions + 1]
+
+            batchSize = config['sessions']['evictionbatchsize']
+            batch = BatchStatement()
+            batch.add(createUserSessionQuery, (org, username, sessionId))
+            for i, oldSession in enumerate(evicted):
+                if i > 0 and i % batchSize == 0:
+                    session.execute(batch)
+                    batch = BatchStatement()
+                batch.add(deleteUserSessionQuery,
+                          (org, username, oldSession.sessionid))
+                if oldSession.sessionkey is not None:
+                    batch.add(deleteUserSessionKeyQuery,
+                              (oldSession.sessionkey,))
+                    SessionCache.delete(oldSession.sessionkey)
+            session.execute(batch)
+            OrgCounters.add(org, 'storedsessions', 1 - len(evicted))
+
+            if len(evicted) > 0:
+                Metrics.inc('session_evictions_total', len(evicted))
+                log.info('Evicted %d sessions for %s@%s', len(evicted),
+                         username, org)
             return sessionId
         except Exception as e:
-            log.critical("Exception in AuthDB.createUserSession: %s" % (e,))
+            log.critical("Exception in AuthDB.createUserSession: %s", e)
 
     @DB.sessionQuery(keyspace)
-    def createUserSessionKey(org, username, sessionId,
-                             consistency=ConsistencyLevel.LOCAL_QUORUM,
-                             session=None):
+    def createUserSessionKey(org, username, sessionId, session=None):
         """
         Create a session key record in the usersessionkeys table for the given
-        user session
+        user session, and record the key on the session so it can be removed
+        along with the session. The key record is inserted with a
+        lightweight transaction, so a key that collides with an existing one
+        is detected and replaced by a new key without a separate read.
 
         :org:
             Name of organization for the user
@@ -210,29 +344,56 @@ class AuthDB(DB):
                     list(range(65, 91)) +  # Uppercase
                     list(range(97, 123)))  # Lowercase
         sysrand = SystemRandom()
-        sessionKey = ''.join(
-            chr(sysrand.choice(charList))
-            for i in range(64))
         try:
             createUserSessionKeyQuery = CassandraCluster.getPreparedStatement(
                 """
                 INSERT INTO usersessionkeys ( sessionkey, org, username,
                     sessionid )
                 VALUES ( ?, ?, ?, ? )
+                IF NOT EXISTS
                 """, keyspace=session.keyspace)
-            createUserSessionKeyQuery.consistency_level = consistency
-            session.execute(createUserSessionKeyQuery,
+            setUserSessionKeyQuery = CassandraCluster.getPreparedStatement(
+                """
+                UPDATE usersessions SET
+                sessionkey = ?
+                WHERE org = ?
+                AND username = ?
+                AND sessionid = ?
+                """, keyspace=session.keyspace)
+
+            for attempt in range(SESSION_KEY_ATTEMPTS):
+                sessionKey = ''.join(
+                    chr(sysrand.choice(charList))
+                    for i in range(64))
+                if session.execute(createUserSessionKeyQuery,
+                                   (sessionKey, org, username,
+                                    sessionId)).was_applied:
+                    break
+                log.warning('Session key collision for %s@%s', username, org)
+            else:
+                raise Exception('No unused session key after %d attempts' %
+                                (SESSION_KEY_ATTEMPTS,))
+
+            # A conditional insert cannot share a batch with a write to
+            #   another partition, so the key is recorded on the session
+            #   once it is known to be unique
+            session.execute(setUserSessionKeyQuery,
                             (sessionKey, org, username, sessionId))
+
+            now = datetime.utcnow()
+            SessionCache.put(sessionKey, CachedSession(sessionId, username,
+                                                       org, now, now))
             return sessionKey
         except Exception as e:
-            log.critical("Exception in AuthDB.createUserSessionKey: %s" % (e,))
+            log.critical("Exception in AuthDB.createUserSessionKey: %s", e)
 
     @DB.sessionQuery(keyspace)
-    def deleteUserSession(org, username, sessionId,
-                          consistency=ConsistencyLevel.LOCAL_QUORUM,
-                          session=None):
+    def deleteUserSession(org, username, sessionId, session=None):
         """
-        Delete/remove a session record from AuthDB.usersessions.
+        Delete/remove a session record from AuthDB.usersessions, along with
+        its session key if one is recorded on the session. The record is
+        deleted with a lightweight transaction, so when the same session is
+        deleted twice at once only the delete that removed it is counted.
 
         :org:
             Organization the user belongs to
@@ -240,31 +401,39 @@ class AuthDB(DB):
             Name of the user
         :sessionId:
             UUID of the session
-        :consistency:
-
         """
+        userSession = AuthDB.getUserSession(org, username, sessionId)
         deleteUserSessionQuery = CassandraCluster.getPreparedStatement(
             """
             DELETE FROM usersessions
             WHERE org = ?
             AND username = ?
             AND sessionid = ?
+            IF EXISTS
+            """, keyspace=session.keyspace)
+        deleteUserSessionKeyQuery = CassandraCluster.getPreparedStatement(
+            """
+            DELETE FROM usersessionkeys
+            WHERE sessionkey = ?
             """, keyspace=session.keyspace)
-        deleteUserSessionQuery.consistency_level = consistency
-        session.execute(deleteUserSessionQuery, (org, username, sessionId))
+        # A conditional delete cannot share a batch with a write to another
+        #   partition, so the key is deleted first
+        if userSession is not None and userSession.sessionkey is not None:
+            session.execute(deleteUserSessionKeyQuery,
+                            (userSession.sessionkey,))
+            SessionCache.delete(userSession.sessionkey)
+        if session.execute(deleteUserSessionQuery,
+                           (org, username, sessionId)).was_applied:
+            OrgCounters.add(org, 'storedsessions', -1)
 
     @DB.sessionQuery(keyspace)
-    def deleteUserSessionByKey(sessionKey,
-                               consistency=ConsistencyLevel.LOCAL_QUORUM,
-                               session=None):
+    def deleteUserSessionByKey(sessionKey, session=None):
         """
         Delete/remove a session key from AuthDB.usersessionkeys and remove the
         associated session record from AuthDB.usersessions.
 
         :sessionKey:
             Key of the session to delete
-        :consistency:
-            Cassandra ConsistencyLevel (default LOCAL_QUORUM)
         """
         userSession = AuthDB.getUserSessionByKey(sessionKey)
         deleteUserSessionByKeyQuery = CassandraCluster.getPreparedStatement(
@@ -272,17 +441,14 @@ class AuthDB(DB):
             DELETE FROM usersessionkeys
             WHERE sessionkey = ?
             """, keyspace=session.keyspace)
-        deleteUserSessionByKeyQuery.consistency_level = consistency
+        SessionCache.delete(sessionKey)
         if userSession is not None:
             AuthDB.deleteUserSession(userSession.org, userSession.username,
-                                     userSession.sessionid,
-                                     consistency=consistency)
+                                     userSession.sessionid)
         session.execute(deleteUserSessionByKeyQuery, (sessionKey,))
 
     @DB.sessionQuery(keyspace)
-    def deletePasswordReset(org, username,
-                            consistency=ConsistencyLevel.LOCAL_QUORUM,
-                            session=None):
+    def deletePasswordReset(org, username, session=None):
         """
         Delete/remove a password reset request for a user
 
@@ -290,8 +456,6 @@ class AuthDB(DB):
             Name of organization the user belongs to
         :username:
             Name of user
-        :consistency:
-            Cassandra ConsistencyLevel (default LOCAL_QUORUM)
         """
         deletePasswordResetQuery = CassandraCluster.getPreparedStatement(
             """
@@ -299,7 +463,6 @@ class AuthDB(DB):
             WHERE org = ?
             AND username = ?
             """, keyspace=session.keyspace)
-        deletePasswordResetQuery.consistency_level = consistency
         session.execute(deletePasswordResetQuery,
                         (org, username))
 
@@ -335,6 +498,27 @@ class AuthDB(DB):
             """, keyspace=session.keyspace)
         return session.execute(getOrgQuery, (org,))
 
+    @DB.sessionQuery(keyspace)
+    def getOrgCounters(org, session=None):
+        """
+        Get the counters of an organization from the authdb.orgcounters
+        table, as a dict of counter name to value. Counters never updated
+        are 0.
+
+        :org:
+            Name of organization
+        """
+        getOrgCountersQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT counter, value FROM orgcounters
+            WHERE org = ?
+            """, keyspace=session.keyspace)
+        counters = {counter: 0 for counter in COUNTERS}
+        for row in session.execute(getOrgCountersQuery, (org,)):
+            if row.counter in counters:
+                counters[row.counter] = row.value
+        return counters
+
     @DB.sessionQuery(keyspace)
     def getOrgSetting(org, setting, session=None):
         """
@@ -354,6 +538,306 @@ class AuthDB(DB):
             """, keyspace=session.keyspace)
         return session.execute(checkOrgSetting, (org, setting))
 
+    def getCachedOrgSetting(org, setting, inherit=False):
+        """
+        Get the value of an organization setting, or None if it is not set.
+        Values are cached for orgsettings.cachettl seconds.
+
+        :org:
+            Name of organization
+        :setting:
+            Setting/property name
+        :inherit:
+            If the org does not set it, use the value of the nearest ancestor
+            org that does
+        """
+        orgs = AuthDB.getOrgAncestors(org) if inherit else (org,)
+        missing = object()
+        for ancestor in orgs:
+            value = AuthDB.orgSettingsCache.get((ancestor, setting), missing)
+            if value is missing:
+                rows = AuthDB.getOrgSetting(ancestor, setting).current_rows
+                value = rows[0].value if len(rows) > 0 else None
+                AuthDB.orgSettingsCache.set((ancestor, setting), value)
+            if value is not None:
+                return value
+        return None
+
+    def getCachedOrgAdmins(org):
+        """
+        Frozenset of the users (user@org) listed in the 'admins' setting of
+        an organization. Cached for orgsettings.adminsttl seconds, which is
+        kept short so revoked admin rights do not linger.
+
+        :org:
+            Name of organization
+        """
+        admins = AuthDB.orgAdminsCache.get(org)
+        if admins is None:
+            rows = AuthDB.getOrgSetting(org, 'admins').current_rows
+            value = rows[0].value if len(rows) > 0 else None
+            admins = frozenset(admin.strip()
+                               for admin in (value or '').split(',')
+                               if admin.strip())
+            AuthDB.orgAdminsCache.set(org, admins)
+        return admins
+
+    def orgExists(org):
+        """
+        Check if an organization exists, from the in-memory org tree or,
+        for orgs not in it yet, from authdb.orgs. Orgs found in authdb.orgs
+        are added to the tree.
+
+        :org:
+            Name of organization
+        """
+        if OrgTree.contains(org, AuthDB.scanOrgs):
+            return True
+        rows = AuthDB.getOrg(org).current_rows
+        if len(rows) == 0:
+            return False
+        OrgTree.add(org, rows[0].parentorg)
+        return True
+
+    def getOrgAncestors(org):
+        """
+        Tuple of an organization and its ancestors, nearest first, from the
+        in-memory org tree
+
+        :org:
+            Name of organization
+        """
+        return OrgTree.ancestors(org, AuthDB.scanOrgs)
+
+    def getMaxSessionsPerUser(org):
+        """
+        Maximum number of sessions a user of the organization may hold. Uses
+        the 'maxSessionsPerUser' setting of the org or its nearest ancestor
+        that sets it, otherwise sessions.maxperuser.
+
+        :org:
+            Name of organization
+        """
+        value = AuthDB.getCachedOrgSetting(org, 'maxSessionsPerUser',
+                                           inherit=True)
+        if value is not None:
+            try:
+                return max(int(value), 1)
+            except ValueError:
+                log.error('Invalid maxSessionsPerUser "%s" for "%s"', value,
+                          org)
+        return config['sessions']['maxperuser']
+
+    @DB.sessionQuery(keyspace)
+    def getOrgUsernames(org, pageSize=None, session=None):
+        """
+        Generator over the usernames in an organization, read in pages of
+        pageSize rows from the authdb.orgusers index once it has been
+        backfilled, or from the org's authdb.users partition before then.
+
+        :org:
+            Name of organization
+        :pageSize:
+            Rows fetched per page. Defaults to userfilter.scanpagesize.
+        """
+        if pageSize is None:
+            pageSize = config['userfilter']['scanpagesize']
+
+        if not config['users']['indexbackfilled']:
+            # The orgusers index may be incomplete, scan the org partition
+            getOrgUsernamesQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT username FROM users
+                WHERE org = ?
+                """, keyspace=session.keyspace)
+            boundQuery = getOrgUsernamesQuery.bind((org,))
+            boundQuery.fetch_size = pageSize
+            for row in session.execute(boundQuery):
+                yield row.username
+            return
+
+        getOrgUsernamesQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT username FROM orgusers
+            WHERE org = ?
+            AND bucket = ?
+            """, keyspace=session.keyspace)
+        for bucket in range(config['users']['indexbuckets']):
+            boundQuery = getOrgUsernamesQuery.bind((org, bucket))
+            boundQuery.fetch_size = pageSize
+            for row in session.execute(boundQuery):
+                yield row.username
+
+    @TenantQuotas.scheduled('getOrgUsersPage')
+    @DB.sessionQuery(keyspace)
+    def getOrgUsersPage(org, limit, bucket=0, after=None, prefix=None,
+                        maxBuckets=None, session=None):
+        """
+        Retrieve one page of an organization's usernames from the bucketed
+        authdb.orgusers index. Buckets are read in order starting at bucket,
+        so each page costs at most limit rows and maxBuckets queries. Until
+        the index has been backfilled, pages are read from the org's
+        authdb.users partition instead, in a single query.
+
+        Returns a tuple of (usernames, nextBucket, nextAfter). nextBucket is
+        None once every bucket has been read.
+
+        :org:
+            Name of organization
+        :limit:
+            Maximum number of usernames to return
+        :bucket:
+            First bucket to read
+        :after:
+            Only return usernames after this one in the first bucket
+        :prefix:
+            Only return usernames starting with this prefix
+        :maxBuckets:
+            Maximum number of buckets to read for this page
+        """
+        if not config['users']['indexbackfilled']:
+            # The orgusers index may be incomplete, page through the org
+            # partition, which is ordered by username
+            return AuthDB.getOrgUsersPartitionPage(
+                org, limit, after=after, prefix=prefix, session=session)
+
+        numBuckets = config['users']['indexbuckets']
+        if maxBuckets is None:
+            maxBuckets = numBuckets
+
+        usernames = []
+        lastBucket = min(bucket + maxBuckets, numBuckets)
+        while bucket < lastBucket:
+            conditions = ['org = ?', 'bucket = ?']
+            params = [org, bucket]
+            if after is not None:
+                conditions.append('username > ?')
+                params.append(after)
+            elif prefix:
+                conditions.append('username >= ?')
+                params.append(prefix)
+            if prefix:
+                conditions.append('username < ?')
+                params.append(prefix + '\U0010ffff')
+            params.append(limit - len(usernames))
+
+            getOrgUsersPageQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT username FROM orgusers
+                WHERE %s
+                LIMIT ?
+                """ % ('\n                AND '.join(conditions),),
+                keyspace=session.keyspace)
+            rows = session.execute(getOrgUsersPageQuery, params).current_rows
+            usernames.extend(row.username for row in rows)
+
+            if len(usernames) >= limit:
+                # Page is full, resume after the last username in this bucket
+                return (usernames, bucket, usernames[-1])
+
+            bucket += 1
+            after = None
+
+        return (usernames, bucket if bucket < numBuckets else None, None)
+
+    def getOrgUsersPartitionPage(org, limit, after=None, prefix=None,
+                                 session=None):
+        """
+        Retrieve one page of an organization's usernames from its
+        authdb.users partition. Returns a tuple of (usernames, nextBucket,
+        nextAfter) like getOrgUsersPage(), always in bucket 0.
+
+        :org:
+            Name of organization
+        :limit:
+            Maximum number of usernames to return
+        :after:
+            Only return usernames after this one
+        :prefix:
+            Only return usernames starting with this prefix
+        :session:
+            Session of the calling query
+        """
+        conditions = ['org = ?']
+        params = [org]
+        if after is not None:
+            conditions.append('username > ?')
+            params.append(after)
+        elif prefix:
+            conditions.append('username >= ?')
+            params.append(prefix)
+        if prefix:
+            conditions.append('username < ?')
+            params.append(prefix + '\U0010ffff')
+        params.append(limit)
+
+        getOrgUsersPartitionPageQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT username FROM users
+            WHERE %s
+            LIMIT ?
+            """ % ('\n            AND '.join(conditions),),
+            keyspace=session.keyspace)
+        rows = session.execute(getOrgUsersPartitionPageQuery,
+                               params).current_rows
+        usernames = [row.username for row in rows]
+
+        if len(usernames) >= limit:
+            return (usernames, 0, usernames[-1])
+        return (usernames, None, None)
+
+    @TenantQuotas.scheduled('getOrgAuthEvents')
+    @DB.sessionQuery(keyspace)
+    def getOrgAuthEvents(org, start, end, limit, session=None):
+        """
+        Retrieve an organization's auth events between two times, newest
+        first, from the hourly partitions of authdb.orgauthevents. Hours are
+        read newest first, eventlog.orghourwindow hours at a time with every
+        bucket of those hours read concurrently, and reading stops as soon
+        as limit events have been found.
+
+        :org:
+            Name of organization
+        :start:
+            Earliest event time, in seconds since the epoch
+        :end:
+            Latest event time, in seconds since the epoch
+        :limit:
+            Maximum number of events to return
+        """
+        getOrgAuthEventsQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT eventtime, username, event, sessionid, source, detail
+            FROM orgauthevents
+            WHERE org = ?
+            AND hour = ?
+            AND bucket = ?
+            AND eventtime >= minTimeuuid(?)
+            AND eventtime <= maxTimeuuid(?)
+            LIMIT ?
+            """, keyspace=session.keyspace)
+        startTime = datetime.utcfromtimestamp(start)
+        endTime = datetime.utcfromtimestamp(end)
+        hours = list(range(int(end // 3600), int(start // 3600) - 1, -1))
+        window = max(config['eventlog']['orghourwindow'], 1)
+        events = []
+        for first in range(0, len(hours), window):
+            remaining = limit - len(events)
+            futures = [session.execute_async(
+                getOrgAuthEventsQuery,
+                (org, hour, bucket, startTime, endTime, remaining))
+                for hour in hours[first:first + window]
+                for bucket in range(config['eventlog']['orgbuckets'])]
+            windowEvents = []
+            for future in futures:
+                windowEvents.extend(future.result())
+            windowEvents.sort(key=lambda row: (row.eventtime.time,
+                                               row.username), reverse=True)
+            events.extend(windowEvents[:remaining])
+            if len(events) >= limit:
+                break
+        return events
+
     @DB.sessionQuery(keyspace)
     def getPasswordReset(org, username, session=None):
         """
@@ -376,7 +860,9 @@ class AuthDB(DB):
     @DB.sessionQuery(keyspace)
     def getUser(org, username, session=None):
         """
-        Retrieve a user from the authdb.users table
+        Retrieve a user from the authdb.users table. Rows include the write
+        times (in microseconds) of the createdate and parentuser columns as
+        createdatetime and parentusertime.
 
         :org:
             Name of organization the user belongs to
@@ -385,12 +871,238 @@ class AuthDB(DB):
         """
         getUserQuery = CassandraCluster.getPreparedStatement(
             """
-            SELECT username, org, parentuser, createdate FROM users
+            SELECT username, org, parentuser, createdate,
+                writetime(createdate) AS createdatetime,
+                writetime(parentuser) AS parentusertime
+            FROM %s
             WHERE org = ?
             AND username = ?
-            """, keyspace=session.keyspace)
+            """ % (config['users']['readtable'],), keyspace=session.keyspace)
         return session.execute(getUserQuery, (org, username))
 
+    def getCachedUser(org, username):
+        """
+        Retrieve a user's rows from getUser(), cached for usercache.ttl
+        seconds. Cached entries are invalidated by createUser() and
+        setPassword() on this worker.
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        """
+        rows = AuthDB.userCache.get((org, username))
+        if rows is None:
+            rows = AuthDB.getUser(org, username).current_rows
+            if len(rows) > 0:
+                AuthDB.userCache.set((org, username), rows)
+        return rows
+
+    def getUserAncestors(org, username):
+        """
+        Tuple of a user's ancestors (parent first) in the form user@org.
+        Chains are recorded in authdb.userancestors when users are created,
+        so resolving one takes one read, and are cached per worker for
+        usercache.ancestryttl seconds. A user's parent never changes, so
+        cached chains do not go stale.
+
+        Chains of users created before authdb.userancestors existed, and not
+        yet recorded by tools.backfillusers, are resolved by walking up their
+        parents (one read per level, stopping at the first recorded ancestor,
+        a cycle or usercache.ancestrymaxdepth levels) and then recorded.
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        """
+        ancestors = AuthDB.ancestryCache.get((org, username))
+        if ancestors is not None:
+            return ancestors
+
+        rows = AuthDB.getUserAncestry(org, username)
+        if len(rows) > 0:
+            ancestors = tuple(rows[0].ancestors or ())
+        else:
+            ancestors = AuthDB.walkUserAncestors(org, username)
+            if ancestors is None:
+                # Not cached, the user may yet be created
+                return ()
+            AuthDB.setUserAncestry(org, username, ancestors)
+        AuthDB.ancestryCache.set((org, username), ancestors)
+        return ancestors
+
+    def walkUserAncestors(org, username):
+        """
+        Resolve a user's ancestors (parent first) by following parentuser
+        links, or None if the user does not exist. The walk stops at the
+        first ancestor whose chain is already known, and is cut short with a
+        warning on a cycle or after usercache.ancestrymaxdepth levels.
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        """
+        maxDepth = config['usercache']['ancestrymaxdepth']
+        user = '%s@%s' % (username, org)
+        ancestors = []
+        seen = {user}
+        while True:
+            if len(ancestors) > 0:
+                known = AuthDB.ancestryCache.get((org, username))
+                if known is None:
+                    rows = AuthDB.getUserAncestry(org, username)
+                    if len(rows) > 0:
+                        known = tuple(rows[0].ancestors or ())
+                if known is not None:
+                    ancestors.extend(a for a in known if a not in seen)
+                    break
+
+            users = AuthDB.getCachedUser(org, username)
+            if len(users) == 0:
+                if len(ancestors) == 0:
+                    return None
+                break
+            parentuser = users[0].parentuser
+            if parentuser is None or '@' not in parentuser:
+                break
+            if parentuser in seen:
+                log.warning('Cycle in the parent users of "%s" at "%s"',
+                            user, parentuser)
+                break
+            if len(ancestors) >= maxDepth:
+                log.warning('Parent users of "%s" exceed %d levels',
+                            user, maxDepth)
+                break
+            seen.add(parentuser)
+            ancestors.append(parentuser)
+            username, org = parentuser.split('@', 1)
+        return tuple(ancestors)
+
+    @DB.sessionQuery(keyspace)
+    def getUserAncestry(org, username, session=None):
+        """
+        Retrieve a user's row from the authdb.userancestors table
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        """
+        getUserAncestryQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT ancestors FROM userancestors
+            WHERE org = ?
+            AND username = ?
+            """, keyspace=session.keyspace)
+        return session.execute(getUserAncestryQuery,
+                               (org, username)).current_rows
+
+    @DB.sessionQuery(keyspace)
+    def getUserAuthEvents(org, username, start, end, limit, session=None):
+        """
+        Retrieve a user's auth events between two times, newest first, from
+        the daily partitions of authdb.userauthevents
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        :start:
+            Earliest event time, in seconds since the epoch
+        :end:
+            Latest event time, in seconds since the epoch
+        :limit:
+            Maximum number of events to return
+        """
+        getUserAuthEventsQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT eventtime, event, sessionid, source, detail
+            FROM userauthevents
+            WHERE org = ?
+            AND username = ?
+            AND day = ?
+            AND eventtime >= minTimeuuid(?)
+            AND eventtime <= maxTimeuuid(?)
+            LIMIT ?
+            """, keyspace=session.keyspace)
+        startTime = datetime.utcfromtimestamp(start)
+        endTime = datetime.utcfromtimestamp(end)
+        events = []
+        for day in range(int(end // 86400), int(start // 86400) - 1, -1):
+            events.extend(session.execute(
+                getUserAuthEventsQuery,
+                (org, username, day, startTime, endTime,
+                 limit - len(events))))
+            if len(events) >= limit:
+                break
+        return events
+
+    @TenantQuotas.scheduled('getUserChildrenPage')
+    @DB.sessionQuery(keyspace)
+    def getUserChildrenPage(org, username, limit, after=None, session=None):
+        """
+        Retrieve one page of a user's child users from the authdb.userchildren
+        index, ordered by org then username. Returns a list of user@org
+        strings and the (org, username) to continue after, or None if this
+        is the last page.
+
+        :org:
+            Name of organization the parent user belongs to
+        :username:
+            Name of the parent user
+        :limit:
+            Maximum number of children to return
+        :after:
+            (org, username) of the last child of the previous page, or None
+        """
+        if after is None:
+            getUserChildrenQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT org, username FROM userchildren
+                WHERE parentorg = ?
+                AND parentusername = ?
+                LIMIT ?
+                """, keyspace=session.keyspace)
+            params = (org, username, limit + 1)
+        else:
+            getUserChildrenQuery = CassandraCluster.getPreparedStatement(
+                """
+                SELECT org, username FROM userchildren
+                WHERE parentorg = ?
+                AND parentusername = ?
+                AND (org, username) > (?, ?)
+                LIMIT ?
+                """, keyspace=session.keyspace)
+            params = (org, username, after[0], after[1], limit + 1)
+
+        rows = session.execute(getUserChildrenQuery, params).current_rows
+        children = ['%s@%s' % (row.username, row.org) for row in rows[:limit]]
+        if len(rows) > limit:
+            return children, (rows[limit - 1].org, rows[limit - 1].username)
+        return children, None
+
+    @DB.sessionQuery(keyspace)
+    def getUserCreations(org, bucket, session=None):
+        """
+        Retrieve the usernames created in an organization during a minute
+        bucket from the authdb.usercreations log
+
+        :org:
+            Name of organization
+        :bucket:
+            Minute bucket (see UserFilter.creationBucket())
+        """
+        getUserCreationsQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT username FROM usercreations
+            WHERE org = ?
+            AND bucket = ?
+            """, keyspace=session.keyspace)
+        return [row.username for row in
+                session.execute(getUserCreationsQuery, (org, bucket))]
+
     @DB.sessionQuery(keyspace)
     def getUserHash(org, username, session=None):
         """
@@ -403,10 +1115,10 @@ class AuthDB(DB):
         """
         getUserHashQuery = CassandraCluster.getPreparedStatement(
             """
-            SELECT hash FROM users
+            SELECT hash FROM %s
             WHERE org = ?
             AND username = ?
-            """, keyspace=session.keyspace)
+            """ % (config['users']['readtable'],), keyspace=session.keyspace)
         res = session.execute(getUserHashQuery, (org, username)).current_rows
         if len(res) > 0:
             return res[0].hash
@@ -425,10 +1137,10 @@ class AuthDB(DB):
         """
         getUserSaltQuery = CassandraCluster.getPreparedStatement(
             """
-            SELECT salt FROM users
+            SELECT salt FROM %s
             WHERE org = ?
             AND username = ?
-            """, keyspace=session.keyspace)
+            """ % (config['users']['readtable'],), keyspace=session.keyspace)
         res = session.execute(getUserSaltQuery, (org, username)).current_rows
         if len(res) > 0:
             return res[0].salt
@@ -497,9 +1209,70 @@ class AuthDB(DB):
                                (org, username)).current_rows
 
     @DB.sessionQuery(keyspace)
-    def setGlobalSetting(setting, value,
-                         consistency=ConsistencyLevel.LOCAL_QUORUM,
-                         session=None):
+    def indexUser(org, username, session=None):
+        """
+        Add a user to the bucketed authdb.orgusers index used for org-wide
+        listings.
+
+        :org:
+            Name of organization
+        :username:
+            Name of user
+        """
+        indexUserQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO orgusers ( org, bucket, username )
+            VALUES ( ?, ?, ? )
+            """, keyspace=session.keyspace)
+        session.execute(indexUserQuery,
+                        (org, AuthDB.userIndexBucket(username), username))
+
+    @DB.sessionQuery(keyspace)
+    def indexUserChild(parentorg, parentusername, org, username,
+                       session=None):
+        """
+        Add a user to the authdb.userchildren index of its parent user
+
+        :parentorg:
+            Name of organization of the parent user
+        :parentusername:
+            Name of the parent user
+        :org:
+            Name of organization of the child user
+        :username:
+            Name of the child user
+        """
+        indexUserChildQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO userchildren ( parentorg, parentusername, org,
+                username )
+            VALUES ( ?, ?, ?, ? )
+            """, keyspace=session.keyspace)
+        session.execute(indexUserChildQuery,
+                        (parentorg, parentusername, org, username))
+
+    @DB.sessionQuery(keyspace)
+    def scanOrgs(pageSize=None, session=None):
+        """
+        Generator over the (org, parentorg) rows of every organization, read
+        in pages of pageSize rows
+
+        :pageSize:
+            Rows fetched per page. Defaults to orgtree.scanpagesize.
+        """
+        if pageSize is None:
+            pageSize = config['orgtree']['scanpagesize']
+        scanOrgsQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT org, parentorg FROM orgs
+            """, keyspace=session.keyspace)
+        boundQuery = scanOrgsQuery.bind(())
+        boundQuery.fetch_size = pageSize
+        for row in session.execute(boundQuery):
+            yield row
+
+    @DB.sessionQuery(keyspace)
+    def setGlobalSetting(setting, value, session=None):
         """
         Set a global setting/property in the authdb.globalsettings table
 
@@ -507,21 +1280,16 @@ class AuthDB(DB):
             Setting/property name
         :value:
             Value of the setting
-        :consistency:
-            Cassandra consistency level. Defaults to LOCAL_QUORUM.
         """
         setGlobalSettingQuery = CassandraCluster.getPreparedStatement(
             """
             INSERT INTO globalsettings (setting, value)
             VALUES (?, ?)
             """, keyspace=session.keyspace)
-        setGlobalSettingQuery.consistency_level = consistency
         session.execute(setGlobalSettingQuery, (setting, value))
 
     @DB.sessionQuery(keyspace)
-    def setOrgSetting(org, setting, value,
-                      consistency=ConsistencyLevel.LOCAL_QUORUM,
-                      session=None):
+    def setOrgSetting(org, setting, value, session=None):
         """
         Set an organization setting/property in the authdb.orgsettings table
 
@@ -531,22 +1299,41 @@ class AuthDB(DB):
             Setting/property name
         :value:
             Value of the setting
-        :consistency:
-            Cassandra consistency level. Defaults to LOCAL_QUORUM.
         """
         setOrgSettingQuery = CassandraCluster.getPreparedStatement(
             """
             INSERT INTO orgsettings (org, setting, value)
             VALUES (?, ?, ?)
             """, keyspace=session.keyspace)
-        setOrgSettingQuery.consistency_level = consistency
         session.execute(setOrgSettingQuery,
                         (org, setting, value))
+        AuthDB.orgSettingsCache.invalidate((org, setting))
+        if setting == 'admins':
+            AuthDB.orgAdminsCache.invalidate(org)
 
     @DB.sessionQuery(keyspace)
-    def setPassword(org, username, passwordHash, salt,
-                    consistency=ConsistencyLevel.LOCAL_QUORUM,
-                    session=None):
+    def setUserAncestry(org, username, ancestors, session=None):
+        """
+        Record a user's ancestors in the authdb.userancestors table
+
+        :org:
+            Name of organization the user belongs to
+        :username:
+            Name of the user
+        :ancestors:
+            Ancestors of the user in the form user@org, parent first
+        """
+        setUserAncestryQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO userancestors ( org, username, ancestors )
+            VALUES ( ?, ?, ? )
+            """, keyspace=session.keyspace)
+        session.execute(setUserAncestryQuery,
+                        (org, username, list(ancestors)))
+        AuthDB.ancestryCache.set((org, username), tuple(ancestors))
+
+    @DB.sessionQuery(keyspace)
+    def setPassword(org, username, passwordHash, salt, session=None):
         """
         Update/set user's password with given hash and salt
 
@@ -558,24 +1345,175 @@ class AuthDB(DB):
             The Argon2 hash of the salted password
         :salt:
             Salt used to generate the hash
-        :consistency:
-            Cassandra consistency level. Defaults to LOCAL_QUORUM.
         """
-        setPasswordQuery = CassandraCluster.getPreparedStatement(
+        for table in config['users']['writetables']:
+            setPasswordQuery = CassandraCluster.getPreparedStatement(
+                """
+                UPDATE %s SET
+                hash = ?,
+                salt = ?
+                WHERE org = ?
+                AND username = ?
+                """ % (table,), keyspace=session.keyspace)
+            session.execute(setPasswordQuery,
+                            (passwordHash, salt, org, username))
+        AuthDB.userCache.invalidate((org, username))
+
+    def isOrgAdmin(org, username, userorg):
+        """
+        Check if a user is listed in the 'admins' setting of an organization
+        or of any of its ancestors, as admins of an org administer its child
+        orgs too. The setting holds a comma separated list of users in the
+        form of user@org.
+
+        :org:
+            Name of the organization to check
+        :username:
+            Name of the user
+        :userorg:
+            Organization of the user
+        """
+        user = '%s@%s' % (username, userorg)
+        for ancestor in AuthDB.getOrgAncestors(org):
+            if user in AuthDB.getCachedOrgAdmins(ancestor):
+                return True
+        return False
+
+    def isUserAncestor(org, username, ancestorusername, ancestororg):
+        """
+        Check if a user is a parent, grandparent, etc. of another user
+
+        :org:
+            Name of organization of the user
+        :username:
+            Name of the user
+        :ancestorusername:
+            Name of the possible ancestor
+        :ancestororg:
+            Organization of the possible ancestor
+        """
+        return ('%s@%s' % (ancestorusername, ancestororg) in
+                AuthDB.getUserAncestors(org, username))
+
+    def isOrgUnder(org, ancestor):
+        """
+        Check if an organization is ancestor or one of its descendants
+
+        :org:
+            Name of the organization to check
+        :ancestor:
+            Name of the possible ancestor organization
+        """
+        return OrgTree.isUnder(org, ancestor, AuthDB.scanOrgs)
+
+    @DB.sessionQuery(keyspace)
+    def updateOrgCounters(org, changes, session=None):
+        """
+        Add to the counters of an organization in one counter batch. Used by
+        OrgCounters, which batches the changes made by AuthDB functions.
+
+        :org:
+            Name of organization
+        :changes:
+            Dict of counter name to the amount to add
+        """
+        updateOrgCounterQuery = CassandraCluster.getPreparedStatement(
             """
-            UPDATE users SET
-            hash = ?,
-            salt = ?
+            UPDATE orgcounters SET
+            value = value + ?
             WHERE org = ?
-            AND username = ?
+            AND counter = ?
             """, keyspace=session.keyspace)
-        setPasswordQuery.consistency_level = consistency
-        session.execute(setPasswordQuery, (passwordHash, salt, org, username))
+        batch = BatchStatement(batch_type=BatchType.COUNTER)
+        for counter, delta in changes.items():
+            batch.add(updateOrgCounterQuery, (delta, org, counter))
+        session.execute(batch)
+
+    @DB.sessionQuery(keyspace)
+    def writeAuthEvents(events, session=None):
+        """
+        Write auth events to the authdb.userauthevents and
+        authdb.orgauthevents tables. Org events are spread over
+        eventlog.orgbuckets partitions per hour by event id, so a flood of
+        events for one org doesn't land on a single partition. Events are
+        grouped into one unlogged batch per partition and the batches are
+        written concurrently. Raises the first error encountered.
+
+        :events:
+            List of event dicts, as built by EventLog.record()
+        """
+        userEventQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO userauthevents ( org, username, day, eventtime, event,
+                sessionid, source, detail )
+            VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )
+            """, keyspace=session.keyspace)
+        orgEventQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO orgauthevents ( org, hour, bucket, eventtime,
+                username, event, sessionid, source, detail )
+            VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )
+            """, keyspace=session.keyspace)
+
+        batches = {}
+
+        def addToBatch(partition, query, params):
+            if partition not in batches:
+                batches[partition] = BatchStatement(
+                    batch_type=BatchType.UNLOGGED)
+            batches[partition].add(query, params)
+
+        for event in events:
+            eventTime = uuid.UUID(event['eventid'])
+            sessionId = (uuid.UUID(event['sessionid'])
+                         if event['sessionid'] is not None else None)
+            day = int(event['time'] // 86400)
+            hour = int(event['time'] // 3600)
+            if event['knownuser']:
+                addToBatch(('user', event['org'], event['username'], day),
+                           userEventQuery,
+                           (event['org'], event['username'], day, eventTime,
+                            event['event'], sessionId, event['source'],
+                            event['detail']))
+            bucket = (zlib.crc32(event['eventid'].encode('utf-8')) %
+                      config['eventlog']['orgbuckets'])
+            addToBatch(('org', event['org'], hour, bucket), orgEventQuery,
+                       (event['org'], hour, bucket, eventTime,
+                        event['username'], event['event'], sessionId,
+                        event['source'], event['detail']))
+
+        futures = [session.execute_async(batch) for batch in batches.values()]
+        for future in futures:
+            future.result()
+
+    def migrationPlan():
+        """
+        Report what migrate.py would change in the authdb schema
+        """
+        return DB.migrationPlan(AuthDB.keyspace)
+
+    def schemaReady():
+        """
+        Check that the authdb schema is at the version this code expects
+        """
+        return DB.schemaReady(AuthDB.keyspace)
 
     def setupDB(replication_class='SimpleStrategy', replication_factor=1):
         DB.setupDB(AuthDB.keyspace, replication_class=replication_class,
                    replication_factor=replication_factor)
 
+    def userIndexBucket(username):
+        """
+        Bucket of the authdb.orgusers index a username is stored in. Stable
+        across processes, so the bucket count must not change once the index
+        has been written.
+
+        :username:
+            Name of the user
+        """
+        return (zlib.crc32(username.encode('utf-8')) %
+                config['users']['indexbuckets'])
+
     def userExists(org, username):
         """
         Check if a user exists in authdb.users table. Uses getUser() for user
@@ -588,6 +1526,27 @@ class AuthDB(DB):
         """
         return len(AuthDB.getUser(org, username).current_rows) > 0
 
+    def userMayExist(org, username):
+        """
+        Check if a user exists, answering from the org's user filter when the
+        user definitely does not exist and falling back to userExists()
+        otherwise. Must not be used to guard user creation, as filters on
+        other workers may briefly lag behind new users.
+
+        :org:
+            Name of organization for user
+        :username:
+            Name of the user
+        """
+        if (config['userfilter']['enabled'] and
+                not UserFilter.mightExist(org, username,
+                                          AuthDB.getOrgUsernames,
+                                          AuthDB.getUserCreations,
+                                          AuthDB.orgExists)):
+            return False
+        return AuthDB.userExists(org, username)
+
+    @TenantQuotas.scheduled('validatePassword')
     def validatePassword(org, username, password):
         """
         Compare the given password against the hashed version for the user
@@ -630,29 +1589,140 @@ class AuthDB(DB):
         else:
             return False
 
-    def validateSessionKey(sessionKey):
+    def sessionRecordCurrent(userSessionRecord):
+        """
+        Check that a session record has not expired: it must have been
+        updated in the last 2 days and started in the last 31 days.
+
+        :userSessionRecord:
+            Session record with startdate and lastupdate attributes
+        """
+        now = datetime.now()
+        return (userSessionRecord.lastupdate > now - timedelta(days=2) and
+                userSessionRecord.startdate > now - timedelta(days=31))
+
+    def validateSessionKey(sessionKey, checkCache=True):
         """
         Verify a session key and grab the user
 
         :sessionKey:
             Key to validate
+        :checkCache:
+            False to skip the session cache lookup, when the caller already
+            missed it. The record read is still cached.
         """
         valid = False
         username = None
         org = None
         try:
-            userSessionRecord = AuthDB.getUserSessionByKey(sessionKey)
-            if userSessionRecord is not None:
+            userSessionRecord = (SessionCache.get(sessionKey) if checkCache
+                                 else None)
+            if userSessionRecord is None and SessionCache.revoked(sessionKey):
+                return (valid, username, org)
+            if userSessionRecord is None:
+                userSessionRecord = AuthDB.getUserSessionByKey(sessionKey)
+                if userSessionRecord is not None:
+                    SessionCache.put(sessionKey, userSessionRecord)
+            if (userSessionRecord is not None and
+                    userSessionRecord.startdate is not None):
                 username = userSessionRecord.username
                 org = userSessionRecord.org
-                now = datetime.now()
-                if (userSessionRecord.lastupdate >
-                        now - timedelta(days=2) and
-                        userSessionRecord.startdate >
-                        now - timedelta(days=31)):
-                    valid = True
+                valid = AuthDB.sessionRecordCurrent(userSessionRecord)
         except ValueError as ve:
-            log.error('Error validating session: %s' % (ve,))
+            log.error('Error validating session: %s', ve)
+        except DatabaseUnavailable:
+            # Not knowing is not the same as the key being invalid
+            raise
         except Exception as e:
-            log.critical('Error in AuthDB.validateSession: %s' % (e,))
+            log.critical('Error in AuthDB.validateSession: %s', e)
         return (valid, username, org)
+
+    @DB.sessionQuery(keyspace)
+    def validateSessionKeys(sessionKeys, session=None):
+        """
+        Verify many session keys at once. Repeated keys are looked up once,
+        cached sessions are answered from the shared session cache and the
+        rest are looked up with concurrent queries. Returns a list of
+        (valid, username, org) tuples in the order of sessionKeys.
+
+        :sessionKeys:
+            List of keys to validate
+        """
+        getSessionKeyQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT sessionid, username, org FROM usersessionkeys
+            WHERE sessionkey = ?
+            """, keyspace=session.keyspace)
+        getUserSessionQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT * FROM usersessions
+            WHERE org = ?
+            AND username = ?
+            AND sessionid = ?
+            """, keyspace=session.keyspace)
+
+        records = {}
+        misses = []
+        for sessionKey in dict.fromkeys(sessionKeys):
+            records[sessionKey] = SessionCache.get(sessionKey)
+            if (records[sessionKey] is None and
+                    not SessionCache.revoked(sessionKey)):
+                misses.append(sessionKey)
+
+        def lookup(query, lookups):
+            """
+            Run query for every (sessionKey, params) with all of them in
+            flight at once and yield (sessionKey, rows). Lookups that find
+            nothing are read again with the fallback profile, if any.
+            """
+            futures = [(sessionKey, params,
+                        session.execute_async(query, params))
+                       for sessionKey, params in lookups]
+            retries = []
+            for sessionKey, params, future in futures:
+                rows = lookupRows(future)
+                if (rows is not None and len(rows) == 0 and
+                        session.mayFallBack()):
+                    retries.append((sessionKey,
+                                    session.fallbackAsync(query, params)))
+                elif rows is not None:
+                    yield sessionKey, rows
+            for sessionKey, future in retries:
+                rows = lookupRows(future)
+                if rows is not None:
+                    yield sessionKey, rows
+
+        def lookupRows(future):
+            try:
+                return future.result().current_rows
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as e:
+                log.error('Error validating session: %s', e)
+                return None
+
+        # Resolve keys to sessions, then sessions to records
+        sessionLookups = []
+        for sessionKey, rows in lookup(getSessionKeyQuery,
+                                       [(sessionKey, (sessionKey,))
+                                        for sessionKey in misses]):
+            if len(rows) == 1:
+                sessionLookups.append(
+                    (sessionKey,
+                     (rows[0].org, rows[0].username, rows[0].sessionid)))
+            elif len(rows) > 1:
+                log.error('Error validating session: Multiple sessions ' +
+                          'returned by key')
+        for sessionKey, rows in lookup(getUserSessionQuery, sessionLookups):
+            if len(rows) > 0:
+                records[sessionKey] = rows[0]
+                SessionCache.put(sessionKey, rows[0])
+
+        results = {}
+        for sessionKey, record in records.items():
+            if record is None or record.startdate is None:
+                results[sessionKey] = (False, None, None)
+            else:
+                results[sessionKey] = (AuthDB.sessionRecordCurrent(record),
+                                       record.username, record.org)
+        return [results[sessionKey] for sessionKey in sessionKeys]
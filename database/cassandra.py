@@ -5,14 +5,199 @@ Contains a class for Cluster/Session singletons and functions for
 initialization and upgrade of Cassandra keyspace schema.
 """
 
-from cassandra.cluster import Cluster
+import threading
+import time
+from cassandra import ConsistencyLevel
+from cassandra.cluster import EXEC_PROFILE_DEFAULT, Cluster, ExecutionProfile
+from cassandra.policies import (ConstantSpeculativeExecutionPolicy,
+                                NoSpeculativeExecutionPolicy, RetryPolicy)
+from database.faultinjection import FaultInjector, FaultyFuture
 from logging import getLogger
+from metrics import Metrics
 from settings import Settings
 
 log = getLogger('gunicorn.error')
 
 config = Settings.getConfig()
 
+Metrics.describe('cassandra_retries_total', 'counter',
+                 'Cassandra requests retried on another host')
+Metrics.describe('cassandra_speculative_executions_total', 'counter',
+                 'Speculative executions sent for slow idempotent requests')
+Metrics.describe('cassandra_fallback_reads_total', 'counter',
+                 'Reads that found nothing and were retried with the ' +
+                 'fallback profile of their execution profile')
+Metrics.describe('cassandra_fallback_reads_skipped_total', 'counter',
+                 'Reads that found nothing and were not retried because ' +
+                 'the fallback rate of their execution profile was spent')
+
+
+class IdempotentRetryPolicy(RetryPolicy):
+    """
+    Retry policy that retries idempotent statements on the next host up to
+    a fixed number of times, and never retries anything else. Retries are
+    counted in the cassandra_retries_total metric.
+    """
+
+    def __init__(self, retries, profile):
+        self.retries = retries
+        self.profile = profile
+
+    def retryNextHost(self, query, retry_num, reason):
+        if (query is not None and query.is_idempotent and
+                retry_num < self.retries):
+            Metrics.inc('cassandra_retries_total', profile=self.profile,
+                        reason=reason)
+            return self.RETRY_NEXT_HOST, None
+        return self.RETHROW, None
+
+    def on_read_timeout(self, query, consistency, required_responses,
+                        received_responses, data_retrieved, retry_num):
+        return self.retryNextHost(query, retry_num, 'readtimeout')
+
+    def on_write_timeout(self, query, consistency, write_type,
+                         required_responses, received_responses, retry_num):
+        return self.retryNextHost(query, retry_num, 'writetimeout')
+
+    def on_unavailable(self, query, consistency, required_replicas,
+                       alive_replicas, retry_num):
+        return self.retryNextHost(query, retry_num, 'unavailable')
+
+    def on_request_error(self, query, consistency, error, retry_num):
+        return self.retryNextHost(query, retry_num, 'requesterror')
+
+
+class CountingSpeculativeExecutionPolicy(ConstantSpeculativeExecutionPolicy):
+    """
+    Constant delay speculative execution that counts the executions sent in
+    the cassandra_speculative_executions_total metric
+    """
+
+    def __init__(self, delay, maxAttempts, profile):
+        super().__init__(delay, maxAttempts)
+        self.profile = profile
+
+    def new_plan(self, keyspace, statement):
+        return CountingSpeculativeExecutionPlan(
+            super().new_plan(keyspace, statement), self.profile)
+
+
+class CountingSpeculativeExecutionPlan:
+    def __init__(self, plan, profile):
+        self.plan = plan
+        self.profile = profile
+        self.calls = 0
+
+    def next_execution(self, host):
+        # The driver asks for the next delay when a request starts and again
+        #   after each speculative execution it sends
+        if self.calls > 0:
+            Metrics.inc('cassandra_speculative_executions_total',
+                        profile=self.profile)
+        self.calls += 1
+        return self.plan.next_execution(host)
+
+
+class ProfiledSession:
+    """
+    Session wrapper that runs statements with an execution profile unless
+    the caller names another one.
+
+    When the profile has an emptyfallback, an idempotent read that returns
+    no rows is read again with the fallback profile. A row written at
+    LOCAL_QUORUM may not have reached the one replica a LOCAL_ONE read asks
+    yet, so this keeps a client's own writes visible to it without paying
+    for quorum reads of rows that are found. Most lookups that find nothing
+    are for rows that were never written (e.g. invented session keys), so
+    a worker sends at most the profile's fallbackrate fallback reads a
+    second and lets the misses over it stand.
+
+    With faultinjection.enabled, statements are delayed or failed as the
+    fault injection rules say (see database/faultinjection.py).
+    """
+
+    def __init__(self, session, profile, operation=None):
+        self.session = session
+        self.profile = profile
+        self.operation = operation
+        self.fallback = CassandraCluster.fallbackFor(profile)
+
+    def execute(self, query, parameters=None, **kwargs):
+        kwargs.setdefault('execution_profile', self.profile)
+        self.injectFaults(query, kwargs['execution_profile'])
+        result = self.session.execute(query, parameters, **kwargs)
+        if (self.fallback is not None and
+                kwargs['execution_profile'] == self.profile and
+                getattr(query, 'is_idempotent', False) and
+                not result.current_rows and self.mayFallBack()):
+            Metrics.inc('cassandra_fallback_reads_total',
+                        profile=self.profile)
+            kwargs['execution_profile'] = self.fallback
+            self.injectFaults(query, self.fallback)
+            result = self.session.execute(query, parameters, **kwargs)
+        return result
+
+    def execute_async(self, query, parameters=None, **kwargs):
+        kwargs.setdefault('execution_profile', self.profile)
+        return self.injectFaultsAsync(
+            query, kwargs['execution_profile'],
+            lambda: self.session.execute_async(query, parameters, **kwargs))
+
+    def mayFallBack(self):
+        """
+        Check if a read that found nothing may be read again with the
+        fallback profile, taking one from the profile's fallback rate
+        """
+        if self.fallback is None:
+            return False
+        if CassandraCluster.takeFallback(self.profile):
+            return True
+        Metrics.inc('cassandra_fallback_reads_skipped_total',
+                    profile=self.profile)
+        return False
+
+    def fallbackAsync(self, query, parameters=None):
+        """
+        Start a read again with the fallback profile, for callers using
+        execute_async() that found no rows and were allowed to by
+        mayFallBack()
+        """
+        Metrics.inc('cassandra_fallback_reads_total', profile=self.profile)
+        return self.injectFaultsAsync(
+            query, self.fallback,
+            lambda: self.session.execute_async(
+                query, parameters, execution_profile=self.fallback))
+
+    def injectFaults(self, query, profile):
+        """
+        Delay or fail a statement before it is run, if a fault injection
+        rule matches it
+        """
+        if not config['faultinjection']['enabled']:
+            return
+        plan = FaultInjector.plan(query, profile, self.operation)
+        if plan is not None:
+            FaultInjector.apply(plan, profile, time.perf_counter())
+
+    def injectFaultsAsync(self, query, profile, start):
+        """
+        Start a statement with start(). If a fault injection rule matches
+        it, its future is delayed or failed when the result is read.
+        """
+        if not config['faultinjection']['enabled']:
+            return start()
+        plan = FaultInjector.plan(query, profile, self.operation)
+        if plan is None:
+            return start()
+        started = time.perf_counter()
+        if plan[1] is not None:
+            # Failed statements never reach the cluster
+            return FaultyFuture(None, plan, profile, started)
+        return FaultyFuture(start(), plan, profile, started)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
 
 class CassandraCluster:
     """
@@ -25,6 +210,11 @@ class CassandraCluster:
     cluster = None
     session = {}
     preparedStmts = {}
+    # Guards creating sessions and preparing statements
+    lock = threading.RLock()
+    # Profile to [tokens, last refill] of its fallback rate
+    fallbackTokens = {}
+    fallbackLock = threading.Lock()
 
     def getSession(keyspace=None):
         """
@@ -35,29 +225,109 @@ class CassandraCluster:
         """
 
         sessionLookup = '*' if keyspace is None else keyspace
-        if sessionLookup not in CassandraCluster.session:
-            if CassandraCluster.cluster is None:
-                CassandraCluster.cluster = Cluster(
-                    config['cassandra']['nodes'],
-                    port=int(config['cassandra']['port']))
-                CassandraCluster.session = {}
-                CassandraCluster.preparedStmts = {}
-            CassandraCluster.session[sessionLookup] = \
-                CassandraCluster.cluster.connect(keyspace)
-            CassandraCluster.preparedStmts[sessionLookup] = {}
-        return CassandraCluster.session[sessionLookup]
+        session = CassandraCluster.session.get(sessionLookup)
+        if session is not None:
+            return session
+
+        # Requests of a batch may ask for the first session concurrently
+        with CassandraCluster.lock:
+            if sessionLookup not in CassandraCluster.session:
+                if CassandraCluster.cluster is None:
+                    CassandraCluster.cluster = Cluster(
+                        config['cassandra']['nodes'],
+                        port=int(config['cassandra']['port']),
+                        execution_profiles=CassandraCluster
+                        .executionProfiles())
+                    CassandraCluster.session = {}
+                    CassandraCluster.preparedStmts = {}
+                CassandraCluster.preparedStmts[sessionLookup] = {}
+                CassandraCluster.session[sessionLookup] = \
+                    CassandraCluster.cluster.connect(keyspace)
+            return CassandraCluster.session[sessionLookup]
+
+    def executionProfiles():
+        """
+        Driver execution profiles for the profiles in
+        config['executionprofiles']. The 'default' profile is also the
+        driver's default.
+        """
+        profiles = {name: CassandraCluster.executionProfile(name)
+                    for name in config['executionprofiles']}
+        # Each profile gets its own policy objects, so build the default twice
+        profiles[EXEC_PROFILE_DEFAULT] = \
+            CassandraCluster.executionProfile('default')
+        return profiles
+
+    def executionProfile(name):
+        settings = config['executionprofiles'][name]
+        if settings['speculativedelay'] is not None:
+            speculation = CountingSpeculativeExecutionPolicy(
+                settings['speculativedelay'],
+                settings['speculativeattempts'], name)
+        else:
+            speculation = NoSpeculativeExecutionPolicy()
+        return ExecutionProfile(
+            retry_policy=IdempotentRetryPolicy(settings['retries'], name),
+            speculative_execution_policy=speculation,
+            consistency_level=ConsistencyLevel.name_to_value[
+                settings['consistency']],
+            serial_consistency_level=ConsistencyLevel.name_to_value[
+                settings['serialconsistency']],
+            request_timeout=settings['timeout'])
+
+    def fallbackFor(profile):
+        """
+        Name of the profile empty reads with a profile are retried with, or
+        None
+        """
+        settings = config['executionprofiles'].get(profile)
+        return settings['emptyfallback'] if settings is not None else None
+
+    def takeFallback(profile):
+        """
+        Take a fallback read from a profile's fallbackrate. Returns False if
+        the profile has none left this second.
+        """
+        rate = config['executionprofiles'][profile]['fallbackrate']
+        if rate is None:
+            return True
+        now = time.monotonic()
+        with CassandraCluster.fallbackLock:
+            bucket = CassandraCluster.fallbackTokens.setdefault(
+                profile, [rate, now])
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def profileFor(operation):
+        """
+        Name of the execution profile an AuthDB operation runs with
+        """
+        return config['operationprofiles'].get(operation, 'default')
 
     def getPreparedStatement(statement, keyspace=None):
         """
-        Get a prepared Cassandra statement, or create it if it doesn't exist
+        Get a prepared Cassandra statement, or create it if it doesn't exist.
+        SELECT statements are marked idempotent, so they may be retried and
+        speculatively executed.
         """
 
         sessionLookup = '*' if keyspace is None else keyspace
-        if sessionLookup not in CassandraCluster.preparedStmts:
-            CassandraCluster.preparedStmts = {}
-
-        if statement not in CassandraCluster.preparedStmts[sessionLookup]:
-            session = CassandraCluster.getSession(keyspace)
-            CassandraCluster.preparedStmts[sessionLookup][statement] = \
-                session.prepare(statement)
-        return CassandraCluster.preparedStmts[sessionLookup][statement]
+        prepared = CassandraCluster.preparedStmts.get(sessionLookup, {}).get(
+            statement)
+        if prepared is not None:
+            return prepared
+
+        session = CassandraCluster.getSession(keyspace)
+        with CassandraCluster.lock:
+            statements = CassandraCluster.preparedStmts.setdefault(
+                sessionLookup, {})
+            if statement not in statements:
+                prepared = session.prepare(statement)
+                prepared.is_idempotent = \
+                    statement.lstrip().upper().startswith('SELECT')
+                statements[statement] = prepared
+            return statements[statement]
@@ -0,0 +1,139 @@
+"""
+Circuit breaker for database calls
+
+Tracks the outcome of AuthDB calls over a rolling window. When too many of
+them fail because the cluster is unavailable or timing out, the breaker
+opens and further calls fail immediately with DatabaseUnavailable (503)
+instead of each waiting for the driver timeout. After
+circuitbreaker.opentime seconds a single probe call is let through; it
+closes the breaker if it succeeds and re-opens it if it fails.
+"""
+
+import threading
+import time
+from cassandra import OperationTimedOut, ReadTimeout, Unavailable, WriteTimeout
+from cassandra.cluster import NoHostAvailable
+from collections import deque
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+from werkzeug.exceptions import ServiceUnavailable
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('circuitbreaker_state', 'gauge',
+                 'Database circuit breaker state (0 closed, 1 half-open, ' +
+                 '2 open)')
+Metrics.describe('circuitbreaker_rejections_total', 'counter',
+                 'Database calls rejected while the circuit breaker was open')
+Metrics.describe('circuitbreaker_trips_total', 'counter',
+                 'Times the database circuit breaker opened')
+
+# Errors that indicate the cluster, rather than the request, is unhealthy
+UNAVAILABLE_ERRORS = (NoHostAvailable, OperationTimedOut, ReadTimeout,
+                      Unavailable, WriteTimeout)
+
+
+class DatabaseUnavailable(ServiceUnavailable):
+    description = 'Service unavailable: the database is not responding'
+
+
+class CircuitBreaker:
+    """
+    Singleton per-process circuit breaker
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    lock = threading.Lock()
+    state = CLOSED
+    openedAt = 0
+    probing = False
+    # Per-second [second, successes, failures] counts
+    window = deque()
+
+    def check():
+        """
+        Raise DatabaseUnavailable if calls should not be attempted. In the
+        half-open state the first caller becomes the probe.
+        """
+        if (not config['circuitbreaker']['enabled'] or
+                CircuitBreaker.state == CircuitBreaker.CLOSED):
+            return
+
+        with CircuitBreaker.lock:
+            if CircuitBreaker.state == CircuitBreaker.OPEN:
+                if CircuitBreaker.isOpen():
+                    Metrics.inc('circuitbreaker_rejections_total')
+                    raise DatabaseUnavailable()
+                CircuitBreaker.setState(CircuitBreaker.HALF_OPEN)
+                CircuitBreaker.probing = False
+            if CircuitBreaker.state == CircuitBreaker.HALF_OPEN:
+                if CircuitBreaker.probing:
+                    Metrics.inc('circuitbreaker_rejections_total')
+                    raise DatabaseUnavailable()
+                CircuitBreaker.probing = True
+
+    def isOpen():
+        """
+        True while the breaker is open and not yet due for a probe
+        """
+        return (CircuitBreaker.state == CircuitBreaker.OPEN and
+                time.time() - CircuitBreaker.openedAt <
+                config['circuitbreaker']['opentime'])
+
+    def success():
+        if not config['circuitbreaker']['enabled']:
+            return
+        with CircuitBreaker.lock:
+            if CircuitBreaker.state != CircuitBreaker.CLOSED:
+                log.info('Database circuit breaker closed')
+                CircuitBreaker.window.clear()
+                CircuitBreaker.setState(CircuitBreaker.CLOSED)
+            CircuitBreaker.record(0, 1)
+
+    def failure():
+        if not config['circuitbreaker']['enabled']:
+            return
+        with CircuitBreaker.lock:
+            successes, failures = CircuitBreaker.record(1, 0)
+            if CircuitBreaker.state == CircuitBreaker.HALF_OPEN:
+                CircuitBreaker.trip('probe failed')
+            elif (CircuitBreaker.state == CircuitBreaker.CLOSED and
+                    successes + failures >=
+                    config['circuitbreaker']['minrequests'] and
+                    failures / (successes + failures) >=
+                    config['circuitbreaker']['failureratio']):
+                CircuitBreaker.trip('%d of the last %d calls failed' %
+                                    (failures, successes + failures))
+
+    def record(failures, successes):
+        """
+        Add outcomes to the current second and return the totals over the
+        window
+        """
+        now = int(time.time())
+        window = CircuitBreaker.window
+        while window and window[0][0] <= now - \
+                config['circuitbreaker']['window']:
+            window.popleft()
+        if not window or window[-1][0] != now:
+            window.append([now, 0, 0])
+        window[-1][1] += successes
+        window[-1][2] += failures
+        return (sum(second[1] for second in window),
+                sum(second[2] for second in window))
+
+    def trip(reason):
+        log.error('Database circuit breaker opened: %s', reason)
+        CircuitBreaker.openedAt = time.time()
+        CircuitBreaker.setState(CircuitBreaker.OPEN)
+        Metrics.inc('circuitbreaker_trips_total')
+
+    def setState(state):
+        CircuitBreaker.state = state
+        Metrics.set('circuitbreaker_state', state)
@@ -1,16 +1,27 @@
 import cassandra
 import datetime
+import inspect
 import os
+import threading
 import time
 import uuid
-from cassandra import ConsistencyLevel
 from cassandra.query import SimpleStatement
-from database.cassandra import CassandraCluster
+from database.cassandra import CassandraCluster, ProfiledSession
+from database.circuitbreaker import (UNAVAILABLE_ERRORS, CircuitBreaker,
+                                     DatabaseUnavailable)
 from functools import wraps
 from logging import getLogger
+from metrics import Metrics
+from settings import Settings
 
 log = getLogger('gunicorn.error')
 
+config = Settings.getConfig()
+
+Metrics.describe('authdb_operation_duration_seconds', 'histogram',
+                 'Duration of AuthDB operations by execution profile and ' +
+                 'outcome')
+
 
 def schemaDir(scriptstype):
     """
@@ -24,7 +35,7 @@ def schemaDir(scriptstype):
         @wraps(func)
         def func_wrapper(path, session, reqid):
             if os.path.isdir(path):
-                log.info('Loading %s from "%s"' % (scriptstype, path))
+                log.info('Loading %s from "%s"', scriptstype, path)
                 contents = os.listdir(path)
                 contents.sort()
                 for f in contents:
@@ -34,18 +45,21 @@ def schemaDir(scriptstype):
                             func(filepath, session)
                             DB.updateReq(session, reqid)
                         else:
-                            log.info('Skipping non-CQL file "%s"' % (filepath,))
+                            log.debug('Skipping non-CQL file "%s"', filepath)
                     else:
-                        log.info('Skipping non-file "%s"' % (filepath,))
+                        log.debug('Skipping non-file "%s"', filepath)
             else:
-                log.info('No %s found for "%s"' %
-                         (scriptstype, session.keyspace))
+                log.info('No %s found for "%s"', scriptstype, session.keyspace)
         return func_wrapper
     return schemaDir_decorator
 
 
 class DB:
 
+    schemaState = {}
+    # Nesting depth of the AuthDB calls running on each thread
+    calls = threading.local()
+
     @schemaDir('baselines')
     def baseline(path, session):
         """
@@ -56,40 +70,55 @@ class DB:
 
         filestart = path.rfind('/')+1
         tablename = path[filestart:-4]
-        log.info('Checking table "%s"' % (tablename,))
+        log.debug('Checking table "%s"', tablename)
         if not DB.tableExists(session.keyspace, tablename):
-            log.info('Running baseline script for "%s"' % (tablename,))
+            log.info('Running baseline script for "%s"', tablename)
             query = open(path).read()
             try:
-                session.execute(SimpleStatement(query,
-                                consistency_level=ConsistencyLevel.QUORUM))
+                DB.executeScript(session, query)
             except Exception as e:
                 if DB.tableExists(session.keyspace, tablename):
                     # Somehow we got in this state that we shouldn't get in
-                    log.warning('Error creating table "%s": ' % (tablename,) +
-                                'Tried to create a table that already exists!')
+                    log.warning('Error creating table "%s": ' +
+                                'Tried to create a table that already exists!',
+                                tablename)
                 else:
                     raise e
         else:
-            log.info('Table "%s" already exists (skipping)' % (tablename,))
+            log.debug('Table "%s" already exists (skipping)', tablename)
 
-    def createDB(keyspace, replication_class, replication_factor,
-                 consistency=ConsistencyLevel.QUORUM):
-        session = CassandraCluster.getSession()
-        log.info('Creating Keyspace "%s"' % (keyspace,))
+    def createDB(keyspace, replication_class, replication_factor):
+        session = ProfiledSession(CassandraCluster.getSession(), 'admin')
+        log.info('Creating Keyspace "%s"', keyspace)
         session.execute(SimpleStatement(
             """
             CREATE KEYSPACE %s WITH replication
                 = {'class': '%s', 'replication_factor': %s};
-            """ % (keyspace, replication_class, replication_factor),
-            consistency_level=consistency))
+            """ % (keyspace, replication_class, replication_factor)))
+
+    def expectedSchemaVersion(keyspace):
+        """
+        Schema version this code expects for a keyspace: the name of the last
+        migration script in its schema directory, or 'baseline' if there are
+        none. Migration scripts are run in name order, so versions compare as
+        strings.
+
+        :keyspace:
+            Keyspace to get the expected version for
+        """
+        path = os.path.join(DB.schemaRoot(keyspace), 'schema_migrations')
+        if os.path.isdir(path):
+            scripts = sorted(f for f in os.listdir(path) if f.endswith('.cql'))
+            if len(scripts) > 0:
+                return scripts[-1]
+        return 'baseline'
 
     def doMigration(session, reqid):
         log.info('Selected for migration.')
 
-        schemaroot = os.path.join(os.getcwd(), 'schema', session.keyspace)
+        schemaroot = DB.schemaRoot(session.keyspace)
 
-        log.info('Checking for schema and migrations in "%s"' % (schemaroot,))
+        log.info('Checking for schema and migrations in "%s"', schemaroot)
 
         # Only migrate if there is a directory for the keyspace schema
         if os.path.isdir(schemaroot):
@@ -97,94 +126,274 @@ class DB:
                         session, reqid)
             DB.migrateSchema(os.path.join(schemaroot, 'schema_migrations'),
                              session, reqid)
+
+            # Let workers know the schema is current
+            DB.setSchemaVersion(session,
+                                DB.expectedSchemaVersion(session.keyspace))
         else:
-            log.info('No schema directory found for "%s"' % (session.keyspace,))
+            log.info('No schema directory found for "%s"', session.keyspace)
 
-    @schemaDir('schema migrations')
-    def migrateSchema(path, session):
+    def migrationPlan(keyspace):
         """
-        Execute a CQL schema migration script within a keyspace. File will not
-        be run if it is marked as successfully run in the schema_migrations
-        table within the keyspace.
+        Report what a migration of a keyspace would do, without changing
+        anything: the baseline tables that would be created, the migration
+        scripts that would run and the schema version before and after.
+
+        :keyspace:
+            Keyspace to report on
         """
+        schemaroot = DB.schemaRoot(keyspace)
+        migrationsPath = os.path.join(schemaroot, 'schema_migrations')
+        baselinePath = os.path.join(schemaroot, 'baseline')
+        plan = {'keyspace': keyspace,
+                'keyspaceexists': False,
+                'currentversion': None,
+                'expectedversion': DB.expectedSchemaVersion(keyspace),
+                'baselines': [],
+                'migrations': []}
 
-        # Get the filename part
-        filestart = path.rfind('/')+1
-        filename = path[filestart:]
+        session = CassandraCluster.getSession()
+        plan['keyspaceexists'] = keyspace in session.cluster.metadata.keyspaces
+        history = {}
+        if plan['keyspaceexists']:
+            session = ProfiledSession(CassandraCluster.getSession(keyspace),
+                                      'admin')
+            if DB.tableExists(keyspace, 'schema_version'):
+                plan['currentversion'] = DB.getSchemaVersion(session)
+            if DB.tableExists(keyspace, 'schema_migrations'):
+                history = DB.getMigrationHistory(session)
+
+        if os.path.isdir(baselinePath):
+            plan['baselines'] = [
+                f[:-4] for f in sorted(os.listdir(baselinePath))
+                if f.endswith('.cql') and not (plan['keyspaceexists'] and
+                                               DB.tableExists(keyspace,
+                                                              f[:-4]))]
+
+        for filename in DB.pendingMigrations(migrationsPath, history):
+            with open(os.path.join(migrationsPath, filename)) as f:
+                statements = DB.splitStatements(f.read())
+            last = history.get(filename)
+            plan['migrations'].append({
+                'script': filename,
+                'statements': statements,
+                'lasterror': (last.error if last is not None and last.failed
+                              else None)})
+        return plan
+
+    def migrateSchema(path, session, reqid):
+        """
+        Execute the pending CQL schema migration scripts in a directory, in
+        name order. The migration history is read once up front; a script is
+        pending unless its last recorded execution succeeded.
+        """
+        if not os.path.isdir(path):
+            log.info('No schema migrations found for "%s"', session.keyspace)
+            return
+
+        log.info('Loading schema migrations from "%s"', path)
+        history = DB.getMigrationHistory(session)
+        pending = DB.pendingMigrations(path, history)
+        log.info('%d of %d schema migrations pending', len(pending),
+                 len(DB.migrationScripts(path)))
 
-        log.info('Checking migration script "%s"' % (filename,))
+        for filename in pending:
+            DB.runMigration(os.path.join(path, filename), session)
+            DB.updateReq(session, reqid)
 
-        # Get the migration history for the script
-        migrationScriptHistoryQuery = CassandraCluster.getPreparedStatement(
+    def migrationScripts(path):
+        """
+        Names of the CQL migration scripts in a directory, in the order they
+        are run
+        """
+        if not os.path.isdir(path):
+            return []
+        return sorted(f for f in os.listdir(path)
+                      if f.endswith('.cql') and
+                      os.path.isfile(os.path.join(path, f)))
+
+    def getMigrationHistory(session):
+        """
+        Get the last recorded execution of every migration script, as a dict
+        of script name to schema_migrations row
+
+        :session:
+            Session for the keyspace
+        """
+        migrationHistoryQuery = CassandraCluster.getPreparedStatement(
             """
-            SELECT * FROM schema_migrations
-            WHERE scriptname = ?;
+            SELECT scriptname, time, run, failed, error
+            FROM schema_migrations
             """, keyspace=session.keyspace)
-        migrationScriptHistory = session.execute(migrationScriptHistoryQuery,
-                                                 (filename,)).current_rows
+        history = {}
+        for row in session.execute(migrationHistoryQuery):
+            # Rows of a script are ordered by time
+            history[row.scriptname] = row
+        return history
 
-        # Run if there is no history or the last execution failed
-        if (len(migrationScriptHistory) == 0 or
-                migrationScriptHistory[-1].failed or
-                not migrationScriptHistory[-1].run):
+    def pendingMigrations(path, history):
+        """
+        Names of the scripts in path that have not been run successfully
 
-            log.info('Running "%s" as it has not been run sucessfully' %
-                     (filename,))
+        :path:
+            Directory of migration scripts
+        :history:
+            Migration history from getMigrationHistory()
+        """
+        return [f for f in DB.migrationScripts(path)
+                if f not in history or history[f].failed or
+                not history[f].run]
 
-            content = open(path).read()
-            exectime = datetime.datetime.now()
+    def runMigration(path, session):
+        """
+        Run a migration script, recording the attempt and its outcome in the
+        schema_migrations table
+        """
+        filename = os.path.basename(path)
+        log.info('Running "%s" as it has not been run sucessfully', filename)
 
-            # Insert a record of this script into the schema_migrations table
-            #   and mark as not run and not failed.
-            migrationScriptRunInsert = CassandraCluster.getPreparedStatement(
-                """
-                INSERT INTO schema_migrations (scriptname, time, run, failed,
-                    error, content)
-                    VALUES (?, ?, false, false, '', ?)
+        content = open(path).read()
+        exectime = datetime.datetime.now()
+
+        # Insert a record of this script into the schema_migrations table
+        #   and mark as not run and not failed.
+        migrationScriptRunInsert = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO schema_migrations (scriptname, time, run, failed,
+                error, content)
+                VALUES (?, ?, false, false, '', ?)
+            """, keyspace=session.keyspace)
+        session.execute(migrationScriptRunInsert,
+                        (filename, exectime, content))
+
+        try:
+            DB.executeScript(session, content)
+
+            log.info('Successfully ran "%s"', filename)
+
+            # Update the script's run record as completed with success
+            migrationScriptUpdateSuccess = \
+                CassandraCluster.getPreparedStatement("""
+                    UPDATE schema_migrations
+                    SET run = true, failed = false
+                    WHERE scriptname = ? AND time = ?
                 """, keyspace=session.keyspace)
-            migrationScriptRunInsert.consistency_level = ConsistencyLevel.QUORUM
-            session.execute(migrationScriptRunInsert,
-                            (filename, exectime, content))
+            session.execute(migrationScriptUpdateSuccess,
+                            (filename, exectime))
+        except Exception as e:
+            log.info('Failed to run "%s"', filename)
+
+            # Log failure
+            migrationScriptUpdateFailure = \
+                CassandraCluster.getPreparedStatement(
+                    """
+                    UPDATE schema_migrations
+                    SET run = false, failed = true, error = ?
+                    WHERE scriptname = ? AND time = ?
+                    """, keyspace=session.keyspace)
+            session.execute(migrationScriptUpdateFailure,
+                            (str(e), filename, exectime))
+
+            # Pass failure upwards
+            raise e
 
+    def executeScript(session, content):
+        """
+        Execute each statement of a CQL script in turn, waiting for the
+        cluster to agree on the schema after each schema change so the next
+        statement (or the next script) never runs against a stale schema.
+
+        :session:
+            Session for the keyspace
+        :content:
+            CQL script text
+        """
+        statements = DB.splitStatements(content)
+        for i, statement in enumerate(statements):
             try:
-                # Run the migration script
-                session.execute(SimpleStatement(content,
-                                consistency_level=ConsistencyLevel.QUORUM))
-
-                log.info('Successfully ran "%s"' % (filename,))
-
-                # Update the script's run record as completed with success
-                migrationScriptUpdateSuccess = \
-                    CassandraCluster.getPreparedStatement("""
-                        UPDATE schema_migrations
-                        SET run = true, failed = false
-                        WHERE scriptname = ? AND time = ?
-                    """, keyspace=session.keyspace)
-                migrationScriptUpdateSuccess.consistency_level = \
-                    ConsistencyLevel.QUORUM
-                session.execute(migrationScriptUpdateSuccess,
-                                (filename, exectime))
+                session.execute(SimpleStatement(statement))
             except Exception as e:
-                log.info('Failed to run "%s"' % (filename,))
+                raise Exception('Statement %d of %d failed: %s' %
+                                (i + 1, len(statements), e))
+            keyword = statement.split(None, 1)[0].upper()
+            if keyword in ('ALTER', 'CREATE', 'DROP'):
+                DB.waitForSchemaAgreement(session)
 
-                # Log failure
-                migrationScriptUpdateFailure = \
-                    CassandraCluster.getPreparedStatement(
-                        """
-                        UPDATE schema_migrations
-                        SET run = false, failed = true, error = ?
-                        WHERE scriptname = ? AND time = ?
-                        """, keyspace=session.keyspace)
-                migrationScriptUpdateFailure.consistency_level = \
-                    ConsistencyLevel.QUORUM
-                session.execute(migrationScriptUpdateFailure,
-                                (str(e), filename, exectime))
+    def splitStatements(content):
+        """
+        Split a CQL script into statements on the semicolons that are not
+        inside strings, quoted identifiers, $$ blocks or comments. Comments
+        are removed.
 
-                # Pass failure upwards
-                raise e
-        else:
-            log.info('Script "%s" has already been run on %s' %
-                     (filename, migrationScriptHistory[-1].time))
+        :content:
+            CQL script text
+        """
+        statements = []
+        current = []
+        i = 0
+        while i < len(content):
+            c = content[i]
+            if content.startswith('--', i) or content.startswith('//', i):
+                end = content.find('\n', i)
+                i = len(content) if end == -1 else end
+                continue
+            if content.startswith('/*', i):
+                end = content.find('*/', i + 2)
+                i = len(content) if end == -1 else end + 2
+                current.append(' ')
+                continue
+            if content.startswith('$$', i):
+                end = content.find('$$', i + 2)
+                end = len(content) if end == -1 else end + 2
+                current.append(content[i:end])
+                i = end
+                continue
+            if c in ('\'', '"'):
+                # Quotes are escaped by doubling them, which this treats as
+                #   two adjacent quoted sections
+                end = content.find(c, i + 1)
+                end = len(content) if end == -1 else end + 1
+                current.append(content[i:end])
+                i = end
+                continue
+            if c == ';':
+                statements.append(''.join(current).strip())
+                current = []
+            else:
+                current.append(c)
+            i += 1
+        statements.append(''.join(current).strip())
+        return [statement for statement in statements if statement]
+
+    def waitForSchemaAgreement(session):
+        """
+        Wait until every live node reports the same schema version. Raises
+        an exception if they don't agree within schema.agreementtimeout
+        seconds.
+
+        :session:
+            Session whose cluster to wait on
+        """
+        if not session.cluster.control_connection.wait_for_schema_agreement(
+                wait_time=config['schema']['agreementtimeout']):
+            raise Exception('Schema agreement not reached within %s seconds' %
+                            (config['schema']['agreementtimeout'],))
+
+    def getSchemaVersion(session):
+        """
+        Get the schema version recorded by the last successful migration of
+        the session's keyspace, or None if there is none.
+
+        :session:
+            Session for the keyspace to check
+        """
+        getSchemaVersionQuery = CassandraCluster.getPreparedStatement(
+            """
+            SELECT version FROM schema_version
+            WHERE name = 'current'
+            """, keyspace=session.keyspace)
+        rows = session.execute(getSchemaVersionQuery).current_rows
+        return rows[0].version if len(rows) > 0 else None
 
     def requestMigration(session=None):
         """
@@ -227,7 +436,7 @@ class DB:
 
                 # Delete the "stale" request (cleanup task)
                 try:
-                    log.info('Found stale request %s, deleting' % (req.reqid,))
+                    log.info('Found stale request %s, deleting', req.reqid)
                     session.execute(deleteReqQuery, (req.reqid,))
                 except:
                     pass
@@ -242,7 +451,7 @@ class DB:
             t = datetime.datetime.now()
 
             log.info('No outstanding migration requests, ' +
-                     'requesting migration with ID %s' % (reqid,))
+                     'requesting migration with ID %s', reqid)
 
             # Nominate ourselves to run migration tasks
             requestMigrationQuery = CassandraCluster.getPreparedStatement(
@@ -251,7 +460,6 @@ class DB:
                     inprogress, failed, lastupdate)
                 VALUES (?, ?, false, false, ?)
                 """, keyspace=session.keyspace)
-            requestMigrationQuery.consistency_level = ConsistencyLevel.QUORUM
             session.execute(requestMigrationQuery, (reqid, t, t))
 
             time.sleep(2)
@@ -325,6 +533,42 @@ class DB:
             # Wait for migration to complete
             DB.waitForMigrationCompletion(session)
 
+    def schemaReady(keyspace):
+        """
+        Check that a keyspace's schema is at least the version this code
+        expects. Once the schema is found ready it is not checked again. A
+        schema that is behind is re-checked at most every
+        schema.recheckinterval seconds.
+
+        :keyspace:
+            Keyspace to check
+        """
+        state = DB.schemaState.get(keyspace)
+        if state is not None and (state[0] or time.time() - state[1] <
+                                  config['schema']['recheckinterval']):
+            return state[0]
+
+        expected = DB.expectedSchemaVersion(keyspace)
+        try:
+            current = DB.getSchemaVersion(CassandraCluster.getSession(keyspace))
+        except Exception as e:
+            log.error('Unable to read schema version of "%s": %s', keyspace, e)
+            current = None
+
+        ready = current is not None and current >= expected
+        if not ready:
+            log.warning('Schema of "%s" is at %s, expected %s. ' +
+                        'Run migrate.py to update it.', keyspace, current,
+                        expected)
+        DB.schemaState[keyspace] = (ready, time.time())
+        return ready
+
+    def schemaRoot(keyspace):
+        """
+        Directory holding the baseline and migration scripts of a keyspace
+        """
+        return os.path.join(os.getcwd(), 'schema', keyspace)
+
     def sessionQuery(keyspace):
         """
         Wrapper to ensure session creation for each query
@@ -333,22 +577,113 @@ class DB:
             Keyspace to use for session creation.
         """
         def sessionQueryWrapper(func):
+            profile = CassandraCluster.profileFor(func.__name__)
+
+            if inspect.isgeneratorfunction(func):
+                # Nothing runs until the generator is iterated, so each step
+                #   is guarded as a call of its own
+                @wraps(func)
+                def generator_wrapper(*args, **kwargs):
+                    generator = func(*args, session=ProfiledSession(
+                        CassandraCluster.getSession(keyspace), profile,
+                        func.__name__), **kwargs)
+                    while True:
+                        item = DB.guardedCall(
+                            func.__name__, profile,
+                            lambda: next(generator, StopIteration))
+                        if item is StopIteration:
+                            return
+                        yield item
+                return generator_wrapper
+
             @wraps(func)
             def func_wrapper(*args, **kwargs):
-                return func(*args,
-                            session=CassandraCluster.getSession(keyspace),
-                            **kwargs)
+                return DB.guardedCall(
+                    func.__name__, profile,
+                    lambda: func(*args, session=ProfiledSession(
+                        CassandraCluster.getSession(keyspace), profile,
+                        func.__name__), **kwargs))
             return func_wrapper
         return sessionQueryWrapper
 
+    def guardedCall(operation, profile, call):
+        """
+        Run call() through the circuit breaker and record its duration.
+        Queries that call other queries are checked and recorded once, by
+        the outermost call, so a half-open breaker's probe isn't rejected
+        by its own nested calls.
+
+        :operation:
+            Name of the AuthDB function
+        :profile:
+            Execution profile of the function
+        :call:
+            Function running the query
+        """
+        outermost = getattr(DB.calls, 'depth', 0) == 0
+        if outermost:
+            CircuitBreaker.check()
+        DB.calls.depth = getattr(DB.calls, 'depth', 0) + 1
+        start = time.perf_counter()
+        try:
+            result = call()
+        except UNAVAILABLE_ERRORS as e:
+            if outermost:
+                CircuitBreaker.failure()
+            DB.observe(operation, profile, start, 'unavailable')
+            raise DatabaseUnavailable() from e
+        except DatabaseUnavailable:
+            # Raised by a nested call
+            if outermost:
+                CircuitBreaker.failure()
+            raise
+        except Exception:
+            # The cluster answered, the request itself failed
+            if outermost:
+                CircuitBreaker.success()
+            DB.observe(operation, profile, start, 'error')
+            raise
+        finally:
+            DB.calls.depth -= 1
+        if outermost:
+            CircuitBreaker.success()
+        DB.observe(operation, profile, start, 'ok')
+        return result
+
+    def observe(operation, profile, start, outcome):
+        Metrics.observe('authdb_operation_duration_seconds',
+                        time.perf_counter() - start, operation=operation,
+                        profile=profile, outcome=outcome)
+
+    def setSchemaVersion(session, version):
+        """
+        Record the schema version of the session's keyspace
+
+        :session:
+            Session for the keyspace
+        :version:
+            Version to record (see expectedSchemaVersion())
+        """
+        setSchemaVersionQuery = CassandraCluster.getPreparedStatement(
+            """
+            INSERT INTO schema_version (name, version, updated)
+            VALUES ('current', ?, ?)
+            """, keyspace=session.keyspace)
+        session.execute(setSchemaVersionQuery,
+                        (version, datetime.datetime.now()))
+        log.info('Schema of "%s" is now at %s', session.keyspace, version)
+
     def setupDB(keyspace, replication_class='SimpleStrategy',
                 replication_factor=1):
         try:
             DB.createDB(keyspace, replication_class, replication_factor)
         except cassandra.AlreadyExists:
-            log.info('Keyspace "%s" already exists (skipping)' % (keyspace,))
+            log.info('Keyspace "%s" already exists (skipping)', keyspace)
 
-        session = CassandraCluster.getSession(keyspace)
+        # Migrations and their bookkeeping run with the admin consistency
+        #   profile
+        session = ProfiledSession(CassandraCluster.getSession(keyspace),
+                                  'admin')
 
         if not DB.tableExists(session.keyspace, 'schema_migrations'):
             # Create the schema_migrations table. This table stores the history
@@ -367,7 +702,7 @@ class DB:
                         content text,
                         PRIMARY KEY (scriptname, time)
                         )
-                    """, consistency_level=ConsistencyLevel.QUORUM))
+                    """))
             except Exception as e:
                 log.info('Failed to create Schema Migrations table (Ignoring)')
                 log.debug(str(e))
@@ -389,12 +724,31 @@ class DB:
                         lastupdate timestamp,
                         PRIMARY KEY (reqid)
                         )
-                    """, consistency_level=ConsistencyLevel.QUORUM))
+                    """))
             except Exception as e:
                 log.info('Failed to create Schema Migration Requests ' +
                          'table (Ignoring)')
                 log.debug(str(e))
 
+        if not DB.tableExists(session.keyspace, 'schema_version'):
+            # Create schema_version table. This table records the schema
+            #   version reached by the last successful migration, so workers
+            #   can check it without taking part in migrations.
+            try:
+                log.info('Creating Schema Version table')
+                session.execute(SimpleStatement(
+                    """
+                    CREATE TABLE schema_version (
+                        name text,
+                        version text,
+                        updated timestamp,
+                        PRIMARY KEY (name)
+                        )
+                    """))
+            except Exception as e:
+                log.info('Failed to create Schema Version table (Ignoring)')
+                log.debug(str(e))
+
         # Just to prevent race conditions on creation and read
         time.sleep(1)
 
@@ -460,8 +814,8 @@ class DB:
             SELECT * FROM schema_migration_requests
             """, keyspace=session.keyspace)
 
-        log.info('Waiting for migrations to complete on "%s"' %
-                 (session.keyspace,))
+        log.info('Waiting for migrations to complete on "%s"',
+                 session.keyspace)
 
         while migrationsRunning:
             time.sleep(0.5)
@@ -483,9 +837,8 @@ class DB:
                     migrationsRunning = False
                     migrationsFailedOrStalled = True
 
-        log.info('Finished waiting for migration of "%s"' % (session.keyspace,))
+        log.info('Finished waiting for migration of "%s"', session.keyspace)
         if migrationsFailedOrStalled:
-            log.warning('Detected failed migration of "%s", ' %
-                        (session.keyspace,) +
-                        'will re-request migration')
+            log.warning('Detected failed migration of "%s", ' +
+                        'will re-request migration', session.keyspace)
             DB.requestMigration(session)
@@ -0,0 +1,297 @@
+"""
+Asynchronous auth event log
+
+Events (logins, failed logins, session deletes, password resets) are queued
+in memory by the API handlers and written to Cassandra in batches by a
+background flusher thread, so recording an event never waits on the database.
+"""
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from cassandra.util import datetime_from_uuid1, uuid_from_time
+from collections import deque
+from database.authdb import AuthDB
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('authevents_recorded_total', 'counter',
+                 'Auth events queued for writing')
+Metrics.describe('authevents_written_total', 'counter',
+                 'Auth events written to the database')
+Metrics.describe('authevents_dropped_total', 'counter',
+                 'Auth events dropped because the queue was full or the ' +
+                 'spill file could not be written')
+Metrics.describe('authevents_spilled_total', 'counter',
+                 'Auth events spilled to the local overflow file')
+
+
+class EventLog:
+    """
+    Singleton bounded queue of auth events with a write-behind flusher.
+
+    When the queue is full, eventlog.policy decides what happens to a new
+    event: 'drop' discards it, 'block' waits up to eventlog.blocktimeout
+    seconds for room before discarding it, and 'spill' appends it to
+    eventlog.spillfile. Batches that fail to write are also spilled under the
+    'spill' policy. Spilled events are written once the queue drains.
+    """
+
+    queue = deque()
+    condition = threading.Condition()
+    spillLock = threading.Lock()
+    flusher = None
+    pid = None
+    lastFailure = 0
+
+    def record(event, org, username, sessionId=None, source=None,
+               detail=None, knownUser=True):
+        """
+        Queue an auth event for writing
+
+        :event:
+            Event type, e.g. 'login' or 'loginfailed'
+        :org:
+            Organization of the user
+        :username:
+            Name of the user
+        :sessionId:
+            Session the event applies to, if any
+        :source:
+            Address the request came from
+        :detail:
+            Free-form detail about the event
+        :knownUser:
+            False if the user does not exist. Such events are only recorded
+            against the org, so unknown usernames don't create partitions.
+        """
+        if not config['eventlog']['enabled']:
+            return
+
+        now = time.time()
+        entry = {'event': event,
+                 'org': org,
+                 'username': username,
+                 'time': now,
+                 'eventid': str(uuid_from_time(now)),
+                 'sessionid': (str(sessionId) if sessionId is not None
+                               else None),
+                 'source': source,
+                 'detail': detail,
+                 'knownuser': knownUser}
+
+        EventLog.ensureFlusher()
+        maxQueue = config['eventlog']['maxqueue']
+        policy = config['eventlog']['policy']
+        with EventLog.condition:
+            if (len(EventLog.queue) >= maxQueue and policy == 'block'):
+                EventLog.condition.wait_for(
+                    lambda: len(EventLog.queue) < maxQueue,
+                    timeout=config['eventlog']['blocktimeout'])
+            queued = len(EventLog.queue) < maxQueue
+            if queued:
+                EventLog.queue.append(entry)
+                if len(EventLog.queue) >= config['eventlog']['batchsize']:
+                    EventLog.condition.notify_all()
+
+        # Metrics may write to disk, so they are counted outside the lock
+        if queued:
+            Metrics.inc('authevents_recorded_total')
+            return
+
+        if policy == 'spill':
+            EventLog.spill([entry])
+        else:
+            Metrics.inc('authevents_dropped_total')
+
+    def ensureFlusher():
+        """
+        Start the flusher thread if this process doesn't have one. Threads
+        don't survive a fork, so a new one is started in each worker.
+        """
+        if EventLog.flusher is None or EventLog.pid != os.getpid():
+            with EventLog.condition:
+                if EventLog.flusher is None or EventLog.pid != os.getpid():
+                    EventLog.pid = os.getpid()
+                    EventLog.flusher = threading.Thread(
+                        target=EventLog.run, name='EventLogFlusher',
+                        daemon=True)
+                    EventLog.flusher.start()
+
+    def run():
+        """
+        Flusher loop: write a batch whenever batchsize events are queued or
+        flushinterval seconds have passed.
+        """
+        while True:
+            with EventLog.condition:
+                EventLog.condition.wait_for(
+                    lambda: (len(EventLog.queue) >=
+                             config['eventlog']['batchsize']),
+                    timeout=config['eventlog']['flushinterval'])
+            try:
+                if (EventLog.flush() and len(EventLog.queue) == 0 and
+                        time.time() - EventLog.lastFailure >
+                        config['eventlog']['spillretryinterval']):
+                    EventLog.replaySpill()
+            except Exception as e:
+                log.error('Error in EventLog flusher: %s', e)
+
+    def flush():
+        """
+        Write every queued event, one batch at a time. Returns False if any
+        batch failed to write.
+        """
+        succeeded = True
+        while True:
+            with EventLog.condition:
+                batch = [EventLog.queue.popleft() for i in
+                         range(min(len(EventLog.queue),
+                                   config['eventlog']['batchsize']))]
+                EventLog.condition.notify_all()
+            if len(batch) == 0:
+                return succeeded
+            succeeded = EventLog.write(batch) and succeeded
+
+    def write(batch):
+        try:
+            AuthDB.writeAuthEvents(batch)
+            Metrics.inc('authevents_written_total', len(batch))
+            return True
+        except Exception as e:
+            log.error('Unable to write %d auth events: %s', len(batch), e)
+            EventLog.lastFailure = time.time()
+            if config['eventlog']['policy'] == 'spill':
+                EventLog.spill(batch)
+            else:
+                Metrics.inc('authevents_dropped_total', len(batch))
+            return False
+
+    def spillPath():
+        return config['eventlog']['spillfile'] % {'pid': os.getpid()}
+
+    def spill(events):
+        """
+        Append events to this process's overflow file
+        """
+        path = EventLog.spillPath()
+        try:
+            with EventLog.spillLock:
+                if (os.path.isfile(path) and os.path.getsize(path) >
+                        config['eventlog']['maxspillbytes']):
+                    raise IOError('spill file is full')
+                with open(path, 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+            Metrics.inc('authevents_spilled_total', len(events))
+        except Exception as e:
+            log.error('Unable to spill %d auth events to "%s": %s',
+                      len(events), path, e)
+            Metrics.inc('authevents_dropped_total', len(events))
+
+    def replaySpill():
+        """
+        Write the events in this process's overflow file, and in any left
+        behind by workers that have exited. Stops at the first batch that
+        fails, spilling the remaining events again.
+        """
+        paths = [EventLog.spillPath()]
+        pattern = config['eventlog']['spillfile'] % {'pid': '*'}
+        for path in glob.glob(pattern):
+            pid = path[len(pattern.split('*')[0]):len(path) -
+                       len(pattern.split('*')[1])]
+            if pid.isdigit() and not EventLog.processAlive(int(pid)):
+                paths.append(path)
+
+        for path in paths:
+            replayPath = '%s.replay-%d' % (path, os.getpid())
+            with EventLog.spillLock:
+                try:
+                    os.replace(path, replayPath)
+                except FileNotFoundError:
+                    continue
+
+            with open(replayPath, 'r') as f:
+                events = [json.loads(line) for line in f if line.strip()]
+            os.remove(replayPath)
+
+            log.info('Replaying %d spilled auth events from "%s"', len(events),
+                     path)
+            batchSize = config['eventlog']['batchsize']
+            for i in range(0, len(events), batchSize):
+                if not EventLog.write(events[i:i + batchSize]):
+                    # Still failing, put the rest back and try again later
+                    EventLog.spill(events[i + batchSize:])
+                    return
+
+    def processAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def queryWindow(start, end, maxRange=None):
+        """
+        Validate the time window of an event query. Defaults to the day
+        before end, and end defaults to now. Raises ValueError if the window
+        is backwards or longer than maxRange seconds.
+
+        :start:
+            Earliest event time in seconds since the epoch, or None
+        :end:
+            Latest event time in seconds since the epoch, or None
+        :maxRange:
+            Longest window allowed, in seconds. Defaults to
+            eventlog.maxqueryrange.
+        """
+        if maxRange is None:
+            maxRange = config['eventlog']['maxqueryrange']
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - 86400
+        if start > end:
+            raise ValueError('start must be before end')
+        if end - start > maxRange:
+            raise ValueError('Time range may not exceed %d seconds' %
+                             (maxRange,))
+        return start, end
+
+    def formatEvent(row):
+        """
+        Convert an event row from authdb.userauthevents or
+        authdb.orgauthevents to a response dict
+        """
+        event = {'time': str(datetime_from_uuid1(row.eventtime)),
+                 'event': row.event,
+                 'sessionid': (str(row.sessionid)
+                               if row.sessionid is not None else None),
+                 'source': row.source,
+                 'detail': row.detail}
+        if hasattr(row, 'username'):
+            event['username'] = row.username
+        return event
+
+    def shutdown():
+        """
+        Write out (or spill) whatever is still queued when the process exits
+        """
+        if EventLog.pid == os.getpid():
+            try:
+                EventLog.flush()
+            except Exception as e:
+                log.error('Error flushing auth events on exit: %s', e)
+
+
+atexit.register(EventLog.shutdown)
@@ -0,0 +1,354 @@
+"""
+Latency and fault injection for Cassandra statements
+
+For testing only. When faultinjection.enabled is set, every statement run
+through a ProfiledSession is checked against a list of rules. A matching
+rule can delay the statement, drawing the delay from a distribution, and
+fail it with the error the driver would raise for a slow or failing
+replica. Injected errors go through the same paths as real ones, so the
+circuit breaker, fallback reads and error handling of the API can be
+measured locally against a healthy stand-in cluster.
+
+Retries and timeouts of the statement's execution profile are emulated:
+retryable errors of idempotent statements are drawn again up to 'retries'
+times, and a statement whose injected delay reaches the profile's timeout
+fails with OperationTimedOut after waiting the timeout.
+
+Rules come from faultinjection.rules, or from faultinjection.file once it
+has been written by PUT /admin/faults. Every worker on the host reads the
+file, so the endpoint changes the faults of all of them.
+"""
+
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from cassandra import (ConsistencyLevel, OperationTimedOut, ReadTimeout,
+                       Unavailable, WriteTimeout)
+from cassandra.cluster import NoHostAvailable
+from cassandra.query import BatchStatement
+from contextlib import contextmanager
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('cassandra_injected_faults_total', 'counter',
+                 'Statements failed by fault injection')
+Metrics.describe('cassandra_injected_delay_seconds', 'histogram',
+                 'Delays added to statements by fault injection')
+
+# Replica errors a rule can raise, built the way the driver reports them
+FAULTS = {
+    'unavailable': lambda: Unavailable(
+        'Injected: not enough replicas available',
+        consistency=ConsistencyLevel.LOCAL_QUORUM, required_replicas=2,
+        alive_replicas=1),
+    'readtimeout': lambda: ReadTimeout(
+        'Injected: replicas timed out',
+        consistency=ConsistencyLevel.LOCAL_QUORUM, required_responses=2,
+        received_responses=1, data_retrieved=False),
+    'writetimeout': lambda: WriteTimeout(
+        'Injected: replicas timed out',
+        consistency=ConsistencyLevel.LOCAL_QUORUM, required_responses=2,
+        received_responses=1, write_type='SIMPLE'),
+    'clienttimeout': lambda: OperationTimedOut(
+        {}, 'Injected: client request timed out'),
+    'nohost': lambda: NoHostAvailable(
+        'Injected: unable to connect to any servers', {})
+}
+
+# Errors the driver retries on the next host for idempotent statements
+RETRYABLE = ('unavailable', 'readtimeout', 'writetimeout')
+
+# Parameters each latency distribution needs, in seconds
+DISTRIBUTIONS = {
+    'fixed': ('delay',),
+    'uniform': ('min', 'max'),
+    'exponential': ('mean',),
+    'lognormal': ('median', 'sigma')
+}
+
+
+class FaultInjector:
+    """
+    Singleton set of fault injection rules
+    """
+
+    lock = threading.Lock()
+    rules = None
+    source = None
+    fileMtime = None
+    checkedAt = 0
+    random = None
+    # Threads running statements that must not be faulted
+    suspended = threading.local()
+
+    def plan(query, profile, operation=None):
+        """
+        Decide the faults of one statement. Returns (delay, error) with the
+        delay in seconds and the error to raise or None, or None if no rule
+        matches.
+
+        :query:
+            Statement about to be run
+        :profile:
+            Name of the execution profile it runs with
+        :operation:
+            Name of the AuthDB operation running it, if any
+        """
+        if getattr(FaultInjector.suspended, 'active', False):
+            return None
+        rules = [rule for rule in FaultInjector.getRules()
+                 if FaultInjector.matches(rule, query, profile, operation)]
+        if len(rules) == 0:
+            return None
+
+        settings = config['executionprofiles'].get(
+            profile, config['executionprofiles']['default'])
+        attempts = 1
+        if getattr(query, 'is_idempotent', False):
+            attempts += settings['retries']
+
+        delay = 0
+        for attempt in range(attempts):
+            error = None
+            for rule in rules:
+                if FaultInjector.random.random() >= rule['rate']:
+                    continue
+                delay += FaultInjector.drawDelay(rule)
+                if error is None:
+                    error = rule['error']
+            if delay >= settings['timeout']:
+                return settings['timeout'], 'clienttimeout'
+            if error in RETRYABLE and attempt < attempts - 1:
+                Metrics.inc('cassandra_retries_total', profile=profile,
+                            reason=error)
+                continue
+            return delay, error
+
+    @contextmanager
+    def suspend():
+        """
+        Run the statements of the current thread without faults, so the
+        admin endpoint keeps working while every statement is failing
+        """
+        FaultInjector.suspended.active = True
+        try:
+            yield
+        finally:
+            FaultInjector.suspended.active = False
+
+    def apply(plan, profile, start):
+        """
+        Wait until the planned delay has passed since start, then raise the
+        planned error, if any
+        """
+        delay, error = plan
+        remaining = start + delay - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        if delay > 0:
+            Metrics.observe('cassandra_injected_delay_seconds', delay,
+                            profile=profile)
+        if error is not None:
+            Metrics.inc('cassandra_injected_faults_total', profile=profile,
+                        fault=error)
+            raise FAULTS[error]()
+
+    def matches(rule, query, profile, operation):
+        if (rule['profiles'] is not None and
+                profile not in rule['profiles']):
+            return False
+        if (rule['operations'] is not None and
+                operation not in rule['operations']):
+            return False
+        return (rule['match'] is None or
+                rule['match'].search(FaultInjector.statementText(query))
+                is not None)
+
+    def statementText(query):
+        """
+        CQL of a statement. Batches are matched as 'BATCH'.
+        """
+        if isinstance(query, str):
+            return query
+        if isinstance(query, BatchStatement):
+            return 'BATCH'
+        if hasattr(query, 'prepared_statement'):
+            return query.prepared_statement.query_string
+        return getattr(query, 'query_string', '')
+
+    def drawDelay(rule):
+        distribution = rule['latency']
+        if distribution is None:
+            return 0
+        if distribution == 'fixed':
+            return rule['delay']
+        if distribution == 'uniform':
+            return FaultInjector.random.uniform(rule['min'], rule['max'])
+        if distribution == 'exponential':
+            return FaultInjector.random.expovariate(1 / rule['mean'])
+        return FaultInjector.random.lognormvariate(math.log(rule['median']),
+                                                   rule['sigma'])
+
+    def getRules():
+        """
+        Current rules, re-reading the rules file if it changed. The file is
+        checked at most once a second.
+        """
+        now = time.time()
+        if FaultInjector.rules is not None and now - \
+                FaultInjector.checkedAt < 1:
+            return FaultInjector.rules
+        with FaultInjector.lock:
+            if FaultInjector.random is None:
+                FaultInjector.random = random.Random(
+                    config['faultinjection']['seed'])
+            FaultInjector.checkedAt = now
+            try:
+                mtime = os.stat(config['faultinjection']['file']).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if FaultInjector.rules is not None and \
+                    mtime == FaultInjector.fileMtime:
+                return FaultInjector.rules
+            FaultInjector.fileMtime = mtime
+            if mtime is None:
+                FaultInjector.setRules(config['faultinjection']['rules'],
+                                       'config')
+            else:
+                try:
+                    with open(config['faultinjection']['file'], 'r') as f:
+                        FaultInjector.setRules(json.load(f), 'file')
+                except (OSError, ValueError) as e:
+                    log.error('Unable to load fault injection rules: %s', e)
+                    if FaultInjector.rules is None:
+                        FaultInjector.setRules([], 'config')
+        return FaultInjector.rules
+
+    def setRules(rules, source):
+        FaultInjector.rules = [FaultInjector.parseRule(rule)
+                               for rule in rules]
+        FaultInjector.source = source
+        log.warning('Injecting faults into Cassandra statements: %d rules ' +
+                    'from %s', len(rules), source)
+
+    def parseRule(rule):
+        """
+        Validate a rule and fill in its defaults. Raises ValueError if the
+        rule is invalid.
+
+        :rule:
+            Dict of the rule settings (see README)
+        """
+        if not isinstance(rule, dict):
+            raise ValueError('Each rule must be an object')
+        unknown = set(rule) - {'match', 'operations', 'profiles', 'rate',
+                               'latency', 'error', 'delay', 'min', 'max',
+                               'mean', 'median', 'sigma'}
+        if unknown:
+            raise ValueError('Unknown rule settings: %s' %
+                             (', '.join(sorted(unknown)),))
+
+        parsed = dict(rule)
+        try:
+            parsed['match'] = re.compile(rule['match']) \
+                if rule.get('match') is not None else None
+        except (re.error, TypeError) as e:
+            raise ValueError('Invalid match "%s": %s' % (rule['match'], e))
+        for key in ('operations', 'profiles'):
+            parsed[key] = rule.get(key)
+            if parsed[key] is not None and not isinstance(parsed[key], list):
+                raise ValueError('%s must be a list' % (key,))
+
+        parsed['rate'] = rule.get('rate', 1.0)
+        if (not isinstance(parsed['rate'], (int, float)) or
+                not 0 <= parsed['rate'] <= 1):
+            raise ValueError('rate must be between 0 and 1')
+
+        parsed['error'] = rule.get('error')
+        if parsed['error'] is not None and parsed['error'] not in FAULTS:
+            raise ValueError('error must be one of %s' %
+                             (', '.join(sorted(FAULTS)),))
+
+        parsed['latency'] = rule.get('latency')
+        if parsed['latency'] is not None:
+            if parsed['latency'] not in DISTRIBUTIONS:
+                raise ValueError('latency must be one of %s' %
+                                 (', '.join(sorted(DISTRIBUTIONS)),))
+            for key in DISTRIBUTIONS[parsed['latency']]:
+                if (not isinstance(rule.get(key), (int, float)) or
+                        rule[key] < 0):
+                    raise ValueError('%s latency needs a %s of 0 or more' %
+                                     (parsed['latency'], key))
+            if parsed['latency'] in ('exponential', 'lognormal') and \
+                    rule.get('mean', rule.get('median')) == 0:
+                raise ValueError('%s latency needs a positive %s' %
+                                 (parsed['latency'],
+                                  DISTRIBUTIONS[parsed['latency']][0]))
+        return parsed
+
+    def saveRules(rules):
+        """
+        Validate rules and write them to the rules file for every worker on
+        the host. Raises ValueError if a rule is invalid.
+        """
+        for rule in rules:
+            FaultInjector.parseRule(rule)
+        path = config['faultinjection']['file']
+        with open(path + '.tmp', 'w') as f:
+            json.dump(rules, f)
+        os.replace(path + '.tmp', path)
+        FaultInjector.checkedAt = 0
+
+    def resetRules():
+        """
+        Remove the rules file, returning every worker to the configured rules
+        """
+        try:
+            os.remove(config['faultinjection']['file'])
+        except FileNotFoundError:
+            pass
+        FaultInjector.checkedAt = 0
+
+    def describeRules():
+        """
+        Current rules in their JSON form
+        """
+        rules = []
+        for rule in FaultInjector.getRules():
+            rule = {key: value for key, value in rule.items()
+                    if value is not None}
+            if 'match' in rule:
+                rule['match'] = rule['match'].pattern
+            rules.append(rule)
+        return rules
+
+
+class FaultyFuture:
+    """
+    Wraps the future of an asynchronous statement so its result is delayed
+    and failed as planned. The statement itself runs right away, so
+    statements in flight together are delayed together. Statements planned
+    to fail are not run and have no future.
+    """
+
+    def __init__(self, future, plan, profile, start):
+        self.future = future
+        self.plan = plan
+        self.profile = profile
+        self.start = start
+
+    def result(self):
+        FaultInjector.apply(self.plan, self.profile, self.start)
+        return self.future.result()
+
+    def __getattr__(self, name):
+        return getattr(self.future, name)
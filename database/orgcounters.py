@@ -0,0 +1,128 @@
+"""
+Write-behind per-org counters
+
+AuthDB records changes to the number of users and stored sessions of each
+org as they happen. The changes are summed in memory and written to the
+authdb.orgcounters counter table by a background flusher thread, one
+counter batch per org, so keeping the counts adds no database round trip to
+the requests that change them. Counter updates are not idempotent, so
+changes from failed writes or crashed workers can make the counts drift;
+tools/reconcileorgcounters.py repairs them.
+"""
+
+import atexit
+import os
+import threading
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('orgcounter_updates_written_total', 'counter',
+                 'Per-org counter batches written to the database')
+Metrics.describe('orgcounter_update_failures_total', 'counter',
+                 'Per-org counter batches that failed to write')
+
+# Counters kept for each org. Sessions are counted from creation until they
+#   are deleted or evicted, expired or not, as nothing removes expired ones.
+COUNTERS = ('users', 'storedsessions')
+
+
+class OrgCounters:
+    """
+    Singleton buffer of counter changes with a write-behind flusher
+    """
+
+    pending = {}
+    condition = threading.Condition()
+    flusher = None
+    pid = None
+
+    def add(org, counter, delta=1):
+        """
+        Queue a change to one of an org's counters
+
+        :org:
+            Name of the organization
+        :counter:
+            One of COUNTERS
+        :delta:
+            Amount to add, negative to subtract
+        """
+        if not config['orgcounters']['enabled'] or delta == 0:
+            return
+        OrgCounters.ensureFlusher()
+        with OrgCounters.condition:
+            changes = OrgCounters.pending.setdefault(org, {})
+            changes[counter] = changes.get(counter, 0) + delta
+
+    def ensureFlusher():
+        """
+        Start the flusher thread if this process doesn't have one. Threads
+        don't survive a fork, so a new one is started in each worker.
+        """
+        if OrgCounters.flusher is None or OrgCounters.pid != os.getpid():
+            with OrgCounters.condition:
+                if (OrgCounters.flusher is None or
+                        OrgCounters.pid != os.getpid()):
+                    OrgCounters.pid = os.getpid()
+                    OrgCounters.pending = {}
+                    OrgCounters.flusher = threading.Thread(
+                        target=OrgCounters.run, name='OrgCountersFlusher',
+                        daemon=True)
+                    OrgCounters.flusher.start()
+
+    def run():
+        """
+        Flusher loop: write the pending changes every flushinterval seconds
+        """
+        while True:
+            with OrgCounters.condition:
+                OrgCounters.condition.wait(
+                    timeout=config['orgcounters']['flushinterval'])
+            try:
+                OrgCounters.flush()
+            except Exception as e:
+                log.error('Error in OrgCounters flusher: %s', e)
+
+    def flush():
+        """
+        Write the pending changes of every org. Changes of orgs whose batch
+        fails are put back to be written with the next flush.
+        """
+        # AuthDB updates the counters, so it can't be imported before it is
+        #   loaded
+        from database.authdb import AuthDB
+
+        with OrgCounters.condition:
+            pending, OrgCounters.pending = OrgCounters.pending, {}
+
+        for org, changes in pending.items():
+            changes = {counter: delta for counter, delta in changes.items()
+                       if delta != 0}
+            if len(changes) == 0:
+                continue
+            try:
+                AuthDB.updateOrgCounters(org, changes)
+                Metrics.inc('orgcounter_updates_written_total')
+            except Exception as e:
+                log.error('Unable to update counters of "%s": %s', org, e)
+                Metrics.inc('orgcounter_update_failures_total')
+                for counter, delta in changes.items():
+                    OrgCounters.add(org, counter, delta)
+
+    def shutdown():
+        """
+        Write whatever is still pending when the process exits
+        """
+        if OrgCounters.pid == os.getpid():
+            try:
+                OrgCounters.flush()
+            except Exception as e:
+                log.error('Error flushing org counters on exit: %s', e)
+
+
+atexit.register(OrgCounters.shutdown)
@@ -0,0 +1,173 @@
+"""
+In-memory org hierarchy
+
+Contains a per-worker copy of the parent links in authdb.orgs with the
+ancestor chain of every org precomputed, so hierarchical checks such as
+inherited settings or admin rights over child orgs need no reads per level.
+"""
+
+import threading
+import time
+from database.circuitbreaker import DatabaseUnavailable
+from logging import getLogger
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+
+class OrgTree:
+    """
+    Singleton org hierarchy.
+
+    The tree is loaded lazily from a paged scan of authdb.orgs and reloaded
+    every 'refreshinterval' seconds to pick up orgs created on other workers
+    or hosts. Orgs created by this worker are added immediately. While one
+    thread reloads the tree, the others keep answering from the previous one.
+    A failed reload keeps the previous tree and is retried after
+    'retryinterval' seconds.
+    """
+
+    lock = threading.Lock()
+    loading = threading.Lock()
+    # Org to parent org
+    parents = {}
+    # Org to the tuple (org, parent, grandparent, ...)
+    chains = {}
+    # Org to the frozenset of its ancestors, excluding itself
+    ancestorSets = {}
+    loadedAt = None
+    # No load is attempted before this time after a failure
+    retryAt = 0
+
+    def ancestors(org, scanOrgs):
+        """
+        Chain of an org and its ancestors, nearest first. Unknown orgs have
+        no ancestors.
+
+        :org:
+            Name of the organization
+        :scanOrgs:
+            Callable returning an iterable of (org, parentorg) rows
+        """
+        OrgTree.refresh(scanOrgs)
+        return OrgTree.chains.get(org, (org,))
+
+    def contains(org, scanOrgs):
+        """
+        Check if an org is in the tree. Orgs created on other workers are
+        only in it after the next refresh.
+
+        :org:
+            Name of the organization
+        :scanOrgs:
+            Callable returning an iterable of (org, parentorg) rows
+        """
+        OrgTree.refresh(scanOrgs)
+        return org in OrgTree.parents
+
+    def isUnder(org, ancestor, scanOrgs):
+        """
+        Check if an org is ancestor or one of its descendants
+
+        :org:
+            Name of the organization to check
+        :ancestor:
+            Name of the possible ancestor
+        :scanOrgs:
+            Callable returning an iterable of (org, parentorg) rows
+        """
+        if org == ancestor:
+            return True
+        OrgTree.refresh(scanOrgs)
+        return ancestor in OrgTree.ancestorSets.get(org, ())
+
+    def refresh(scanOrgs):
+        """
+        Load the tree if it has not been loaded or is older than
+        orgtree.refreshinterval. Only one thread loads at a time; if a tree
+        is already loaded, other threads use it instead of waiting.
+
+        If a load fails, the last tree loaded keeps being used and the load
+        is retried after orgtree.retryinterval. Without a tree, answers would
+        silently lose inherited settings and admin rights, so until one has
+        been loaded DatabaseUnavailable is raised instead.
+        """
+        loadedAt = OrgTree.loadedAt
+        if (loadedAt is not None and time.time() - loadedAt <
+                config['orgtree']['refreshinterval']):
+            return
+        if not OrgTree.loading.acquire(blocking=loadedAt is None):
+            return
+        try:
+            if OrgTree.loadedAt != loadedAt:
+                # Loaded by another thread while waiting
+                return
+            if time.time() < OrgTree.retryAt:
+                if loadedAt is None:
+                    raise DatabaseUnavailable()
+                return
+            try:
+                OrgTree.load(scanOrgs)
+            except Exception as e:
+                OrgTree.retryAt = (time.time() +
+                                   config['orgtree']['retryinterval'])
+                if loadedAt is None:
+                    log.error('Unable to load org tree: %s', e)
+                    if isinstance(e, DatabaseUnavailable):
+                        raise
+                    raise DatabaseUnavailable() from e
+                log.error('Unable to reload org tree, keeping the tree ' +
+                          'loaded %.0fs ago: %s', time.time() - loadedAt, e)
+        finally:
+            OrgTree.loading.release()
+
+    def load(scanOrgs):
+        """
+        Replace the tree with one built from a full scan of the orgs
+        """
+        start = time.time()
+        parents = {row.org: row.parentorg or None for row in scanOrgs()}
+        with OrgTree.lock:
+            OrgTree.build(parents)
+            OrgTree.loadedAt = start
+        log.info('Loaded org tree: %d orgs in %.3fs', len(parents),
+                 time.time() - start)
+
+    def add(org, parentorg):
+        """
+        Record a newly created org in the local tree, if one has been loaded
+        """
+        with OrgTree.lock:
+            if OrgTree.loadedAt is None:
+                return
+            parents = dict(OrgTree.parents)
+            parents[org] = parentorg or None
+            OrgTree.build(parents)
+
+    def build(parents):
+        """
+        Precompute the ancestor chains of every org and swap them in. Must be
+        called with the lock held.
+        """
+        chains = {}
+        ancestorSets = {}
+        for org in parents:
+            chain = OrgTree.chainOf(org, parents)
+            chains[org] = chain
+            ancestorSets[org] = frozenset(chain[1:])
+        OrgTree.parents = parents
+        OrgTree.chains = chains
+        OrgTree.ancestorSets = ancestorSets
+
+    def chainOf(org, parents):
+        chain = [org]
+        parent = parents.get(org)
+        while parent is not None and parent not in chain:
+            chain.append(parent)
+            parent = parents.get(parent)
+        if parent is not None:
+            log.warning('Parent orgs of "%s" form a cycle at "%s"', org,
+                        parent)
+        return tuple(chain)
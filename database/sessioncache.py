@@ -0,0 +1,324 @@
+"""
+Host-local shared session cache
+
+A fixed-size hash table of validated session records in a memory-mapped file
+(by default under /dev/shm), shared by every worker process on the host.
+Readers are lock-free and use a per-slot sequence lock; writers serialize
+on an flock of a companion lock file. Sessions cached by one worker, and
+deletions made by one worker, are visible to every other worker on the next
+lookup.
+"""
+
+import calendar
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from hashlib import blake2b
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('sessioncache_hits_total', 'counter',
+                 'Session key lookups answered by the shared session cache')
+Metrics.describe('sessioncache_misses_total', 'counter',
+                 'Session key lookups not found in the shared session cache')
+
+CachedSession = namedtuple('CachedSession', ['sessionid', 'username', 'org',
+                                             'startdate', 'lastupdate'])
+
+
+class SessionCache:
+    """
+    Singleton view of the shared session cache file.
+
+    Layout: a 64-byte header (magic, version, slot count, slot size, hash
+    salt) followed by fixed 256-byte slots. Each slot starts with a 32-bit
+    sequence number that is odd while the slot is being written. Keys are
+    stored as salted blake2b hashes, never in the clear.
+    """
+
+    MAGIC = b'ASSESSC1'
+    HEADER = struct.Struct('<8sIII16s')
+    HEADER_SIZE = 64
+    SEQ = struct.Struct('<I')
+    SLOT = struct.Struct('<IB16sddd16sB80sB80s')
+    SLOT_SIZE = 256
+
+    EMPTY = 0
+    VALID = 1
+    DELETED = 2
+
+    mm = None
+    fd = None
+    pid = None
+    slots = 0
+    salt = b''
+    lock = threading.Lock()
+
+    def open():
+        """
+        Map the cache file for this process, creating or re-initializing it
+        if its layout doesn't match the configuration. Returns False if the
+        cache is disabled or unavailable.
+        """
+        if not config['sessioncache']['enabled']:
+            return False
+        if SessionCache.pid == os.getpid():
+            return SessionCache.mm is not None
+
+        with SessionCache.lock:
+            if SessionCache.pid == os.getpid():
+                return SessionCache.mm is not None
+            # flock is held per open file, so each process needs its own
+            SessionCache.pid = os.getpid()
+            SessionCache.mm = None
+            try:
+                SessionCache.map(config['sessioncache']['path'],
+                                 config['sessioncache']['slots'])
+            except Exception as e:
+                log.error('Unable to open session cache "%s": %s',
+                          config['sessioncache']['path'], e)
+            return SessionCache.mm is not None
+
+    def map(path, slots):
+        """
+        Map the cache file at path. A file with a different layout is
+        replaced rather than resized, so processes still using it are not
+        affected.
+        """
+        size = SessionCache.HEADER_SIZE + slots * SessionCache.SLOT_SIZE
+        lockFd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(lockFd, fcntl.LOCK_EX)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            header = os.pread(fd, SessionCache.HEADER.size, 0)
+            valid = False
+            if len(header) == SessionCache.HEADER.size:
+                magic, version, fileSlots, slotSize, salt = \
+                    SessionCache.HEADER.unpack(header)
+                valid = (magic == SessionCache.MAGIC and version == 1 and
+                         fileSlots == slots and
+                         slotSize == SessionCache.SLOT_SIZE and
+                         os.fstat(fd).st_size == size)
+            if not valid:
+                log.info('Initializing session cache "%s" (%d slots, %d ' +
+                         'bytes)', path, slots, size)
+                os.close(fd)
+                salt = os.urandom(16)
+                tmpPath = '%s.%d' % (path, os.getpid())
+                fd = os.open(tmpPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                             0o600)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, SessionCache.HEADER.pack(
+                    SessionCache.MAGIC, 1, slots, SessionCache.SLOT_SIZE,
+                    salt), 0)
+                os.replace(tmpPath, path)
+            SessionCache.mm = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                        mmap.PROT_READ | mmap.PROT_WRITE)
+            os.close(fd)
+        finally:
+            fcntl.flock(lockFd, fcntl.LOCK_UN)
+
+        # Writers serialize on the lock file, which is never replaced
+        SessionCache.fd = lockFd
+        SessionCache.slots = slots
+        SessionCache.salt = salt
+
+    def keyHash(sessionKey):
+        return blake2b(sessionKey.encode('utf-8'), digest_size=16,
+                       key=SessionCache.salt).digest()
+
+    def probe(keyHash):
+        """
+        Offsets of the slots a key may occupy
+        """
+        start = int.from_bytes(keyHash[:8], 'little') % SessionCache.slots
+        return [SessionCache.HEADER_SIZE +
+                ((start + i) % SessionCache.slots) * SessionCache.SLOT_SIZE
+                for i in range(config['sessioncache']['probe'])]
+
+    def readSlot(offset):
+        """
+        Read a consistent copy of a slot, retrying while a writer holds it.
+        Returns None if no consistent copy could be read.
+        """
+        mm = SessionCache.mm
+        for attempt in range(100):
+            seq = SessionCache.SEQ.unpack_from(mm, offset)[0]
+            if seq & 1:
+                continue
+            slot = SessionCache.SLOT.unpack_from(mm, offset)
+            if SessionCache.SEQ.unpack_from(mm, offset)[0] == seq:
+                return slot
+        return None
+
+    def get(sessionKey):
+        """
+        Look up a session record by key. Returns a CachedSession, or None if
+        the key is not cached, was deleted or the entry expired.
+
+        :sessionKey:
+            Session key to look up
+        """
+        if not SessionCache.open():
+            return None
+
+        keyHash = SessionCache.keyHash(sessionKey)
+        now = time.time()
+        for offset in SessionCache.probe(keyHash):
+            slot = SessionCache.readSlot(offset)
+            if slot is None or slot[1] == SessionCache.EMPTY:
+                break
+            if slot[2] != keyHash:
+                continue
+            if slot[1] == SessionCache.VALID and slot[3] > now:
+                Metrics.inc('sessioncache_hits_total')
+                return CachedSession(
+                    uuid.UUID(bytes=slot[6]),
+                    slot[8][:slot[7]].decode('utf-8'),
+                    slot[10][:slot[9]].decode('utf-8'),
+                    datetime.utcfromtimestamp(slot[4]),
+                    datetime.utcfromtimestamp(slot[5]))
+            break
+        Metrics.inc('sessioncache_misses_total')
+        return None
+
+    def revoked(sessionKey):
+        """
+        Check if a session key was deleted. Keys are never reused, so a
+        deleted key is invalid without reading it from the database. Only
+        recent deletions are remembered.
+
+        :sessionKey:
+            Session key to look up
+        """
+        if not SessionCache.open():
+            return False
+
+        keyHash = SessionCache.keyHash(sessionKey)
+        for offset in SessionCache.probe(keyHash):
+            slot = SessionCache.readSlot(offset)
+            if slot is None or slot[1] == SessionCache.EMPTY:
+                return False
+            if slot[2] == keyHash:
+                return slot[1] == SessionCache.DELETED
+        return False
+
+    def put(sessionKey, record):
+        """
+        Cache a session record for sessioncache.ttl seconds. A key marked as
+        deleted is never cached again, so a lookup that read the session
+        before a concurrent delete cannot bring it back.
+
+        :sessionKey:
+            Key of the session
+        :record:
+            Session record with sessionid, username, org, startdate and
+            lastupdate attributes
+        """
+        username = record.username.encode('utf-8')
+        org = record.org.encode('utf-8')
+        if (len(username) > 80 or len(org) > 80 or
+                record.startdate is None or record.lastupdate is None):
+            return
+        SessionCache.write(sessionKey, SessionCache.VALID, (
+            time.time() + config['sessioncache']['ttl'],
+            SessionCache.toEpoch(record.startdate),
+            SessionCache.toEpoch(record.lastupdate),
+            record.sessionid.bytes, len(username), username, len(org), org))
+
+    def delete(sessionKey):
+        """
+        Mark a session key as deleted for every worker on the host. The
+        mark is kept for at least sessioncache.ttl seconds before its slot
+        may be reused by another key.
+
+        :sessionKey:
+            Key of the session
+        """
+        SessionCache.write(sessionKey, SessionCache.DELETED,
+                           (time.time() + config['sessioncache']['ttl'],
+                            0.0, 0.0, b'', 0, b'', 0, b''))
+
+    def write(sessionKey, state, fields):
+        if not SessionCache.open():
+            return
+
+        keyHash = SessionCache.keyHash(sessionKey)
+        offsets = SessionCache.probe(keyHash)
+        mm = SessionCache.mm
+        now = time.time()
+
+        with SessionCache.lock:
+            fcntl.flock(SessionCache.fd, fcntl.LOCK_EX)
+            try:
+                # Reuse the key's slot if it has one, else the first free or
+                #   expired slot, else the cached session expiring soonest,
+                #   keeping deletion marks while sessions can be evicted
+                target = None
+                for offset in offsets:
+                    slot = SessionCache.SLOT.unpack_from(mm, offset)
+                    if slot[1] == SessionCache.EMPTY:
+                        target = offset
+                        break
+                    if slot[2] == keyHash:
+                        if (state == SessionCache.VALID and
+                                slot[1] == SessionCache.DELETED):
+                            # Deleted after the caller read the session
+                            return
+                        target = offset
+                        break
+                    if target is None and slot[3] <= now:
+                        target = offset
+                if target is None:
+                    target = min(offsets, key=SessionCache.evictionOrder)
+
+                seq = SessionCache.SEQ.unpack_from(mm, target)[0]
+                if seq & 1:
+                    # A writer died mid-write, the slot contents are garbage
+                    seq += 1
+                SessionCache.SEQ.pack_into(mm, target, (seq + 1) & 0xffffffff)
+                body = SessionCache.SLOT.pack(0, state, keyHash, *fields)
+                mm[target + 4:target + SessionCache.SLOT.size] = body[4:]
+                SessionCache.SEQ.pack_into(mm, target, (seq + 2) & 0xffffffff)
+            finally:
+                fcntl.flock(SessionCache.fd, fcntl.LOCK_UN)
+
+    def evictionOrder(offset):
+        """
+        Sort key of a live slot when one must be evicted: cached sessions
+        before deletion marks, then soonest expiring first
+        """
+        slot = SessionCache.SLOT.unpack_from(SessionCache.mm, offset)
+        return (slot[1] == SessionCache.DELETED, slot[3])
+
+    def toEpoch(dt):
+        return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+    def stats():
+        """
+        Size and occupancy of the cache
+        """
+        if not SessionCache.open():
+            return {'enabled': False}
+        used = 0
+        now = time.time()
+        for i in range(SessionCache.slots):
+            offset = SessionCache.HEADER_SIZE + i * SessionCache.SLOT_SIZE
+            slot = SessionCache.SLOT.unpack_from(SessionCache.mm, offset)
+            if slot[1] == SessionCache.VALID and slot[3] > now:
+                used += 1
+        return {'enabled': True,
+                'slots': SessionCache.slots,
+                'bytes': len(SessionCache.mm),
+                'used': used}
@@ -0,0 +1,249 @@
+"""
+Per-org quotas and fair scheduling of expensive operations
+
+Expensive AuthDB operations (password checks, user creation and the bulk
+listing reads) are wrapped with TenantQuotas.scheduled(). Each org may start
+operations at up to its 'operationsPerSecond' and run up to its
+'maxConcurrentOperations' at once; requests over the rate are rejected with
+QuotaExceeded (429). The operations of all orgs share tenantquotas.slots
+slots per worker. When the slots are busy, callers wait in a weighted fair
+queue: every operation is tagged with a virtual finish time that advances by
+cost / 'schedulingWeight' for its org, and freed slots go to the waiting
+operation with the lowest tag, so an org flooding the queue only delays its
+own operations. Operations that wait longer than tenantquotas.queuetimeout,
+or find their org's queue full, are rejected as well.
+
+Quotas are read from the org's settings (or its nearest ancestor's) through
+the org settings cache, with the tenantquotas defaults for orgs that do not
+set them. Queues and rate limits are kept per worker.
+"""
+
+import threading
+import time
+from collections import deque
+from functools import wraps
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+from werkzeug.exceptions import TooManyRequests
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('tenantquota_queue_depth', 'gauge',
+                 'Operations of an org waiting for a slot')
+Metrics.describe('tenantquota_rejections_total', 'counter',
+                 'Operations rejected by the per-org quotas by reason')
+Metrics.describe('tenantquota_wait_seconds', 'histogram',
+                 'Time operations waited for a slot')
+
+
+class QuotaExceeded(TooManyRequests):
+    description = 'Too many requests for this organization, try again later'
+
+
+class OrgQueue:
+    """
+    Scheduling state of one org
+    """
+
+    def __init__(self, rate):
+        self.running = 0
+        self.concurrency = 1
+        self.waiting = deque()
+        # Virtual finish time of the org's last admitted or queued operation
+        self.finish = 0
+        self.tokens = rate
+        self.refilled = time.monotonic()
+
+    def takeTokens(self, rate, cost):
+        """
+        Take cost tokens from a bucket refilled at rate per second and
+        holding up to a second's worth. Returns False if there are not
+        enough.
+        """
+        now = time.monotonic()
+        capacity = max(rate, cost)
+        self.tokens = min(capacity,
+                          self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def idle(self):
+        return self.running == 0 and len(self.waiting) == 0
+
+
+class Waiter:
+    def __init__(self, tag):
+        self.tag = tag
+        self.admitted = False
+        self.event = threading.Event()
+
+
+class TenantQuotas:
+    """
+    Singleton per-worker scheduler of expensive operations
+    """
+
+    lock = threading.Lock()
+    orgs = {}
+    running = 0
+    # Virtual time: the tag of the last operation given a slot
+    virtualTime = 0
+
+    def scheduled(operation):
+        """
+        Wrapper for AuthDB functions whose first argument is an org, to run
+        them under that org's quotas
+
+        :operation:
+            Name of the operation in tenantquotas.costs
+        """
+        def scheduledWrapper(func):
+            @wraps(func)
+            def func_wrapper(*args, **kwargs):
+                if not config['tenantquotas']['enabled']:
+                    return func(*args, **kwargs)
+                org = args[0] if args else kwargs['org']
+                TenantQuotas.acquire(org, operation)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    TenantQuotas.release(org)
+            return func_wrapper
+        return scheduledWrapper
+
+    def quotasFor(org):
+        """
+        (operations per second or None, concurrent operations, weight) of an
+        org
+        """
+        # AuthDB is scheduled, so it can't be imported before it is loaded
+        from database.authdb import AuthDB
+
+        defaults = config['tenantquotas']
+        quotas = []
+        for setting, default, convert in (
+                ('operationsPerSecond', defaults['ratelimit'], float),
+                ('maxConcurrentOperations', defaults['maxconcurrent'], int),
+                ('schedulingWeight', defaults['weight'], float)):
+            value = AuthDB.getCachedOrgSetting(org, setting, inherit=True)
+            if value is not None:
+                try:
+                    value = convert(value)
+                except ValueError:
+                    log.error('Invalid %s "%s" for "%s"', setting, value, org)
+                    value = None
+            quotas.append(value if value is not None and value > 0
+                          else default)
+        return tuple(quotas)
+
+    def acquire(org, operation):
+        """
+        Wait for a slot for an operation of an org. Raises QuotaExceeded if
+        the org is over its rate, its queue is full or the wait times out.
+        """
+        rate, concurrency, weight = TenantQuotas.quotasFor(org)
+        cost = config['tenantquotas']['costs'].get(operation, 1)
+
+        with TenantQuotas.lock:
+            state = TenantQuotas.orgs.get(org)
+            if state is None:
+                if len(TenantQuotas.orgs) >= 10000:
+                    TenantQuotas.prune()
+                state = TenantQuotas.orgs[org] = OrgQueue(rate or 0)
+            state.concurrency = concurrency
+            startNow = (TenantQuotas.running < config['tenantquotas']['slots']
+                        and state.running < concurrency and
+                        len(state.waiting) == 0)
+            # Check the queue before spending rate budget on an operation
+            #   that would be rejected anyway
+            if (not startNow and
+                    len(state.waiting) >= config['tenantquotas']['maxqueue']):
+                TenantQuotas.reject(org, 'queuefull',
+                                    config['tenantquotas']['queuetimeout'])
+            if rate is not None and not state.takeTokens(rate, cost):
+                TenantQuotas.reject(org, 'rate', max(cost / rate, 1))
+
+            tag = max(TenantQuotas.virtualTime, state.finish) + cost / weight
+            state.finish = tag
+            if startNow:
+                TenantQuotas.start(state, tag)
+                return
+
+            waiter = Waiter(tag)
+            state.waiting.append(waiter)
+            Metrics.set('tenantquota_queue_depth', len(state.waiting),
+                        org=org)
+
+        start = time.perf_counter()
+        waiter.event.wait(config['tenantquotas']['queuetimeout'])
+        with TenantQuotas.lock:
+            if not waiter.admitted:
+                state.waiting.remove(waiter)
+                Metrics.set('tenantquota_queue_depth', len(state.waiting),
+                            org=org)
+                TenantQuotas.reject(org, 'timeout',
+                                    config['tenantquotas']['queuetimeout'])
+        Metrics.observe('tenantquota_wait_seconds',
+                        time.perf_counter() - start, operation=operation)
+
+    def release(org):
+        """
+        Free the slot of a finished operation and hand it to the next
+        waiting operation
+        """
+        with TenantQuotas.lock:
+            state = TenantQuotas.orgs[org]
+            state.running -= 1
+            TenantQuotas.running -= 1
+            TenantQuotas.dispatch()
+
+    def start(state, tag):
+        """
+        Give an operation a slot. Must be called with the lock held.
+        """
+        state.running += 1
+        TenantQuotas.running += 1
+        TenantQuotas.virtualTime = max(TenantQuotas.virtualTime, tag)
+
+    def dispatch():
+        """
+        Fill free slots with the waiting operations with the lowest tags of
+        the orgs under their concurrency. Must be called with the lock held.
+        """
+        while TenantQuotas.running < config['tenantquotas']['slots']:
+            best = None
+            for org, state in TenantQuotas.orgs.items():
+                if (state.waiting and state.running < state.concurrency and
+                        (best is None or state.waiting[0].tag <
+                         TenantQuotas.orgs[best].waiting[0].tag)):
+                    best = org
+            if best is None:
+                return
+            state = TenantQuotas.orgs[best]
+            waiter = state.waiting.popleft()
+            Metrics.set('tenantquota_queue_depth', len(state.waiting),
+                        org=best)
+            TenantQuotas.start(state, waiter.tag)
+            waiter.admitted = True
+            waiter.event.set()
+
+    def reject(org, reason, retryAfter):
+        """
+        Count and raise a rejection. Must be called with the lock held.
+        """
+        Metrics.inc('tenantquota_rejections_total', org=org, reason=reason)
+        raise QuotaExceeded(retry_after=max(int(retryAfter + 0.5), 1))
+
+    def prune():
+        """
+        Forget the state of idle orgs. Must be called with the lock held.
+        """
+        TenantQuotas.orgs = {org: state
+                             for org, state in TenantQuotas.orgs.items()
+                             if not state.idle()}
@@ -0,0 +1,260 @@
+"""
+Negative lookup filters for usernames
+
+Contains a Bloom filter implementation and a per-org registry of filters used
+to answer "does this user exist?" without a Cassandra read when the answer is
+definitely "no".
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+from logging import getLogger
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings. Uses double hashing of a single
+    128-bit blake2b digest to derive the bit positions.
+    """
+
+    def __init__(self, capacity, falsePositiveRate):
+        """
+        :capacity:
+            Number of items the filter is sized for
+        :falsePositiveRate:
+            Target false positive rate at capacity
+        """
+        self.capacity = max(int(capacity), 1)
+        self.numBits = BloomFilter.bitsFor(self.capacity, falsePositiveRate)
+        self.numHashes = max(1, int(round(
+            (self.numBits / self.capacity) * math.log(2))))
+        self.bits = bytearray((self.numBits + 7) // 8)
+        self.count = 0
+
+    def bitsFor(capacity, falsePositiveRate):
+        """
+        Number of bits needed to hold capacity items at the given false
+        positive rate.
+        """
+        return max(8, int(math.ceil(-capacity * math.log(falsePositiveRate) /
+                                    (math.log(2) ** 2))))
+
+    def _positions(self, item):
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.numBits for i in range(self.numHashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def sizeBytes(self):
+        return len(self.bits)
+
+
+class OrgUserFilter:
+    """
+    Bloom filter of the usernames in a single org, along with the bookkeeping
+    needed to keep it in sync with the users created on other workers.
+    """
+
+    def __init__(self, org, usernames, falsePositiveRate, scannedAt):
+        """
+        :scannedAt:
+            Time the scan of usernames started. Users created after it are
+            read from the creation log.
+        """
+        self.org = org
+        usernames = list(usernames)
+        self.bloom = BloomFilter(max(len(usernames) * 2, 1024),
+                                 falsePositiveRate)
+        for username in usernames:
+            self.bloom.add(username)
+        self.builtAt = scannedAt
+        self.syncedAt = scannedAt
+        self.syncing = False
+
+    def needsRebuild(self, now):
+        return (now - self.builtAt > config['userfilter']['rebuildinterval'] or
+                now - self.syncedAt > config['userfilter']['maxsyncgap'] or
+                self.bloom.count > self.bloom.capacity)
+
+
+class UserFilter:
+    """
+    Singleton registry of per-org username filters.
+
+    Filters are built in the background on first lookup for an org from a
+    paged scan of the org's usernames; until one is built, lookups for the
+    org fall back to the database. Only orgs that exist get a filter, and at
+    most 'maxbuilds' filters are built at once. Users created on other
+    workers or hosts are picked up from the authdb.usercreations log every
+    'syncinterval' seconds, and the whole filter is rebuilt in the
+    background every 'rebuildinterval' seconds while the old one keeps being
+    used.
+    """
+
+    lock = threading.Lock()
+    filters = OrderedDict()
+    # Orgs whose filter is being built
+    building = set()
+    # Org to the time a failed build may be retried
+    retryAt = {}
+
+    def mightExist(org, username, scanUsernames, getCreations, orgExists):
+        """
+        Returns False if the user definitely does not exist, True if it might.
+        Users of orgs that do not exist definitely do not exist.
+
+        :org:
+            Name of organization for user
+        :username:
+            Name of the user
+        :scanUsernames:
+            Callable returning an iterable of all usernames in an org
+        :getCreations:
+            Callable returning the usernames created in an org during a
+            creation log bucket
+        :orgExists:
+            Callable checking if an org exists, consulted before building a
+            filter for an org
+        """
+        with UserFilter.lock:
+            known = org in UserFilter.filters or org in UserFilter.building
+        if not known and not orgExists(org):
+            return False
+        orgFilter = UserFilter.getFilter(org, scanUsernames, getCreations)
+        if orgFilter is None:
+            return True
+        return username in orgFilter.bloom
+
+    def getFilter(org, scanUsernames, getCreations):
+        """
+        Get the filter for an org, starting a build or syncing it as needed.
+        Returns None if no filter has been built yet. The org must exist.
+        """
+        now = time.time()
+        sync = False
+        with UserFilter.lock:
+            orgFilter = UserFilter.filters.get(org)
+            if orgFilter is not None:
+                UserFilter.filters.move_to_end(org)
+            if ((orgFilter is None or orgFilter.needsRebuild(now)) and
+                    org not in UserFilter.building and
+                    len(UserFilter.building) <
+                    config['userfilter']['maxbuilds'] and
+                    UserFilter.retryAt.get(org, 0) <= now):
+                UserFilter.building.add(org)
+                threading.Thread(target=UserFilter.build,
+                                 args=(org, scanUsernames, getCreations),
+                                 daemon=True).start()
+            elif (orgFilter is not None and not orgFilter.syncing and
+                    now - orgFilter.syncedAt >
+                    config['userfilter']['syncinterval']):
+                orgFilter.syncing = sync = True
+
+        if sync:
+            try:
+                UserFilter.sync(orgFilter, getCreations, now)
+            except Exception as e:
+                log.error('Unable to sync user filter for "%s": %s', org, e)
+            finally:
+                orgFilter.syncing = False
+        return orgFilter
+
+    def build(org, scanUsernames, getCreations):
+        """
+        Build the filter for an org from a full scan of its usernames, catch
+        up with the users created during the scan and swap it in. Runs in
+        its own thread.
+        """
+        start = time.time()
+        try:
+            orgFilter = OrgUserFilter(
+                org, scanUsernames(org),
+                config['userfilter']['falsepositiverate'], start)
+            UserFilter.sync(orgFilter, getCreations, time.time())
+        except Exception as e:
+            log.error('Unable to build user filter for "%s": %s', org, e)
+            with UserFilter.lock:
+                UserFilter.building.discard(org)
+                UserFilter.retryAt[org] = \
+                    time.time() + config['userfilter']['retryinterval']
+            return
+
+        with UserFilter.lock:
+            UserFilter.building.discard(org)
+            UserFilter.retryAt.pop(org, None)
+            UserFilter.filters[org] = orgFilter
+            while len(UserFilter.filters) > config['userfilter']['maxorgs']:
+                UserFilter.filters.popitem(last=False)
+        log.info('Built user filter for "%s": %d users, %d bytes in %.3fs',
+                 org, orgFilter.bloom.count, orgFilter.bloom.sizeBytes(),
+                 time.time() - start)
+
+    def sync(orgFilter, getCreations, now):
+        """
+        Add the users created since the filter was last synced. The previous
+        bucket is always re-read to cover clock skew between hosts.
+        """
+        firstBucket = UserFilter.creationBucket(orgFilter.syncedAt) - 1
+        usernames = []
+        for bucket in range(firstBucket, UserFilter.creationBucket(now) + 1):
+            usernames.extend(getCreations(orgFilter.org, bucket))
+        with UserFilter.lock:
+            for username in usernames:
+                orgFilter.bloom.add(username)
+            orgFilter.syncedAt = now
+
+    def add(org, username):
+        """
+        Record a newly created user in the local filter for its org, if one
+        has been built.
+        """
+        with UserFilter.lock:
+            orgFilter = UserFilter.filters.get(org)
+            if orgFilter is not None:
+                orgFilter.bloom.add(username)
+
+    def creationBucket(timestamp=None):
+        """
+        Minute bucket of the authdb.usercreations log for a timestamp.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        return int(timestamp // 60)
+
+    def memoryPerMillion(falsePositiveRate=None):
+        """
+        Bytes of filter memory needed per million users at the configured
+        (or given) false positive rate. Filters are sized at twice the
+        current user count, so a built filter uses up to double this.
+        """
+        if falsePositiveRate is None:
+            falsePositiveRate = config['userfilter']['falsepositiverate']
+        return (BloomFilter.bitsFor(1000000, falsePositiveRate) + 7) // 8
+
+    def stats():
+        """
+        Per-org filter sizes, for reporting.
+        """
+        with UserFilter.lock:
+            return {org: {'users': f.bloom.count,
+                          'capacity': f.bloom.capacity,
+                          'bytes': f.bloom.sizeBytes(),
+                          'builtAt': f.builtAt}
+                    for org, f in UserFilter.filters.items()}
@@ -0,0 +1,213 @@
+"""
+Non-blocking, rate limited logging
+
+Request threads only put log records on an in-memory queue; a listener
+thread formats them and writes them to the logger's original handlers, so
+file and stream I/O never happens on a request. Messages are passed as a
+template and arguments and are only formatted by the listener, so messages
+that are filtered out or dropped are never formatted at all.
+
+Each message template may be logged logging.ratelimit times a second, with
+bursts of up to logging.burst. Messages over the limit are dropped and
+counted, and the next message of that template that is logged says how many
+were suppressed, so a flood of one error (e.g. during an attack or an
+outage) can't crowd the disk or the other messages out.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from metrics import Metrics
+from settings import Settings
+
+config = Settings.getConfig()
+
+# Logger all of the application's modules log to
+LOGGER = 'gunicorn.error'
+
+Metrics.describe('log_messages_suppressed_total', 'counter',
+                 'Log messages dropped by the per-message rate limit')
+Metrics.describe('log_messages_dropped_total', 'counter',
+                 'Log messages dropped because the log queue was full')
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per logger and message template
+    """
+
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # (logger, template) to [tokens, last refill, suppressed]
+        self.buckets = {}
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.CRITICAL:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= 10000:
+                    # Templates built from values would grow this forever
+                    self.buckets.clear()
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst,
+                            bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                suppressed = True
+            else:
+                bucket[0] -= 1
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+                suppressed = False
+        if suppressed:
+            Metrics.inc('log_messages_suppressed_total',
+                        level=record.levelname.lower())
+            return False
+        return True
+
+
+class SuppressedCountFormatter(logging.Formatter):
+    """
+    Wraps a formatter to note how many messages like a record were
+    suppressed before it
+    """
+
+    def __init__(self, formatter):
+        super().__init__()
+        self.formatter = formatter or logging.Formatter()
+
+    def format(self, record):
+        message = self.formatter.format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += ' (%d similar messages suppressed)' % (suppressed,)
+        return message
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record. The template is kept alongside the
+    formatted message so similar messages can be grouped.
+    """
+
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'pid': record.process,
+                 'thread': record.threadName,
+                 'message': record.getMessage(),
+                 'template': str(record.msg)}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that drops records when the queue is full instead of
+    blocking or printing errors, and leaves formatting to the listener
+    """
+
+    def prepare(self, record):
+        # Tracebacks are rendered by the listener from exc_info, which stays
+        #   valid as the queue is in-process
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            Metrics.inc('log_messages_dropped_total')
+
+
+class QueueLogging:
+    """
+    Singleton that moves the handlers of the application's logger behind a
+    queue and a listener thread
+    """
+
+    lock = threading.Lock()
+    # Logger the handlers were taken from and the handlers
+    owner = None
+    handlers = None
+    listener = None
+    pid = None
+
+    def install():
+        """
+        Rate limit the application's logger, set the format of its handlers
+        and, if logging.queue is set, write its records from a listener
+        thread. The handlers are taken from the logger, or from the root
+        logger when it has none of its own (as in scripts that use
+        logging.basicConfig()). Cheap to call again; a listener is started
+        in each process.
+        """
+        if QueueLogging.pid == os.getpid():
+            return
+        with QueueLogging.lock:
+            if QueueLogging.pid == os.getpid():
+                return
+            logger = logging.getLogger(LOGGER)
+            if QueueLogging.pid is None:
+                logger.addFilter(RateLimitFilter(
+                    config['logging']['ratelimit'],
+                    config['logging']['burst']))
+            QueueLogging.pid = os.getpid()
+
+            if QueueLogging.handlers is None:
+                owner = logger if logger.handlers else logging.getLogger()
+                if len(owner.handlers) == 0:
+                    return
+                QueueLogging.owner = owner
+                QueueLogging.handlers = list(owner.handlers)
+                for handler in QueueLogging.handlers:
+                    if config['logging']['format'] == 'json':
+                        handler.setFormatter(JsonFormatter())
+                    else:
+                        handler.setFormatter(
+                            SuppressedCountFormatter(handler.formatter))
+            if not config['logging']['queue']:
+                return
+
+            # Keep the handlers on a logger nothing logs to, so gunicorn
+            #   still finds and reopens their files on SIGUSR1
+            holder = logging.getLogger(LOGGER + '.queued')
+            holder.propagate = False
+            holder.disabled = True
+            holder.handlers = QueueLogging.handlers
+
+            # A forked process inherits the handlers but not the listener
+            #   thread, so it gets a queue and listener of its own
+            logQueue = queue.Queue(config['logging']['maxqueue'])
+            QueueLogging.owner.handlers = [NonBlockingQueueHandler(logQueue)]
+            QueueLogging.listener = QueueListener(
+                logQueue, *QueueLogging.handlers, respect_handler_level=True)
+            QueueLogging.listener.start()
+
+    def shutdown():
+        """
+        Write the queued records before the process exits
+        """
+        if QueueLogging.listener is not None and \
+                QueueLogging.pid == os.getpid():
+            QueueLogging.listener.stop()
+            QueueLogging.listener = None
+
+
+atexit.register(QueueLogging.shutdown)
@@ -0,0 +1,285 @@
+"""
+Process metrics
+
+Counters and gauges recorded by the API and exported in the Prometheus text
+format. When metrics.directory is set, each worker process periodically
+writes its values to that directory and the export aggregates every worker's
+file, so any worker can answer for the whole host. The files of workers
+that have exited are folded into one file of their counters, so their counts
+are kept while their gauges stop being reported.
+"""
+
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from logging import getLogger
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+
+class Metrics:
+    """
+    Singleton registry of process metrics
+    """
+
+    prefix = 'authservices_'
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+    lock = threading.Lock()
+    descriptions = {}
+    counters = {}
+    gauges = {}
+    lastDump = 0
+
+    def describe(name, kind, helpText):
+        """
+        Register the type and help text of a metric
+
+        :name:
+            Metric name, without the common prefix
+        :kind:
+            Prometheus metric type ('counter', 'gauge' or 'histogram')
+        :helpText:
+            Description of the metric
+        """
+        Metrics.descriptions[name] = (kind, helpText)
+
+    def inc(name, value=1, **labels):
+        """
+        Increment a counter
+
+        :name:
+            Metric name, without the common prefix
+        :value:
+            Amount to increment by
+        :labels:
+            Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + value
+        Metrics.maybeDump()
+
+    def set(name, value, **labels):
+        """
+        Set a gauge
+
+        :name:
+            Metric name, without the common prefix
+        :value:
+            Current value
+        :labels:
+            Label values of the series
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with Metrics.lock:
+            Metrics.gauges[key] = value
+        Metrics.maybeDump()
+
+    def observe(name, value, **labels):
+        """
+        Record an observation in a histogram with the default buckets. The
+        buckets, sum and count are kept as counters, so they aggregate
+        across workers like any other counter.
+
+        :name:
+            Metric name, without the common prefix
+        :value:
+            Observed value, e.g. a duration in seconds
+        :labels:
+            Label values of the series
+        """
+        base = tuple(sorted(labels.items()))
+        with Metrics.lock:
+            for bound in Metrics.buckets + (float('inf'),):
+                key = (name + '_bucket', tuple(sorted(
+                    base + (('le', Metrics.formatBound(bound)),))))
+                Metrics.counters[key] = (Metrics.counters.get(key, 0) +
+                                         (1 if value <= bound else 0))
+            for suffix, amount in (('_sum', value), ('_count', 1)):
+                key = (name + suffix, base)
+                Metrics.counters[key] = Metrics.counters.get(key, 0) + amount
+        Metrics.maybeDump()
+
+    def formatBound(bound):
+        return '+Inf' if bound == float('inf') else repr(float(bound))
+
+    def snapshot():
+        with Metrics.lock:
+            return {'counters': [[n, list(map(list, l)), v]
+                                 for (n, l), v in Metrics.counters.items()],
+                    'gauges': [[n, list(map(list, l)), v]
+                               for (n, l), v in Metrics.gauges.items()]}
+
+    def maybeDump():
+        if (config['metrics']['directory'] is not None and
+                time.time() - Metrics.lastDump >
+                config['metrics']['dumpinterval']):
+            Metrics.dump()
+
+    def dump():
+        """
+        Write this process's metrics to the shared metrics directory
+        """
+        Metrics.lastDump = time.time()
+        path = os.path.join(config['metrics']['directory'],
+                            'metrics-%d.json' % (os.getpid(),))
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(Metrics.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            log.error('Unable to write metrics to "%s": %s', path, e)
+
+    def collect():
+        """
+        Collect the metrics of every worker. Counters are summed across
+        workers and gauges are reported per worker with a 'pid' label.
+        """
+        snapshots = {os.getpid(): Metrics.snapshot()}
+        if config['metrics']['directory'] is not None:
+            Metrics.dump()
+            for path in glob.glob(os.path.join(config['metrics']['directory'],
+                                               'metrics-*.json')):
+                try:
+                    pid = int(os.path.basename(path)[8:-5])
+                    if pid in snapshots:
+                        continue
+                    if not Metrics.processAlive(pid):
+                        Metrics.retire(path)
+                        continue
+                    with open(path, 'r') as f:
+                        snapshots[pid] = json.load(f)
+                except Exception as e:
+                    log.error('Unable to read metrics from "%s": %s', path, e)
+            exited = Metrics.exitedPath()
+            if os.path.isfile(exited):
+                try:
+                    with open(exited, 'r') as f:
+                        # Counters only, there is no process to label gauges
+                        #   with
+                        snapshots[None] = {'counters': json.load(f),
+                                           'gauges': []}
+                except Exception as e:
+                    log.error('Unable to read metrics from "%s": %s', exited,
+                              e)
+
+        counters = {}
+        gauges = {}
+        for pid, snapshot in snapshots.items():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                labels = labels + [['pid', pid]]
+                key = (name, tuple(sorted(map(tuple, labels))))
+                gauges[key] = value
+        return counters, gauges
+
+    def exitedPath():
+        """
+        File holding the summed counters of workers that have exited
+        """
+        return os.path.join(config['metrics']['directory'],
+                            'exited-metrics.json')
+
+    def retire(path):
+        """
+        Add the counters of an exited worker's metrics file to the exited
+        workers' file and remove it. The file is claimed by renaming it
+        first, so it is only counted once when workers collect at the same
+        time.
+        """
+        claimed = '%s.%d' % (path, os.getpid())
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed, 'r') as f:
+            counters = json.load(f)['counters']
+
+        exited = Metrics.exitedPath()
+        with open(exited + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            totals = {}
+            if os.path.isfile(exited):
+                with open(exited, 'r') as f:
+                    totals = {(name, tuple(map(tuple, labels))): value
+                              for name, labels, value in json.load(f)}
+            for name, labels, value in counters:
+                key = (name, tuple(map(tuple, labels)))
+                totals[key] = totals.get(key, 0) + value
+            with open(exited + '.tmp', 'w') as f:
+                json.dump([[name, list(map(list, labels)), value]
+                           for (name, labels), value in totals.items()], f)
+            os.replace(exited + '.tmp', exited)
+        os.remove(claimed)
+
+    def processAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def render():
+        """
+        Render every worker's metrics in the Prometheus text format
+        """
+        counters, gauges = Metrics.collect()
+        lines = []
+        for series in (counters, gauges):
+            lastName = None
+            for (name, labels), value in sorted(series.items(),
+                                                key=Metrics.sortKey):
+                family = Metrics.family(name)
+                if family != lastName:
+                    if family in Metrics.descriptions:
+                        kind, helpText = Metrics.descriptions[family]
+                        lines.append('# HELP %s%s %s' %
+                                     (Metrics.prefix, family, helpText))
+                        lines.append('# TYPE %s%s %s' %
+                                     (Metrics.prefix, family, kind))
+                    lastName = family
+                lines.append('%s%s%s %s' % (Metrics.prefix, name,
+                                            Metrics.formatLabels(labels),
+                                            value))
+        return '\n'.join(lines) + '\n'
+
+    def family(name):
+        """
+        Name of the metric a series belongs to: histogram series are named
+        after their histogram with a _bucket, _sum or _count suffix.
+        """
+        for suffix in ('_bucket', '_sum', '_count'):
+            base = name[:-len(suffix)]
+            if (name.endswith(suffix) and
+                    Metrics.descriptions.get(base, ('',))[0] == 'histogram'):
+                return base
+        return name
+
+    def sortKey(item):
+        """
+        Order series by metric, then labels, with histogram buckets in
+        increasing order
+        """
+        (name, labels), value = item
+        family = Metrics.family(name)
+        bound = float(dict(labels).get('le', 0))
+        return (family, str([label for label in labels if label[0] != 'le']),
+                name != family + '_bucket', bound, name)
+
+    def formatLabels(labels):
+        if len(labels) == 0:
+            return ''
+        return '{%s}' % (','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels),)
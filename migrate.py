@@ -0,0 +1,74 @@
+"""
+Schema migration and bootstrap entry point
+
+Creates the auth keyspace if needed, runs pending baseline and migration
+scripts, records the resulting schema version and creates the default org.
+Run once per deploy, before restarting the API workers:
+
+    python migrate.py
+
+Use --dry-run to report the pending changes without making them.
+"""
+
+import argparse
+import logging
+import sys
+from database.authdb import AuthDB
+from settings import Settings
+
+log = logging.getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+
+def bootstrap():
+    log.info("Initializing database.")
+
+    AuthDB.setupDB()
+    AuthDB.createDefaultOrg(config['defaultorg']['name'],
+                            config['defaultorg']['defaultadminuser'],
+                            config['defaultorg']['defaultadminemail'])
+
+    log.info("Database initialization complete.")
+
+
+def report(plan):
+    """
+    Print a migration plan from AuthDB.migrationPlan()
+    """
+    print('Keyspace:          %s%s' %
+          (plan['keyspace'],
+           '' if plan['keyspaceexists'] else ' (will be created)'))
+    print('Schema version:    %s -> %s' %
+          (plan['currentversion'], plan['expectedversion']))
+    print('Baseline tables:   %s' %
+          (', '.join(plan['baselines']) if plan['baselines'] else 'none'))
+    print('Pending scripts:   %d' % (len(plan['migrations']),))
+    for migration in plan['migrations']:
+        print('')
+        print('-- %s (%d statements)%s' %
+              (migration['script'], len(migration['statements']),
+               ', last failed: %s' % (migration['lasterror'],)
+               if migration['lasterror'] else ''))
+        for statement in migration['statements']:
+            print(statement + ';')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Migrate the database schema')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report pending changes without making them')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+
+    try:
+        if args.dry_run:
+            report(AuthDB.migrationPlan())
+        else:
+            bootstrap()
+    except Exception as e:
+        log.critical('Migration failed: %s', e)
+        sys.exit(1)
@@ -0,0 +1,191 @@
+"""
+Per-request profiling
+
+When profiling.enabled is set, a sampled fraction of requests (and any
+request carrying an admin's session key in the profiling header) runs under
+cProfile. Each profile is written as a pstats file to a directory per
+endpoint, where it can be opened with pstats, snakeviz or flameprof, or
+aggregated through the /admin/profiles endpoints. When profiling is
+disabled no request hooks are installed.
+"""
+
+import cProfile
+import glob
+import os
+import pstats
+import random
+import re
+import tempfile
+import time
+from database.authdb import AuthDB
+from database.sessioncache import SessionCache
+from flask import g, request
+from logging import getLogger
+from metrics import Metrics
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('profiles_written_total', 'counter',
+                 'Request profiles written to the profile directory')
+
+# Length of the session keys issued by AuthDB.createUserSessionKey()
+SESSION_KEY_LENGTH = 64
+
+
+class Profiler:
+    """
+    Singleton managing request profiles
+    """
+
+    def install(app):
+        """
+        Register the request hooks on a Flask app if profiling is enabled
+        """
+        if not config['profiling']['enabled']:
+            return False
+        app.before_request(Profiler.start)
+        app.teardown_request(Profiler.stop)
+        log.info('Profiling %.2f%% of requests to "%s"',
+                 config['profiling']['samplerate'] * 100,
+                 config['profiling']['directory'])
+        return True
+
+    def start():
+        if not Profiler.wanted():
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return
+        g.profile = profile
+        g.profileStart = time.perf_counter()
+
+    def wanted():
+        """
+        Whether the current request should be profiled: sampled at
+        profiling.samplerate, or requested by an admin of the default org
+        passing their session key in the profiling header. The header is
+        only honoured for keys in the shared session cache, so it never adds
+        a session read to a request.
+        """
+        if random.random() < config['profiling']['samplerate']:
+            return True
+        key = request.headers.get(config['profiling']['header'])
+        if key is None:
+            return False
+        return Profiler.privileged(key)
+
+    def privileged(sessionKey):
+        if len(sessionKey) != SESSION_KEY_LENGTH:
+            return False
+        cached = SessionCache.get(sessionKey)
+        if cached is None:
+            return False
+        try:
+            return AuthDB.isOrgAdmin(config['defaultorg']['name'],
+                                     cached.username, cached.org)
+        except Exception as e:
+            log.error('Unable to check profiling privileges: %s', e)
+            return False
+
+    def stop(exc=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        duration = time.perf_counter() - g.pop('profileStart')
+        try:
+            Profiler.write(profile, request.endpoint or 'unknown', duration)
+        except Exception as e:
+            log.error('Unable to write request profile: %s', e)
+
+    def endpointDirectory(endpoint):
+        return os.path.join(config['profiling']['directory'],
+                            re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint))
+
+    def write(profile, endpoint, duration):
+        """
+        Write a request profile, named by its duration in milliseconds, and
+        prune the oldest profiles past profiling.maxprofilesperendpoint.
+        """
+        directory = Profiler.endpointDirectory(endpoint)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, '%.3f-%d-%d.prof' %
+                            (duration * 1000, time.time(), os.getpid()))
+        profile.dump_stats(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        Metrics.inc('profiles_written_total', endpoint=endpoint)
+
+        paths = glob.glob(os.path.join(directory, '*.prof'))
+        excess = len(paths) - config['profiling']['maxprofilesperendpoint']
+        if excess > 0:
+            for old in sorted(paths, key=os.path.getmtime)[:excess]:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def endpoints():
+        """
+        Summarize the profiles written for each endpoint
+        """
+        endpoints = []
+        if not os.path.isdir(config['profiling']['directory']):
+            return endpoints
+        for name in sorted(os.listdir(config['profiling']['directory'])):
+            durations = [float(os.path.basename(path).split('-')[0])
+                         for path in Profiler.profiles(name)]
+            if durations:
+                endpoints.append({'endpoint': name,
+                                  'profiles': len(durations),
+                                  'maxms': max(durations),
+                                  'meanms': sum(durations) / len(durations)})
+        return endpoints
+
+    def profiles(endpoint):
+        return glob.glob(os.path.join(Profiler.endpointDirectory(endpoint),
+                                      '*.prof'))
+
+    def aggregate(endpoint):
+        """
+        Combine every profile of an endpoint. Returns a pstats.Stats, or
+        None if there are no profiles.
+        """
+        stats = None
+        for path in Profiler.profiles(endpoint):
+            try:
+                if stats is None:
+                    stats = pstats.Stats(path)
+                else:
+                    stats.add(path)
+            except Exception as e:
+                # Pruned by another worker since it was listed
+                log.debug('Skipping profile "%s": %s', path, e)
+        return stats
+
+    def summarize(stats, sort, limit):
+        """
+        The top functions of a pstats.Stats as a list of dicts
+        """
+        column = {'cumulative': 3, 'tottime': 2, 'calls': 1}[sort]
+        rows = sorted(stats.stats.items(), key=lambda i: i[1][column],
+                      reverse=True)[:limit]
+        return [{'function': pstats.func_std_string(func),
+                 'primitivecalls': cc,
+                 'calls': nc,
+                 'tottime': tt,
+                 'cumtime': ct}
+                for func, (cc, nc, tt, ct, callers) in rows]
+
+    def dump(stats):
+        """
+        Serialize a pstats.Stats in the marshalled pstats format
+        """
+        with tempfile.NamedTemporaryFile(suffix='.prof') as f:
+            stats.dump_stats(f.name)
+            return f.read()
@@ -0,0 +1,73 @@
+"""
+JSON output representation for the API
+
+Replaces flask_restful's default application/json representation, which
+serializes with json.dumps and builds the response through
+flask.make_response. Responses are encoded with orjson when it is installed
+(an optional dependency) or a preconfigured json encoder otherwise, and the
+Response is built directly. The encoder is chosen by
+responses.jsonencoder. In debug mode flask_restful's indented output is
+kept.
+"""
+
+import json
+from flask import Response, current_app
+from flask_restful.representations.json import output_json as restfulJson
+from logging import getLogger
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Same output as flask_restful's json.dumps() call, without building an
+#   encoder per call
+jsonEncoder = json.JSONEncoder()
+
+
+def encodeStdlib(data):
+    return (jsonEncoder.encode(data) + '\n').encode('utf-8')
+
+
+def encodeOrjson(data):
+    return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def chooseEncoder(name):
+    """
+    Encoder function for a responses.jsonencoder setting
+
+    :name:
+        'auto' for orjson if it is installed and json otherwise, 'orjson' or
+        'json'
+    """
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        if orjson is None:
+            log.warning('responses.jsonencoder is "orjson" but orjson is ' +
+                        'not installed, using json')
+            return encodeStdlib
+        return encodeOrjson
+    if name not in ('auto', 'json'):
+        raise ValueError('Unknown responses.jsonencoder "%s"' % (name,))
+    return encodeStdlib
+
+
+encode = chooseEncoder(config['responses']['jsonencoder'])
+
+
+def outputJson(data, code, headers=None):
+    """
+    Make a Flask response with a JSON encoded body
+    """
+    if current_app.debug:
+        return restfulJson(data, code, headers)
+    response = Response(encode(data), status=code,
+                        mimetype='application/json')
+    if headers:
+        response.headers.extend(headers)
+    return response
@@ -10,17 +10,274 @@ class Settings:
     loaded = False
 
     config = {
+        'capture': {
+            'enabled': False,
+            'file': '/var/tmp/authservicesapi-capture-%(pid)s.jsonl',
+            'samplerate': 1.0,
+            'secret': None,
+            'maxbytes': 1073741824
+        },
         'cassandra': {
             'cluster': 'AuthServices',
             'nodes': ['127.0.0.1'],
             'port': '9042',
             'auth_keyspace': 'authdb'
         },
+        'executionprofiles': {
+            'default': {
+                'timeout': 10.0,
+                'retries': 0,
+                'speculativedelay': None,
+                'speculativeattempts': 0,
+                'consistency': 'LOCAL_ONE',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            },
+            'hot_read': {
+                'timeout': 2.0,
+                'retries': 1,
+                'speculativedelay': 0.05,
+                'speculativeattempts': 2,
+                'consistency': 'LOCAL_ONE',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': 'auth_read',
+                'fallbackrate': 50
+            },
+            'cached_read': {
+                'timeout': 2.0,
+                'retries': 1,
+                'speculativedelay': 0.05,
+                'speculativeattempts': 2,
+                'consistency': 'LOCAL_ONE',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            },
+            'auth_read': {
+                'timeout': 5.0,
+                'retries': 1,
+                'speculativedelay': None,
+                'speculativeattempts': 0,
+                'consistency': 'LOCAL_QUORUM',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            },
+            'auth_write': {
+                'timeout': 10.0,
+                'retries': 0,
+                'speculativedelay': None,
+                'speculativeattempts': 0,
+                'consistency': 'LOCAL_QUORUM',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            },
+            'admin': {
+                'timeout': 10.0,
+                'retries': 0,
+                'speculativedelay': None,
+                'speculativeattempts': 0,
+                'consistency': 'QUORUM',
+                'serialconsistency': 'SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            },
+            'export': {
+                'timeout': 60.0,
+                'retries': 2,
+                'speculativedelay': None,
+                'speculativeattempts': 0,
+                'consistency': 'LOCAL_QUORUM',
+                'serialconsistency': 'LOCAL_SERIAL',
+                'emptyfallback': None,
+                'fallbackrate': None
+            }
+        },
+        'operationprofiles': {
+            'createDefaultOrg': 'admin',
+            'createOrg': 'admin',
+            'createPasswordReset': 'auth_write',
+            'createUser': 'auth_write',
+            'createUserSession': 'auth_write',
+            'createUserSessionKey': 'auth_write',
+            'deletePasswordReset': 'auth_write',
+            'deleteUserSession': 'auth_write',
+            'deleteUserSessionByKey': 'auth_write',
+            'getGlobalSetting': 'auth_read',
+            'getOrg': 'hot_read',
+            'getOrgAuthEvents': 'auth_read',
+            'getOrgCounters': 'auth_read',
+            'getOrgSetting': 'cached_read',
+            'getOrgUsernames': 'export',
+            'getOrgUsersPage': 'auth_read',
+            'getPasswordReset': 'auth_read',
+            'getUser': 'hot_read',
+            'getUserAncestry': 'hot_read',
+            'getUserAuthEvents': 'auth_read',
+            'getUserChildrenPage': 'auth_read',
+            'getUserCreations': 'auth_read',
+            'getUserHash': 'hot_read',
+            'getUserSalt': 'hot_read',
+            'getUserSession': 'hot_read',
+            'getUserSessionByKey': 'hot_read',
+            'getUserSessions': 'auth_read',
+            'indexUser': 'auth_write',
+            'indexUserChild': 'auth_write',
+            'scanOrgs': 'export',
+            'setGlobalSetting': 'admin',
+            'setOrgSetting': 'admin',
+            'setPassword': 'auth_write',
+            'setUserAncestry': 'auth_write',
+            'updateOrgCounters': 'auth_write',
+            'validateSessionKeys': 'hot_read',
+            'writeAuthEvents': 'auth_write'
+        },
+        'circuitbreaker': {
+            'enabled': True,
+            'window': 10,
+            'minrequests': 20,
+            'failureratio': 0.5,
+            'opentime': 5
+        },
+        'faultinjection': {
+            'enabled': False,
+            'file': '/dev/shm/authservicesapi-faults.json',
+            'seed': None,
+            'rules': []
+        },
         'defaultorg': {
             'name': 'example.net',
             'defaultadminuser': 'admin',
             'defaultadminpass': 'admin',
             'defaultadminemail': 'admin@example.net'
+        },
+        'profiling': {
+            'enabled': False,
+            'samplerate': 0.001,
+            'header': 'X-Profile-Key',
+            'directory': '/var/tmp/authservicesapi-profiles',
+            'maxprofilesperendpoint': 100
+        },
+        'schema': {
+            'migrateonboot': False,
+            'recheckinterval': 5,
+            'agreementtimeout': 30
+        },
+        'users': {
+            'readtable': 'users',
+            'writetables': ['users'],
+            'indexbuckets': 64,
+            'indexbackfilled': False,
+            'childrenpagesize': 100,
+            'maxchildrenpagesize': 1000
+        },
+        'orgs': {
+            'defaultpagesize': 100,
+            'maxpagesize': 1000,
+            'maxbucketsperpage': 16
+        },
+        'orgcounters': {
+            'enabled': True,
+            'flushinterval': 1.0
+        },
+        'orgtree': {
+            'refreshinterval': 60,
+            'retryinterval': 5,
+            'scanpagesize': 5000
+        },
+        'sessions': {
+            'maxperuser': 100,
+            'evictionbatchsize': 100,
+            'maxvalidatebatch': 100
+        },
+        'tenantquotas': {
+            'enabled': False,
+            'slots': 8,
+            'maxconcurrent': 4,
+            'ratelimit': None,
+            'weight': 1.0,
+            'maxqueue': 32,
+            'queuetimeout': 2.0,
+            'costs': {
+                'createUser': 2,
+                'getOrgAuthEvents': 1,
+                'getOrgUsersPage': 1,
+                'getUserChildrenPage': 1,
+                'validatePassword': 1
+            }
+        },
+        'responses': {
+            'jsonencoder': 'auto'
+        },
+        'batch': {
+            'maxrequests': 20,
+            'maxworkers': 8
+        },
+        'orgsettings': {
+            'cachettl': 60,
+            'cachesize': 10000,
+            'adminsttl': 5
+        },
+        'logging': {
+            'queue': True,
+            'maxqueue': 10000,
+            'format': 'text',
+            'ratelimit': 10,
+            'burst': 100
+        },
+        'metrics': {
+            'directory': None,
+            'dumpinterval': 5
+        },
+        'eventlog': {
+            'enabled': True,
+            'maxqueue': 10000,
+            'policy': 'drop',
+            'blocktimeout': 0.05,
+            'batchsize': 100,
+            'flushinterval': 1.0,
+            'spillfile': '/var/tmp/authservicesapi-events-%(pid)s.jsonl',
+            'maxspillbytes': 104857600,
+            'spillretryinterval': 30,
+            'maxqueryrange': 2678400,
+            'maxorgqueryrange': 604800,
+            'querylimit': 1000,
+            'orgbuckets': 8,
+            'orghourwindow': 4
+        },
+        'sessioncache': {
+            'enabled': True,
+            'path': '/dev/shm/authservicesapi-sessions',
+            'slots': 65536,
+            'probe': 8,
+            'ttl': 30
+        },
+        'usercache': {
+            'ttl': 30,
+            'size': 100000,
+            'maxage': 30,
+            'ancestryttl': 3600,
+            'ancestrysize': 100000,
+            'ancestrymaxdepth': 64
+        },
+        'userfilter': {
+            'enabled': True,
+            'falsepositiverate': 0.01,
+            'syncinterval': 2,
+            'maxsyncgap': 1800,
+            'rebuildinterval': 3600,
+            'maxorgs': 1024,
+            'scanpagesize': 5000,
+            'retryinterval': 60,
+            'maxbuilds': 2
+        },
+        'validationsocket': {
+            'path': '/run/authservicesapi/validate.sock',
+            'mode': '0660',
+            'threads': 8,
+            'maxinflight': 1024
         }
     }
 
@@ -0,0 +1,170 @@
+"""
+Backfill the usersbyname table, orgusers index, userchildren index and
+userancestors table from the users table
+
+Part of the online migration away from the wide (org) partitions of
+authdb.users:
+
+ 1. Run the 0002/0003 schema migrations and add 'usersbyname' to
+    users.writetables so new writes go to both tables. From then on, user
+    creation runs its lightweight transaction on usersbyname, and until
+    step 3 also reads users to catch users not yet backfilled.
+ 2. Run this tool. Rows are copied with the write time of the original cells,
+    so anything written by the dual writes in the meantime wins.
+ 3. Set users.indexbackfilled to true and users.readtable to 'usersbyname'.
+ 4. Once reads are verified, remove 'users' from users.writetables.
+
+Usage (from the repository root):
+    python -m tools.backfillusers [--checkpoint FILE] [--pagesize N]
+"""
+
+import argparse
+import logging
+import os
+from cassandra import ConsistencyLevel
+from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.query import SimpleStatement
+from database.authdb import AuthDB
+from database.cassandra import CassandraCluster
+
+log = logging.getLogger('gunicorn.error')
+
+
+def loadCheckpoint(path):
+    if path is not None and os.path.isfile(path):
+        with open(path, 'r') as f:
+            state = f.read().strip()
+            if state:
+                return bytes.fromhex(state)
+    return None
+
+
+def saveCheckpoint(path, pagingState):
+    if path is not None:
+        with open(path + '.tmp', 'w') as f:
+            f.write(pagingState.hex() if pagingState is not None else '')
+        os.replace(path + '.tmp', path)
+
+
+def backfill(pageSize=1000, concurrency=32, checkpoint=None):
+    """
+    Copy every row of authdb.users into authdb.usersbyname and
+    authdb.orgusers, index users with a parent in authdb.userchildren and
+    record each user's chain of ancestors in authdb.userancestors, one page
+    at a time.
+
+    :pageSize:
+        Rows read from authdb.users per page
+    :concurrency:
+        Writes in flight at once
+    :checkpoint:
+        File used to save the scan position after each page, so an
+        interrupted backfill can resume where it left off
+    """
+    session = CassandraCluster.getSession(AuthDB.keyspace)
+
+    scanQuery = SimpleStatement(
+        """
+        SELECT org, username, email, parentuser, createdate, salt, hash,
+            writetime(createdate) AS rowtime, writetime(hash) AS hashtime
+        FROM users
+        """, fetch_size=pageSize,
+        consistency_level=ConsistencyLevel.LOCAL_QUORUM)
+    copyUserQuery = CassandraCluster.getPreparedStatement(
+        """
+        INSERT INTO usersbyname ( org, username, email, parentuser,
+            createdate )
+        VALUES ( ?, ?, ?, ?, ? )
+        USING TIMESTAMP ?
+        """, keyspace=session.keyspace)
+    copyPasswordQuery = CassandraCluster.getPreparedStatement(
+        """
+        UPDATE usersbyname USING TIMESTAMP ? SET
+        hash = ?,
+        salt = ?
+        WHERE org = ?
+        AND username = ?
+        """, keyspace=session.keyspace)
+    indexUserQuery = CassandraCluster.getPreparedStatement(
+        """
+        INSERT INTO orgusers ( org, bucket, username )
+        VALUES ( ?, ?, ? )
+        """, keyspace=session.keyspace)
+    indexUserChildQuery = CassandraCluster.getPreparedStatement(
+        """
+        INSERT INTO userchildren ( parentorg, parentusername, org, username )
+        VALUES ( ?, ?, ?, ? )
+        """, keyspace=session.keyspace)
+    ancestryQuery = CassandraCluster.getPreparedStatement(
+        """
+        INSERT INTO userancestors ( org, username, ancestors )
+        VALUES ( ?, ?, ? )
+        """, keyspace=session.keyspace)
+
+    pagingState = loadCheckpoint(checkpoint)
+    if pagingState is not None:
+        log.info('Resuming backfill from checkpoint "%s"', checkpoint)
+
+    copied = 0
+    while True:
+        results = session.execute(scanQuery, paging_state=pagingState)
+        rows = results.current_rows
+
+        userArgs = [(r.org, r.username, r.email, r.parentuser, r.createdate,
+                     r.rowtime) for r in rows if r.rowtime is not None]
+        passwordArgs = [(r.hashtime, r.hash, r.salt, r.org, r.username)
+                        for r in rows if r.hashtime is not None]
+        indexArgs = [(r.org, AuthDB.userIndexBucket(r.username), r.username)
+                     for r in rows]
+        childArgs = [tuple(reversed(r.parentuser.split('@', 1))) +
+                     (r.org, r.username)
+                     for r in rows
+                     if r.parentuser is not None and '@' in r.parentuser]
+        # Users without a parent have no ancestors; the chains of the others
+        # are resolved (and recorded) through their parents, sharing the
+        # chains of common ancestors through the ancestry cache.
+        ancestryArgs = [(r.org, r.username, [])
+                        for r in rows
+                        if r.parentuser is None or '@' not in r.parentuser]
+        for r in rows:
+            if r.parentuser is not None and '@' in r.parentuser:
+                AuthDB.getUserAncestors(r.org, r.username)
+
+        for query, args in ((copyUserQuery, userArgs),
+                            (copyPasswordQuery, passwordArgs),
+                            (indexUserQuery, indexArgs),
+                            (indexUserChildQuery, childArgs),
+                            (ancestryQuery, ancestryArgs)):
+            for success, result in execute_concurrent_with_args(
+                    session, query, args, concurrency=concurrency,
+                    raise_on_first_error=False):
+                if not success:
+                    raise result
+
+        copied += len(rows)
+        pagingState = results.paging_state
+        saveCheckpoint(checkpoint, pagingState)
+        log.info('Backfilled %d users', copied)
+
+        if pagingState is None:
+            break
+
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Backfill usersbyname, orgusers, userchildren and ' +
+        'userancestors from users')
+    parser.add_argument('--pagesize', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--checkpoint', default=None,
+                        help='File to save and resume the scan position')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+
+    total = backfill(pageSize=args.pagesize, concurrency=args.concurrency,
+                     checkpoint=args.checkpoint)
+    log.info('Backfill complete: %d users copied', total)
@@ -0,0 +1,70 @@
+"""
+Compare one POST /batch with the same requests made one at a time
+
+Sends `--requests` GET requests for a user to a running service, first
+sequentially (a new connection per request, as most clients do) and then as
+a single batch, and reports the time per request of each.
+
+Usage (from the repository root):
+    python -m tools.benchbatch --url http://localhost:8000 \\
+        --user bob@example.net [--requests N] [--rounds N]
+"""
+
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+
+
+def call(url, method='GET', body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark POST /batch against sequential requests')
+    parser.add_argument('--url', required=True,
+                        help='Base URL of the service')
+    parser.add_argument('--user', required=True,
+                        help='Existing user to fetch, as user@org')
+    parser.add_argument('--requests', type=int, default=10,
+                        help='Requests per round (default 10)')
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    base = args.url.rstrip('/')
+    path = '/users/%s' % (args.user,)
+    batch = {'requests': [{'id': str(i), 'path': path}
+                          for i in range(args.requests)]}
+
+    status, body = call(base + '/batch', 'POST', batch)
+    if status != 200:
+        raise SystemExit('POST /batch failed with %d: %s' % (status, body))
+
+    start = time.perf_counter()
+    for r in range(args.rounds):
+        for i in range(args.requests):
+            call(base + path)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for r in range(args.rounds):
+        call(base + '/batch', 'POST', batch)
+    batched = time.perf_counter() - start
+
+    total = args.rounds * args.requests
+    print('requests:           %d x %d' % (args.rounds, args.requests))
+    print('sequential:         %.2f ms per request' %
+          (sequential / total * 1e3,))
+    print('batched:            %.2f ms per request' %
+          (batched / total * 1e3,))
+    print('saved per request:  %.2f ms' % ((sequential - batched) / total *
+                                           1e3,))
@@ -0,0 +1,115 @@
+"""
+Measure the per-request CPU cost of argument parsing and JSON output
+
+For a few cheap endpoints, times parsing the request arguments with a
+parser built for the request (as the resources used to) against the
+resource's prebuilt parser, and encoding a typical response with
+flask_restful's default JSON representation against
+representations.outputJson. Runs in-process on synthetic requests; does not
+touch the database.
+
+Usage (from the repository root):
+    python -m tools.benchrequests [--iterations N]
+"""
+
+import argparse
+import time
+import uuid
+from apis.sessions import Session, Sessions, SessionsValidate
+from apis.users import CompletePasswordReset, Users
+from flask import Flask
+from flask_restful import reqparse
+from flask_restful.representations.json import output_json
+from representations import outputJson
+
+KEY = '%064x' % (uuid.uuid4().int,)
+SESSION = {'username': 'benchuser', 'org': 'example.net',
+           'sessionid': str(uuid.uuid4()),
+           'startdate': '2024-01-01 00:00:00.000000',
+           'lastupdate': '2024-01-01 00:00:00.000000'}
+
+# (name, parser, request context arguments, response body)
+CASES = [
+    ('GET /sessions/<user>@<org>/current', Session.keyParser,
+     {'path': '/sessions/benchuser@example.net/current',
+      'query_string': {'key': KEY}},
+     {'message': 'Information for session None', 'session': SESSION}),
+    ('DELETE /sessions/<user>@<org>/current', Session.keyParser,
+     {'path': '/sessions/benchuser@example.net/current', 'method': 'DELETE',
+      'query_string': {'key': KEY}},
+     {'message': 'Session deleted'}),
+    ('GET /sessions/<user>@<org>', Sessions.getParser,
+     {'path': '/sessions/benchuser@example.net',
+      'query_string': {'key': KEY}},
+     {'message': 'Found 10 sessions for benchuser@example.net',
+      'sessions': [{'sessionid': SESSION['sessionid'],
+                    'startdate': SESSION['startdate'],
+                    'lastupdate': SESSION['lastupdate']}] * 10}),
+    ('POST /sessions/validate', SessionsValidate.postParser,
+     {'path': '/sessions/validate', 'method': 'POST',
+      'json': {'keys': [KEY] * 10}},
+     {'results': [[True, 'benchuser', 'example.net']] * 10}),
+    ('POST /users', Users.postParser,
+     {'path': '/users', 'method': 'POST',
+      'json': {'username': 'benchuser', 'org': 'example.net',
+               'email': 'benchuser@example.net'}},
+     {'message': 'User "benchuser"@"example.net" created'}),
+    ('POST .../completepasswordreset', CompletePasswordReset.postParser,
+     {'path': '/users/benchuser@example.net/completepasswordreset',
+      'method': 'POST',
+      'json': {'resetid': str(uuid.uuid4()), 'password': KEY}},
+     {'message': 'Password updated for "benchuser"@"example.net".'})
+]
+
+
+def rebuild(parser):
+    """
+    Build a parser with the same arguments, as the resources did on every
+    request
+    """
+    fresh = reqparse.RequestParser()
+    for argument in parser.args:
+        fresh.add_argument(**vars(argument))
+    return fresh
+
+
+def cpuTime(func, iterations):
+    """
+    CPU seconds per call of func
+    """
+    start = time.process_time()
+    for i in range(iterations):
+        func()
+    return (time.process_time() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark request parsing and JSON output')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    totals = [0, 0]
+    print('%-40s %10s %10s %10s %10s' %
+          ('endpoint (us CPU per request)', 'parse', 'prebuilt', 'json',
+           'fast json'))
+    for name, argParser, context, body in CASES:
+        with app.test_request_context(**context):
+            if rebuild(argParser).parse_args() != argParser.parse_args():
+                raise SystemExit('Rebuilt parser for %s differs' % (name,))
+            times = [cpuTime(lambda: rebuild(argParser).parse_args(),
+                             args.iterations),
+                     cpuTime(argParser.parse_args, args.iterations),
+                     cpuTime(lambda: output_json(body, 200),
+                             args.iterations),
+                     cpuTime(lambda: outputJson(body, 200),
+                             args.iterations)]
+        totals[0] += times[0] + times[2]
+        totals[1] += times[1] + times[3]
+        print('%-40s %10.2f %10.2f %10.2f %10.2f' %
+              ((name,) + tuple(t * 1e6 for t in times)))
+
+    print('saved per request:  %.2f us CPU (%.0f%% of parsing and output)' %
+          ((totals[0] - totals[1]) / len(CASES) * 1e6,
+           (totals[0] - totals[1]) / totals[0] * 100))
@@ -0,0 +1,64 @@
+"""
+Measure the footprint and lookup cost of the shared session cache
+
+Fills a scratch cache file with synthetic sessions and times hits, misses
+and writes. Does not touch the configured cache or the database.
+
+Usage (from the repository root):
+    python -m tools.benchsessioncache [--slots N] [--entries N] [--lookups N]
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import uuid
+from database.sessioncache import CachedSession, SessionCache
+from settings import Settings
+
+config = Settings.getConfig()
+
+
+def timeit(func, count):
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the shared session cache')
+    parser.add_argument('--slots', type=int,
+                        default=config['sessioncache']['slots'])
+    parser.add_argument('--entries', type=int, default=None,
+                        help='Sessions to cache (default: half the slots)')
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+    entries = args.entries if args.entries is not None else args.slots // 2
+
+    path = os.path.join(tempfile.mkdtemp(), 'sessioncache')
+    config['sessioncache'].update(enabled=True, path=path, slots=args.slots)
+
+    now = datetime.datetime.utcnow()
+    record = CachedSession(uuid.uuid4(), 'benchuser', 'example.net', now, now)
+    keys = ['%064d' % (i,) for i in range(entries)]
+
+    writeCost = timeit(lambda i: SessionCache.put(keys[i], record), entries)
+    hitCost = timeit(lambda i: SessionCache.get(keys[i % entries]),
+                     args.lookups)
+    missCost = timeit(lambda i: SessionCache.get('missing%d' % (i,)),
+                      args.lookups)
+    stats = SessionCache.stats()
+
+    print('slots:        %d' % (stats['slots'],))
+    print('bytes:        %d' % (stats['bytes'],))
+    print('cached:       %d of %d' % (stats['used'], entries))
+    print('write:        %.2f us' % (writeCost,))
+    print('lookup hit:   %.2f us' % (hitCost,))
+    print('lookup miss:  %.2f us' % (missCost,))
+
+    os.remove(path)
+    os.remove(path + '.lock')
+    os.rmdir(os.path.dirname(path))
@@ -0,0 +1,81 @@
+"""
+Measure session key validation over the validation socket
+
+Starts a validation server on a scratch socket and session cache filled
+with synthetic sessions, then times cache hits one request at a time and
+pipelined. Does not touch the configured socket, cache or the database.
+
+Usage (from the repository root):
+    python -m tools.benchvalidationsocket [--requests N] [--pipeline N]
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from database.sessioncache import CachedSession, SessionCache
+from settings import Settings
+from validationserver import ValidationClient, startServer
+
+config = Settings.getConfig()
+
+
+def runServer(path, ready):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(startServer(path, ThreadPoolExecutor(1)))
+    ready.set()
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the validation socket')
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=100000)
+    parser.add_argument('--pipeline', type=int, default=100,
+                        help='Requests in flight when pipelining')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    config['sessioncache'].update(
+        enabled=True, path=os.path.join(directory, 'sessioncache'),
+        slots=args.sessions * 4)
+    path = os.path.join(directory, 'validate.sock')
+
+    now = datetime.datetime.now()
+    record = CachedSession(uuid.uuid4(), 'benchuser', 'example.net', now, now)
+    keys = ['%064d' % (i,) for i in range(args.sessions)]
+    for key in keys:
+        SessionCache.put(key, record)
+
+    ready = threading.Event()
+    threading.Thread(target=runServer, args=(path, ready),
+                     daemon=True).start()
+    ready.wait()
+
+    with ValidationClient(path) as client:
+        if not client.validate(keys[0])[0]:
+            raise SystemExit('Cached session did not validate')
+
+        start = time.perf_counter()
+        for i in range(args.requests):
+            client.validate(keys[i % args.sessions])
+        single = (time.perf_counter() - start) / args.requests * 1e6
+
+        batches = max(args.requests // args.pipeline, 1)
+        start = time.perf_counter()
+        for i in range(batches):
+            client.validateMany(
+                [keys[(i * args.pipeline + j) % args.sessions]
+                 for j in range(args.pipeline)])
+        pipelined = ((time.perf_counter() - start) /
+                     (batches * args.pipeline) * 1e6)
+
+    print('round trip (hit):   %.2f us' % (single,))
+    print('pipelined (hit):    %.2f us per key, %d in flight' %
+          (pipelined, args.pipeline))
@@ -0,0 +1,315 @@
+"""
+Export tables of the auth keyspace in parallel token ranges
+
+Splits the token ring into --splits ranges and scans them with up to
+--concurrency ranges in flight, so export throughput grows with the ranges
+in flight until the cluster or client is saturated. Each range is streamed
+page by page into its own part file, gzipped JSONL or Parquet, so rows are
+never held in memory beyond a page. Completed ranges are recorded in a
+checkpoint file and skipped when the export is run again, so an interrupted
+export resumes where it left off. Part files are written under a temporary
+name and only renamed once their range is complete.
+
+Parquet output needs pyarrow, which is not otherwise required.
+
+Exports include password hashes and session keys; protect them accordingly.
+
+Usage (from the repository root):
+    python -m tools.export --output DIR [--tables users,usersessions,...] \\
+        [--format jsonl|parquet] [--splits N] [--concurrency N] \\
+        [--pagesize N]
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database.authdb import AuthDB
+from database.cassandra import CassandraCluster, ProfiledSession
+
+log = logging.getLogger('gunicorn.error')
+
+# Token bounds of the Murmur3 partitioner. No key hashes to MIN_TOKEN, so
+# ranges of the form (start, end] starting at it cover the whole ring.
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+
+def tokenRanges(splits):
+    """
+    Split the ring into splits (start, end] ranges of equal width
+    """
+    step = (MAX_TOKEN - MIN_TOKEN) // splits
+    bounds = [MIN_TOKEN + i * step for i in range(splits)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def jsonValue(value):
+    """
+    JSON form of the Cassandra values json does not handle
+    """
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    return str(value)
+
+
+class JsonlWriter:
+    """
+    Writes rows as gzipped JSON lines
+    """
+
+    extension = '.jsonl.gz'
+
+    def __init__(self, path, columns):
+        self.file = gzip.open(path, 'wt', encoding='utf-8')
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row._asdict(), default=jsonValue) +
+                            '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes rows as a Parquet file, one row group per page
+    """
+
+    extension = '.parquet'
+
+    # Arrow types of the CQL types stored natively; anything else is
+    #   written as a string
+    TYPES = {'ascii': 'string', 'text': 'string', 'varchar': 'string',
+             'int': 'int32', 'bigint': 'int64', 'counter': 'int64',
+             'boolean': 'bool', 'double': 'float64', 'float': 'float32'}
+
+    def __init__(self, path, columns):
+        # Only Parquet exports need pyarrow
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        fields = []
+        self.native = {}
+        for column in columns:
+            if column.cql_type in ParquetWriter.TYPES:
+                arrowType = getattr(pyarrow,
+                                    ParquetWriter.TYPES[column.cql_type])()
+            elif column.cql_type == 'timestamp':
+                arrowType = pyarrow.timestamp('ms')
+            elif column.cql_type in ('list<text>', 'set<text>'):
+                arrowType = pyarrow.list_(pyarrow.string())
+            else:
+                arrowType = pyarrow.string()
+            self.native[column.name] = not pyarrow.types.is_string(arrowType)
+            fields.append(pyarrow.field(column.name, arrowType))
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema,
+                                                    compression='zstd')
+
+    def write(self, rows):
+        if len(rows) == 0:
+            return
+        records = []
+        for row in rows:
+            record = row._asdict()
+            for name, native in self.native.items():
+                value = record.get(name)
+                if native and isinstance(value, (set, frozenset, tuple)):
+                    record[name] = list(value)
+                elif not native and value is not None and \
+                        not isinstance(value, str):
+                    record[name] = jsonValue(value)
+            records.append(record)
+        self.writer.write_batch(self.pyarrow.RecordBatch.from_pylist(
+            records, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'jsonl': JsonlWriter, 'parquet': ParquetWriter}
+
+
+class Checkpoint:
+    """
+    Completed ranges of each table, saved after every range
+    """
+
+    def __init__(self, path, splits, outputFormat):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'splits': splits, 'format': outputFormat, 'done': {}}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if (state['splits'] != splits or
+                    state['format'] != outputFormat):
+                raise SystemExit(
+                    'Checkpoint "%s" is for %d %s splits, remove it to ' %
+                    (path, state['splits'], state['format']) +
+                    'start over')
+            self.state = state
+
+    def done(self, table):
+        return {int(i): rows
+                for i, rows in self.state['done'].get(table, {}).items()}
+
+    def complete(self, table, index, rows):
+        with self.lock:
+            self.state['done'].setdefault(table, {})[str(index)] = rows
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+def exportRange(session, query, writerClass, columns, path, tokenRange,
+                pageSize):
+    """
+    Stream one token range of a table into a part file. Returns the number
+    of rows written.
+    """
+    bound = query.bind(tokenRange)
+    bound.fetch_size = pageSize
+    writer = writerClass(path + '.tmp', columns)
+    rows = 0
+    try:
+        results = session.execute(bound)
+        while True:
+            writer.write(results.current_rows)
+            rows += len(results.current_rows)
+            if not results.has_more_pages:
+                break
+            results.fetch_next_page()
+    finally:
+        writer.close()
+    os.replace(path + '.tmp', path)
+    return rows
+
+
+def exportTable(session, table, output, writerClass, checkpoint, executor,
+                ranges, pageSize):
+    """
+    Export every range of a table not already in the checkpoint, then write
+    the table's manifest. Returns the number of rows exported by this run.
+    Exits once every range has been tried if any of them failed.
+    """
+    metadata = session.cluster.metadata.keyspaces[session.keyspace]
+    if table not in metadata.tables:
+        raise SystemExit('No table "%s" in keyspace "%s"' %
+                         (table, session.keyspace))
+    tableMetadata = metadata.tables[table]
+    columns = list(tableMetadata.columns.values())
+    partitionKey = ', '.join(c.name for c in tableMetadata.partition_key)
+    query = CassandraCluster.getPreparedStatement(
+        """
+        SELECT * FROM %s
+        WHERE token(%s) > ?
+        AND token(%s) <= ?
+        """ % (table, partitionKey, partitionKey), keyspace=session.keyspace)
+
+    directory = os.path.join(output, table)
+    os.makedirs(directory, exist_ok=True)
+    done = checkpoint.done(table)
+    if done:
+        log.info('%s: resuming, %d of %d ranges already exported', table,
+                 len(done), len(ranges))
+
+    start = time.time()
+    futures = {}
+    for index, tokenRange in enumerate(ranges):
+        if index in done:
+            continue
+        path = os.path.join(directory, 'part-%05d%s' %
+                            (index, writerClass.extension))
+        futures[executor.submit(exportRange, session, query, writerClass,
+                                columns, path, tokenRange,
+                                pageSize)] = index
+
+    exported = 0
+    failed = 0
+    for future in as_completed(futures):
+        index = futures[future]
+        try:
+            rows = future.result()
+        except Exception as e:
+            # Keep recording the other ranges so a rerun only repeats this
+            log.error('%s: range %d failed: %s', table, index, e)
+            failed += 1
+            continue
+        checkpoint.complete(table, index, rows)
+        done[index] = rows
+        exported += rows
+        elapsed = time.time() - start
+        log.info('%s: %d/%d ranges, %d rows, %.0f rows/s', table, len(done),
+                 len(ranges), exported, exported / elapsed if elapsed else 0)
+
+    if failed > 0:
+        raise SystemExit('%s: %d ranges failed, run again to resume' %
+                         (table, failed))
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump({'table': table,
+                   'keyspace': session.keyspace,
+                   'format': checkpoint.state['format'],
+                   'columns': [{'name': c.name, 'type': c.cql_type}
+                               for c in columns],
+                   'parts': len(ranges),
+                   'rows': sum(done.values())}, f, indent=2)
+    return exported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export auth keyspace tables in parallel token ranges')
+    parser.add_argument('--output', required=True,
+                        help='Directory to write a subdirectory per table to')
+    parser.add_argument('--tables', default='users,usersessions,orgsettings',
+                        help='Comma separated tables to export ' +
+                        '(default users,usersessions,orgsettings)')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('--splits', type=int, default=256,
+                        help='Token ranges per table (default 256)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Ranges scanned at once (default 16)')
+    parser.add_argument('--pagesize', type=int, default=5000)
+    parser.add_argument('--checkpoint', default=None,
+                        help='Checkpoint file ' +
+                        '(default OUTPUT/checkpoint.json)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = Checkpoint(
+        args.checkpoint or os.path.join(args.output, 'checkpoint.json'),
+        args.splits, args.format)
+    session = ProfiledSession(CassandraCluster.getSession(AuthDB.keyspace),
+                              'export')
+    ranges = tokenRanges(args.splits)
+
+    start = time.time()
+    total = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for table in args.tables.split(','):
+            total += exportTable(session, table.strip(), args.output,
+                                 WRITERS[args.format], checkpoint, executor,
+                                 ranges, args.pagesize)
+    elapsed = time.time() - start
+    log.info('Export complete: %d rows in %.1fs (%.0f rows/s)', total, elapsed,
+             total / elapsed if elapsed else 0)
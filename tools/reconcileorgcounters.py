@@ -0,0 +1,128 @@
+"""
+Repair drift in the per-org user and stored session counters
+
+Counts the users (in users.readtable) and sessions (in usersessions) of
+every org with a parallel token range scan, compares them with the
+authdb.orgcounters table and adds the difference to each counter that is
+off. Users and sessions created or deleted while the scan runs can leave a
+small difference behind, so run it when traffic is low or run it twice.
+
+Usage (from the repository root):
+    python -m tools.reconcileorgcounters [--dry-run] [--splits N] \\
+        [--concurrency N] [--pagesize N]
+"""
+
+import argparse
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database.authdb import AuthDB
+from database.cassandra import CassandraCluster, ProfiledSession
+from database.orgcounters import COUNTERS
+from settings import Settings
+from tools.export import tokenRanges
+
+log = logging.getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+
+def countRange(session, query, tokenRange, pageSize):
+    counts = Counter()
+    bound = query.bind(tokenRange)
+    bound.fetch_size = pageSize
+    for row in session.execute(bound):
+        counts[row.org] += 1
+    return counts
+
+
+def countByOrg(session, table, executor, ranges, pageSize):
+    """
+    Number of rows of a table per org
+    """
+    tableMetadata = \
+        session.cluster.metadata.keyspaces[session.keyspace].tables[table]
+    partitionKey = ', '.join(c.name for c in tableMetadata.partition_key)
+    query = CassandraCluster.getPreparedStatement(
+        """
+        SELECT org FROM %s
+        WHERE token(%s) > ?
+        AND token(%s) <= ?
+        """ % (table, partitionKey, partitionKey), keyspace=session.keyspace)
+
+    counts = Counter()
+    for future in as_completed([executor.submit(countRange, session, query,
+                                                tokenRange, pageSize)
+                                for tokenRange in ranges]):
+        counts.update(future.result())
+    log.info('Counted %d rows of %s in %d orgs', sum(counts.values()), table,
+             len(counts))
+    return counts
+
+
+def countedOrgs(session):
+    """
+    Orgs that have counters
+    """
+    query = CassandraCluster.getPreparedStatement(
+        """
+        SELECT DISTINCT org FROM orgcounters
+        """, keyspace=session.keyspace)
+    return {row.org for row in session.execute(query)}
+
+
+def reconcile(dryRun=False, splits=256, concurrency=16, pageSize=5000):
+    """
+    Correct the counters of every org. Returns the number of orgs whose
+    counters were off.
+    """
+    session = ProfiledSession(CassandraCluster.getSession(AuthDB.keyspace),
+                              'export')
+    ranges = tokenRanges(splits)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        actual = {'users': countByOrg(session, config['users']['readtable'],
+                                      executor, ranges, pageSize),
+                  'storedsessions': countByOrg(session, 'usersessions',
+                                               executor, ranges, pageSize)}
+
+    orgs = countedOrgs(session)
+    for counter in COUNTERS:
+        orgs.update(actual[counter])
+
+    drifted = 0
+    for org in sorted(orgs):
+        current = AuthDB.getOrgCounters(org)
+        changes = {counter: actual[counter][org] - current[counter]
+                   for counter in COUNTERS
+                   if actual[counter][org] != current[counter]}
+        if len(changes) == 0:
+            continue
+        drifted += 1
+        log.info('%s: %s', org, ', '.join(
+            '%s %d (counted %d)' % (counter, current[counter],
+                                    actual[counter][org])
+            for counter in sorted(changes)))
+        if not dryRun:
+            AuthDB.updateOrgCounters(org, changes)
+    return drifted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Repair drift in the per-org counters')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report drift without correcting it')
+    parser.add_argument('--splits', type=int, default=256,
+                        help='Token ranges per table (default 256)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Ranges scanned at once (default 16)')
+    parser.add_argument('--pagesize', type=int, default=5000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+
+    drifted = reconcile(dryRun=args.dry_run, splits=args.splits,
+                        concurrency=args.concurrency, pageSize=args.pagesize)
+    log.info('%d orgs %s', drifted,
+             'have drifted' if args.dry_run else 'corrected')
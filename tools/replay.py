@@ -0,0 +1,289 @@
+"""
+Replay captured traffic against a test deployment
+
+Reads capture files written by trafficcapture.py and re-issues the requests
+at the captured pace, a multiple of it, or as fast as possible, then
+reports latency percentiles and error rates per endpoint.
+
+Captured identities are anonymized, so they are mapped onto the test
+deployment: every org becomes --org, usernames are used as captured, and
+session keys are taken from replayed logins. A key whose login was not
+captured is replaced by logging in as the user of the request (or the first
+user seen). Requests that failed when captured are replayed with a wrong
+password or an unknown key so the failure mix is kept. Run with --setup
+once to create the captured users in --org with --password; this needs
+database access like the other tools.
+
+Usage (from the repository root):
+    python -m tools.replay --url http://test-host:8000 [--speed 1|10|max] \\
+        [--setup] [--org ORG] [--password PASSWORD] CAPTURE [CAPTURE ...]
+"""
+
+import argparse
+import http.client
+import json
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from settings import Settings
+
+config = Settings.getConfig()
+
+RULE_ARGUMENT = re.compile(r'<(?:[^<>:]+:)?([^<>]+)>')
+
+
+def load(paths):
+    entries = []
+    for path in paths:
+        with open(path, 'r') as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    return sorted(entries, key=lambda entry: entry['time'])
+
+
+def capturedUsers(entries):
+    users = set()
+    for entry in entries:
+        for args in (entry['view'], entry['query'], entry['body'] or {}):
+            if isinstance(args.get('username'), str):
+                users.add(args['username'])
+            if isinstance(args.get('parentuser'), str):
+                users.add(args['parentuser'].split('@')[0])
+    return sorted(users)
+
+
+def setup(users, org, password):
+    """
+    Create the captured users in org, all with the same password
+    """
+    # Only setup needs the database, replaying does not
+    import passwordutils
+    from database.authdb import AuthDB
+
+    for username in users:
+        # Does nothing if the user already exists
+        AuthDB.createUser(org, username, '%s@example.invalid' % (username,),
+                          None)
+        salt = passwordutils.generateSalt()
+        AuthDB.setPassword(org, username,
+                           passwordutils.hashPassword(password, salt), salt)
+    print('Set up %d users in %s' % (len(users), org))
+
+
+class Replayer:
+    """
+    Issues captured requests, mapping captured identities onto the test
+    deployment
+    """
+
+    def __init__(self, url, org, password, fallbackUser, entries):
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.base = parsed.path.rstrip('/')
+        self.org = org
+        self.password = password
+        self.fallbackUser = fallbackUser
+        self.keys = {}
+        self.sessionIds = {}
+        # Keys issued by captured logins. Requests using them wait for the
+        #   replayed login instead of logging in again.
+        self.issued = {entry['issued']['key']: threading.Event()
+                       for entry in entries if entry.get('issued')}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.results = defaultdict(list)
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            cls = (http.client.HTTPSConnection if self.scheme == 'https'
+                   else http.client.HTTPConnection)
+            self.local.connection = cls(self.netloc, timeout=30)
+        return self.local.connection
+
+    def send(self, method, path, headers, body):
+        """
+        Issue a request on this thread's connection. Returns the status and
+        the decoded JSON body (or None).
+        """
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        for attempt in range(2):
+            try:
+                connection = self.connection()
+                connection.request(method, self.base + path, body=data,
+                                   headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # Stale keep-alive connection, reconnect once
+                self.local.connection = None
+                if attempt == 1:
+                    raise
+        try:
+            return response.status, json.loads(payload)
+        except ValueError:
+            return response.status, None
+
+    def login(self, username):
+        status, body = self.send(
+            'POST', '/sessions/%s@%s' % (username, self.org), {},
+            {'password': self.password})
+        if status != 200 or body is None:
+            return None
+        return body['key']
+
+    def key(self, anonKey, username, failed):
+        """
+        The test deployment key for a captured key
+        """
+        if failed:
+            return 'replay-invalid-%s' % (anonKey,)
+        if anonKey in self.issued:
+            self.issued[anonKey].wait(timeout=30)
+        with self.lock:
+            if anonKey in self.keys:
+                return self.keys[anonKey]
+        realKey = self.login(username or self.fallbackUser)
+        if realKey is None:
+            return 'replay-invalid-%s' % (anonKey,)
+        with self.lock:
+            return self.keys.setdefault(anonKey, realKey)
+
+    def value(self, name, value, entry, username):
+        failed = entry['status'] in (401, 403)
+        if name in ('key', 'keys') and isinstance(value, list):
+            return [self.key(item, username, failed) for item in value]
+        if name == 'key':
+            return self.key(value, username, failed)
+        if name == 'org':
+            return self.org
+        if name == 'parentuser':
+            return '%s@%s' % (value.split('@')[0], self.org)
+        if name == 'sessionId':
+            with self.lock:
+                return self.sessionIds.get(value, str(uuid.uuid4()))
+        if name == 'password':
+            if entry['status'] < 400:
+                return self.password
+            return 'replay-wrong-%s' % (self.password,)
+        if name == 'email':
+            return '%s@example.invalid' % (username or 'replay',)
+        return value
+
+    def build(self, entry):
+        """
+        The method, path, headers and body of a captured request
+        """
+        username = (entry['view'].get('username') or
+                    (entry['body'] or {}).get('username'))
+
+        def resolve(args):
+            return {name: self.value(name, value, entry, username)
+                    for name, value in args.items()
+                    if value is not None or name in ('password', 'email')}
+
+        view = resolve(entry['view'])
+        path = RULE_ARGUMENT.sub(
+            lambda m: urllib.parse.quote(str(view[m.group(1)]), safe='@'),
+            entry['rule'])
+        query = resolve(entry['query'])
+        if query:
+            path += '?' + urllib.parse.urlencode(query, doseq=True)
+        headers = resolve(entry['headers'])
+        body = (resolve(entry['body']) if entry['body'] is not None
+                else None)
+        return entry['method'], path, headers, body
+
+    def replay(self, entry):
+        name = '%s %s' % (entry['method'], entry['endpoint'])
+        start = time.perf_counter()
+        try:
+            method, path, headers, body = self.build(entry)
+            start = time.perf_counter()
+            status, response = self.send(method, path, headers, body)
+        except Exception:
+            status, response = None, None
+        self.record(name, time.perf_counter() - start, status, entry)
+
+        issued = entry.get('issued')
+        if issued:
+            if isinstance(response, dict) and 'key' in response:
+                with self.lock:
+                    self.keys[issued['key']] = response['key']
+                    self.sessionIds[issued['sessionId']] = response.get('id')
+            self.issued[issued['key']].set()
+
+    def record(self, name, duration, status, entry):
+        with self.lock:
+            self.results[name].append((duration, status, entry['status']))
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(results, elapsed):
+    print('%-32s %7s %7s %8s %8s %8s %8s %8s' %
+          ('endpoint', 'count', 'errors', 'mismatch', 'p50 ms', 'p90 ms',
+           'p99 ms', 'max ms'))
+    total = 0
+    for name in sorted(results):
+        rows = results[name]
+        durations = sorted(row[0] * 1000 for row in rows)
+        errors = sum(1 for row in rows if row[1] is None or row[1] >= 500)
+        mismatched = sum(1 for row in rows if row[1] != row[2])
+        total += len(rows)
+        print('%-32s %7d %6.2f%% %7.2f%% %8.2f %8.2f %8.2f %8.2f' %
+              (name, len(rows), errors * 100 / len(rows),
+               mismatched * 100 / len(rows), percentile(durations, 0.5),
+               percentile(durations, 0.9), percentile(durations, 0.99),
+               durations[-1]))
+    print('%d requests in %.1fs (%.1f/s)' %
+          (total, elapsed, total / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay captured traffic against a test deployment')
+    parser.add_argument('captures', nargs='+', help='Capture files')
+    parser.add_argument('--url', required=True,
+                        help='Base URL of the test deployment')
+    parser.add_argument('--speed', default='1',
+                        help='Multiple of the captured pace, or "max" ' +
+                        '(default 1)')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Requests in flight at once (default 32)')
+    parser.add_argument('--org', default=config['defaultorg']['name'],
+                        help='Org every captured org is mapped to')
+    parser.add_argument('--password', default='replay-password',
+                        help='Password of the replayed users')
+    parser.add_argument('--setup', action='store_true',
+                        help='Create the captured users before replaying')
+    args = parser.parse_args()
+
+    entries = load(args.captures)
+    if len(entries) == 0:
+        raise SystemExit('No captured requests')
+    users = capturedUsers(entries)
+    if args.setup:
+        setup(users, args.org, args.password)
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    replayer = Replayer(args.url, args.org, args.password,
+                        users[0] if users else 'replay', entries)
+    first = entries[0]['time']
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for entry in entries:
+            if speed is not None:
+                delay = (entry['time'] - first) / speed - \
+                    (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(replayer.replay, entry)
+    report(replayer.results, time.perf_counter() - start)
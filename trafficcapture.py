@@ -0,0 +1,169 @@
+"""
+Request capture for load testing
+
+When capture.enabled is set, each worker appends one JSON line per request
+to its capture file, recording the shape of the request: endpoint, URL rule,
+method, status and duration. Usernames, orgs, session keys and ids are
+replaced with keyed HMAC identities, so the same user or key maps to the
+same identity in every request and worker but cannot be recovered without
+capture.secret. Passwords, emails and any argument not known to be
+harmless are recorded only as present. tools/replay.py re-issues captured
+traffic against a test deployment.
+
+/batch requests are not recorded themselves, as their bodies cannot be
+sanitized into something replayable. Each of their sub-requests is
+dispatched through the app and recorded as a request of its own instead.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from flask import g, request
+from logging import getLogger
+from settings import Settings
+
+log = getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+# Argument names whose values are identities, and the prefix of their
+# anonymized form
+IDENTITIES = {'username': 'u', 'org': 'o', 'key': 'k', 'keys': 'k',
+              'sessionId': 's', 'resetid': 'r'}
+
+# Arguments whose values are recorded as given
+PLAIN = ('limit', 'start', 'end', 'sort', 'format')
+
+# Endpoints not recorded, as their sub-requests are recorded individually
+SKIPPED = ('batch',)
+
+
+class TrafficCapture:
+    """
+    Singleton writer of sanitized request records
+    """
+
+    lock = threading.Lock()
+    secret = None
+    full = False
+
+    def install(app):
+        """
+        Register the request hooks on a Flask app if capture is enabled
+        """
+        if not config['capture']['enabled']:
+            return False
+        if config['capture']['secret'] is None:
+            log.warning('capture.secret is not set, captured identities ' +
+                        'will not match across workers')
+        app.before_request(TrafficCapture.start)
+        app.after_request(TrafficCapture.record)
+        return True
+
+    def start():
+        if request.endpoint in SKIPPED:
+            return
+        if random.random() < config['capture']['samplerate']:
+            g.captureStart = time.perf_counter()
+
+    def record(response):
+        start = g.pop('captureStart', None)
+        if start is None or TrafficCapture.full:
+            return response
+        try:
+            entry = TrafficCapture.describe(
+                response, (time.perf_counter() - start) * 1000)
+            TrafficCapture.write(json.dumps(entry) + '\n')
+        except Exception as e:
+            log.error('Unable to capture request: %s', e)
+        return response
+
+    def describe(response, durationMs):
+        """
+        Sanitized record of the current request and its response
+        """
+        entry = {'time': time.time(),
+                 'endpoint': request.endpoint,
+                 'method': request.method,
+                 'rule': (request.url_rule.rule
+                          if request.url_rule is not None else request.path),
+                 'view': TrafficCapture.sanitize(request.view_args or {},
+                                                 plain=True),
+                 'query': TrafficCapture.sanitize(request.args.to_dict()),
+                 'headers': {},
+                 'body': None,
+                 'status': response.status_code,
+                 'durationms': round(durationMs, 3)}
+
+        if 'key' in request.headers:
+            entry['headers']['key'] = TrafficCapture.anonymize(
+                'k', request.headers['key'])
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            entry['body'] = TrafficCapture.sanitize(body)
+        elif request.form:
+            entry['body'] = TrafficCapture.sanitize(request.form.to_dict())
+
+        # Sessions issued by the request, so replay can map them
+        if response.is_json and response.status_code < 400:
+            data = response.get_json(silent=True)
+            if isinstance(data, dict) and 'key' in data:
+                entry['issued'] = {
+                    'key': TrafficCapture.anonymize('k', data['key']),
+                    'sessionId': TrafficCapture.anonymize(
+                        's', data.get('id'))}
+        return entry
+
+    def sanitize(args, plain=False):
+        """
+        Anonymize the identities in a dict of arguments and drop the values
+        of anything else not in PLAIN, unless plain is set
+        """
+        sanitized = {}
+        for name, value in args.items():
+            if name == 'parentuser' and isinstance(value, str):
+                sanitized[name] = '@'.join(
+                    TrafficCapture.anonymize(prefix, part)
+                    for prefix, part in zip(('u', 'o'), value.split('@', 1)))
+            elif name in IDENTITIES and isinstance(value, list):
+                sanitized[name] = [
+                    TrafficCapture.anonymize(IDENTITIES[name], item)
+                    for item in value]
+            elif name in IDENTITIES:
+                sanitized[name] = TrafficCapture.anonymize(IDENTITIES[name],
+                                                           value)
+            elif plain or name in PLAIN:
+                sanitized[name] = value
+            elif isinstance(value, list):
+                sanitized[name] = [None] * len(value)
+            else:
+                sanitized[name] = None
+        return sanitized
+
+    def anonymize(prefix, value):
+        """
+        Stable anonymous identity of a value
+        """
+        if TrafficCapture.secret is None:
+            secret = config['capture']['secret']
+            TrafficCapture.secret = (secret.encode('utf-8')
+                                     if secret is not None
+                                     else os.urandom(32))
+        return '%s%s' % (prefix, hmac.new(
+            TrafficCapture.secret, str(value).encode('utf-8'),
+            hashlib.sha256).hexdigest()[:16])
+
+    def write(line):
+        path = config['capture']['file'] % {'pid': os.getpid()}
+        with TrafficCapture.lock:
+            if (os.path.isfile(path) and
+                    os.path.getsize(path) > config['capture']['maxbytes']):
+                log.warning('Capture file "%s" is full, capture stopped', path)
+                TrafficCapture.full = True
+                return
+            with open(path, 'a') as f:
+                f.write(line)
@@ -0,0 +1,275 @@
+"""
+Session key validation over a Unix domain socket
+
+A small binary protocol for sidecars on the same host that only need to
+check session keys, without the cost of HTTP, request parsing and JSON.
+Answers come from the shared session cache when possible and otherwise from
+AuthDB.validateSessionKey() on a thread pool, so the answer is always the
+same as Session.get would give. Run alongside the API workers:
+
+    python validationserver.py
+
+Every frame, in both directions, is a 2-byte big-endian length followed by
+that many bytes.
+
+Request:  4-byte request id, session key (UTF-8)
+Response: 4-byte request id, 1-byte status, 2-byte username length,
+          2-byte org length, username, org (UTF-8)
+
+Status is 1 for a valid key, 0 for an invalid or expired key (username and
+org are set if the session exists) and 2 if the request could not be
+answered. Clients may send many requests without waiting; responses carry
+the request id and may arrive out of order.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from database.authdb import AuthDB
+from database.sessioncache import SessionCache
+from logutils import QueueLogging
+from metrics import Metrics
+from settings import Settings
+
+log = logging.getLogger('gunicorn.error')
+
+config = Settings.getConfig()
+
+Metrics.describe('validationsocket_requests_total', 'counter',
+                 'Session keys validated over the validation socket')
+
+LENGTH = struct.Struct('!H')
+REQUEST = struct.Struct('!I')
+RESPONSE = struct.Struct('!IBHH')
+
+INVALID = 0
+VALID = 1
+ERROR = 2
+
+
+def encodeResponse(requestId, status, username=None, org=None):
+    username = (username or '').encode('utf-8')
+    org = (org or '').encode('utf-8')
+    body = RESPONSE.pack(requestId, status, len(username), len(org)) + \
+        username + org
+    return LENGTH.pack(len(body)) + body
+
+
+class ValidationProtocol(asyncio.Protocol):
+    """
+    One client connection. Cache hits are answered as soon as the request is
+    read; misses are looked up on the executor and answered when done.
+    Reading pauses while validationsocket.maxinflight lookups are pending.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.transport = None
+        self.buffer = bytearray()
+        self.inflight = 0
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        responses = []
+        while len(self.buffer) >= LENGTH.size:
+            length = LENGTH.unpack_from(self.buffer)[0]
+            if len(self.buffer) < LENGTH.size + length:
+                break
+            frame = bytes(self.buffer[LENGTH.size:LENGTH.size + length])
+            del self.buffer[:LENGTH.size + length]
+            if length < REQUEST.size:
+                log.error('Malformed validation request, closing connection')
+                self.transport.close()
+                return
+            requestId = REQUEST.unpack_from(frame)[0]
+            response = self.handle(requestId, frame[REQUEST.size:])
+            if response is not None:
+                responses.append(response)
+
+        if responses:
+            self.transport.write(b''.join(responses))
+        if (not self.paused and
+                self.inflight >= config['validationsocket']['maxinflight']):
+            self.paused = True
+            self.transport.pause_reading()
+
+    def handle(self, requestId, key):
+        """
+        Answer a request from the session cache, or start a lookup and
+        return None
+        """
+        try:
+            sessionKey = key.decode('utf-8')
+            record = SessionCache.get(sessionKey)
+        except Exception as e:
+            log.error('Error validating session over socket: %s', e)
+            return encodeResponse(requestId, ERROR)
+
+        if record is not None:
+            Metrics.inc('validationsocket_requests_total', source='cache')
+            return encodeResponse(
+                requestId,
+                VALID if AuthDB.sessionRecordCurrent(record) else INVALID,
+                record.username, record.org)
+
+        Metrics.inc('validationsocket_requests_total', source='database')
+        self.inflight += 1
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, AuthDB.validateSessionKey, sessionKey, False)
+        future.add_done_callback(
+            lambda f: self.answer(requestId, f))
+        return None
+
+    def answer(self, requestId, future):
+        self.inflight -= 1
+        if self.transport.is_closing():
+            return
+        try:
+            valid, username, org = future.result()
+            response = encodeResponse(requestId, VALID if valid else INVALID,
+                                      username, org)
+        except Exception as e:
+            log.error('Error validating session over socket: %s', e)
+            response = encodeResponse(requestId, ERROR)
+        self.transport.write(response)
+        if (self.paused and
+                self.inflight < config['validationsocket']['maxinflight']):
+            self.paused = False
+            self.transport.resume_reading()
+
+
+async def startServer(path, executor):
+    """
+    Listen on the socket at path, replacing a stale socket file left by a
+    previous run
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    server = await asyncio.get_running_loop().create_unix_server(
+        lambda: ValidationProtocol(executor), path)
+    os.chmod(path, int(config['validationsocket']['mode'], 8))
+    return server
+
+
+async def serve(path):
+    executor = ThreadPoolExecutor(
+        max_workers=config['validationsocket']['threads'],
+        thread_name_prefix='ValidationLookup')
+    server = await startServer(path, executor)
+    log.info('Validating session keys on "%s"', path)
+
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
+    async with server:
+        await stopping.wait()
+    executor.shutdown(wait=False)
+    os.remove(path)
+    log.info('Validation socket stopped')
+
+
+class ValidationClient:
+    """
+    Blocking client for the validation socket
+
+    :path:
+        Socket path, defaults to validationsocket.path
+    """
+
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or config['validationsocket']['path'])
+        self.buffer = bytearray()
+        self.nextId = 0
+
+    def validate(self, sessionKey):
+        """
+        Validate one session key. Returns (valid, username, org) like
+        AuthDB.validateSessionKey(), or raises IOError if the server could
+        not answer.
+        """
+        return self.validateMany([sessionKey])[0]
+
+    def validateMany(self, sessionKeys):
+        """
+        Validate several session keys, sending every request before reading
+        the responses. Returns a list of (valid, username, org) in the order
+        of sessionKeys.
+        """
+        ids = {}
+        frames = []
+        for sessionKey in sessionKeys:
+            self.nextId = (self.nextId + 1) & 0xffffffff
+            ids[self.nextId] = len(ids)
+            body = REQUEST.pack(self.nextId) + sessionKey.encode('utf-8')
+            frames.append(LENGTH.pack(len(body)) + body)
+        self.sock.sendall(b''.join(frames))
+
+        results = [None] * len(ids)
+        remaining = len(ids)
+        while remaining:
+            requestId, status, username, org = self.readResponse()
+            if requestId not in ids:
+                continue
+            if status == ERROR:
+                raise IOError('Validation server could not answer request')
+            results[ids.pop(requestId)] = (status == VALID, username, org)
+            remaining -= 1
+        return results
+
+    def readResponse(self):
+        while True:
+            if len(self.buffer) >= LENGTH.size:
+                length = LENGTH.unpack_from(self.buffer)[0]
+                if len(self.buffer) >= LENGTH.size + length:
+                    frame = bytes(
+                        self.buffer[LENGTH.size:LENGTH.size + length])
+                    del self.buffer[:LENGTH.size + length]
+                    break
+            data = self.sock.recv(65536)
+            if not data:
+                raise IOError('Validation server closed the connection')
+            self.buffer += data
+
+        requestId, status, usernameLength, orgLength = \
+            RESPONSE.unpack_from(frame)
+        offset = RESPONSE.size
+        username = frame[offset:offset + usernameLength].decode('utf-8')
+        offset += usernameLength
+        org = frame[offset:offset + orgLength].decode('utf-8')
+        return requestId, status, username or None, org or None
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    log.setLevel(logging.INFO)
+    # Keep log writes off the event loop
+    QueueLogging.install()
+
+    try:
+        asyncio.run(serve(config['validationsocket']['path']))
+    except Exception as e:
+        log.critical('Validation socket failed: %s', e)
+        sys.exit(1)